@@ -0,0 +1,59 @@
+#Benchmark of the plane accumulation across MPI tasks: native MPI reductions vs the window based tree scheme
+#Run with: mpiexec -n <tasks> python mpi_reduction.py [--sizes 512 1024 2048] [--planes 3] [--repeat 5]
+
+import argparse
+
+import numpy as np
+from mpi4py import MPI
+
+from lenstools.utils import MPIWhirlPool
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--sizes",dest="sizes",nargs="+",type=int,default=[512,1024,2048],help="plane sizes in pixels (per side)")
+parser.add_argument("--planes",dest="planes",type=int,default=3,help="number of planes in the stack")
+parser.add_argument("--repeat",dest="repeat",type=int,default=5,help="number of timed repetitions")
+cmd_args = parser.parse_args()
+
+pool = MPIWhirlPool(comm=MPI.COMM_WORLD)
+
+#Accumulation schemes: (window type,accumulate method), None is a plain pool.reduce on the stack
+schemes = [("sendrecv","tree"),("RMA","tree"),("sendrecv","reduce"),None]
+
+def accumulate(stack,scheme):
+
+	if scheme is None:
+		pool.reduce(stack)
+	else:
+		window_type,method = scheme
+		pool.openWindow(stack,window_type=window_type)
+		pool.accumulate(method=method)
+		pool.closeWindow()
+
+	return stack
+
+if pool.is_master():
+	print("{0} MPI tasks, {1} planes per stack".format(pool.size+1,cmd_args.planes))
+	print("{0:>6} {1:>10} {2:>10} {3:>12}".format("size","window","method","time (s)"))
+
+for size in cmd_args.sizes:
+
+	#Every task contributes its rank to each pixel of the stack
+	expected = pool.size*(pool.size+1)/2
+
+	for scheme in schemes:
+
+		times = list()
+		for r in range(cmd_args.repeat):
+
+			stack = np.ones((cmd_args.planes,size,size),dtype=np.float32) * pool.rank
+
+			pool.comm.Barrier()
+			start = MPI.Wtime()
+			accumulate(stack,scheme)
+			times.append(pool.comm.allreduce(MPI.Wtime()-start,op=MPI.MAX))
+
+		#Check the result and report the median time
+		if pool.is_master():
+			assert np.all(stack==expected),"Wrong accumulation result!"
+			window_type,method = scheme if (scheme is not None) else ("-","reduce")
+			print("{0:>6} {1:>10} {2:>10} {3:>12.4f}".format(size,window_type,method,np.median(times)))
@@ -21,6 +21,8 @@ static struct module_state _state;
 static char module_docstring[] = "This module provides a python interface for operations on Nbody simulation snapshots";
 static char grid3d_docstring[] = "Put the snapshot particles on a regularly spaced grid";
 static char grid3d_nfw_docstring[] = "Put the snapshot particles on a regularly spaced grid, but give each particle a NFW profile";
+static char grid3d_assign_docstring[] = "Put the snapshot particles on a regularly spaced grid with a mass assignment scheme (0=NGP,1=CIC,2=TSC), using multiple threads";
+static char grid_slabs_docstring[] = "Put the snapshot particles on a stack of planes, one for each (normal,slab) pair, in a single pass over the particles";
 static char adaptive_docstring[] = "Put the snapshot particles on a regularly spaced grid using adaptive smoothing";
 
 //Useful
@@ -30,6 +32,8 @@ static PyObject *_apply_kernel3d(PyObject *args,double(*kernel)(double,double,do
 //Method declarations
 static PyObject * _nbody_grid3d(PyObject *self,PyObject *args);
 static PyObject *_nbody_grid3d_nfw(PyObject *self,PyObject *args);
+static PyObject *_nbody_grid3d_assign(PyObject *self,PyObject *args);
+static PyObject *_nbody_grid_slabs(PyObject *self,PyObject *args);
 static PyObject * _nbody_adaptive(PyObject *self,PyObject *args);
 
 //_nbody method definitions
@@ -37,6 +41,8 @@ static PyMethodDef module_methods[] = {
 
 	{"grid3d",_nbody_grid3d,METH_VARARGS,grid3d_docstring},
 	{"grid3d_nfw",_nbody_grid3d_nfw,METH_VARARGS,grid3d_nfw_docstring},
+	{"grid3d_assign",_nbody_grid3d_assign,METH_VARARGS,grid3d_assign_docstring},
+	{"grid_slabs",_nbody_grid_slabs,METH_VARARGS,grid_slabs_docstring},
 	{"adaptive",_nbody_adaptive,METH_VARARGS,adaptive_docstring},
 	{NULL,NULL,0,NULL}
 
@@ -406,6 +412,185 @@ static PyObject *_nbody_grid3d_nfw(PyObject *self,PyObject *args){
 }
 
 
+//grid3d_assign() implementation
+static PyObject *_nbody_grid3d_assign(PyObject *self,PyObject *args){
+
+	PyObject *positions_obj,*bins_obj,*weights_obj;
+	float *weights;
+	int scheme,num_threads;
+
+	//parse input tuple
+	if(!PyArg_ParseTuple(args,"OOOii",&positions_obj,&bins_obj,&weights_obj,&scheme,&num_threads)){
+		return NULL;
+	}
+
+	//interpret parsed objects as arrays
+	PyObject *positions_array = PyArray_FROM_OTF(positions_obj,NPY_FLOAT32,NPY_IN_ARRAY);
+	PyObject *binsX_array = PyArray_FROM_OTF(PyTuple_GET_ITEM(bins_obj,0),NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *binsY_array = PyArray_FROM_OTF(PyTuple_GET_ITEM(bins_obj,1),NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *binsZ_array = PyArray_FROM_OTF(PyTuple_GET_ITEM(bins_obj,2),NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *weights_array = NULL;
+
+	if(weights_obj!=Py_None){
+		weights_array = PyArray_FROM_OTF(weights_obj,NPY_FLOAT32,NPY_IN_ARRAY);
+	}
+
+	//check if anything failed
+	if(positions_array==NULL || binsX_array==NULL || binsY_array==NULL || binsZ_array==NULL || (weights_obj!=Py_None && weights_array==NULL)){
+		
+		Py_XDECREF(positions_array);
+		Py_XDECREF(binsX_array);
+		Py_XDECREF(binsY_array);
+		Py_XDECREF(binsZ_array);
+		Py_XDECREF(weights_array);
+
+		return NULL;
+	}
+
+	//Get data pointers
+	weights = (weights_array==NULL) ? NULL : (float *)PyArray_DATA(weights_array);
+	double *binsX_data = (double *)PyArray_DATA(binsX_array);
+	double *binsY_data = (double *)PyArray_DATA(binsY_array);
+	double *binsZ_data = (double *)PyArray_DATA(binsZ_array);
+
+	//Get info about the number of bins
+	int NumPart = (int)PyArray_DIM(positions_array,0);
+	int nx = (int)PyArray_DIM(binsX_array,0) - 1;
+	int ny = (int)PyArray_DIM(binsY_array,0) - 1;
+	int nz = (int)PyArray_DIM(binsZ_array,0) - 1;
+
+	//Allocate the new array for the grid
+	npy_intp gridDims[] = {(npy_intp) nx,(npy_intp) ny,(npy_intp) nz};
+	PyObject *grid_array = PyArray_ZEROS(3,gridDims,NPY_FLOAT32,0);
+
+	if(grid_array==NULL){
+
+		Py_DECREF(positions_array);
+		Py_DECREF(binsX_array);
+		Py_DECREF(binsY_array);
+		Py_DECREF(binsZ_array);
+		Py_XDECREF(weights_array);
+
+		return NULL;
+
+	}
+
+	//Snap the particles on the grid (the GIL is released while the threads work)
+	int err;
+	Py_BEGIN_ALLOW_THREADS
+	err = grid3dAssign((float *)PyArray_DATA(positions_array),weights,NumPart,binsX_data[0],binsY_data[0],binsZ_data[0],binsX_data[1] - binsX_data[0],binsY_data[1] - binsY_data[0],binsZ_data[1] - binsZ_data[0],nx,ny,nz,scheme,num_threads,(float *)PyArray_DATA(grid_array));
+	Py_END_ALLOW_THREADS
+
+	Py_DECREF(positions_array);
+	Py_DECREF(binsX_array);
+	Py_DECREF(binsY_array);
+	Py_DECREF(binsZ_array);
+	Py_XDECREF(weights_array);
+
+	if(err){
+		Py_DECREF(grid_array);
+		PyErr_NoMemory();
+		return NULL;
+	}
+
+	//return the grid
+	return grid_array;
+
+}
+
+//grid_slabs() implementation
+static PyObject *_nbody_grid_slabs(PyObject *self,PyObject *args){
+
+	PyObject *positions_obj,*bins_obj,*normals_obj,*slab_low_obj,*slab_high_obj,*weights_obj;
+	float *weights;
+	double left[3],size[3];
+	int a,num_threads;
+
+	//parse input tuple
+	if(!PyArg_ParseTuple(args,"OOOOOOi",&positions_obj,&bins_obj,&normals_obj,&slab_low_obj,&slab_high_obj,&weights_obj,&num_threads)){
+		return NULL;
+	}
+
+	//interpret parsed objects as arrays
+	PyObject *positions_array = PyArray_FROM_OTF(positions_obj,NPY_FLOAT32,NPY_IN_ARRAY);
+	PyObject *binsX_array = PyArray_FROM_OTF(PyTuple_GET_ITEM(bins_obj,0),NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *binsY_array = PyArray_FROM_OTF(PyTuple_GET_ITEM(bins_obj,1),NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *binsZ_array = PyArray_FROM_OTF(PyTuple_GET_ITEM(bins_obj,2),NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *normals_array = PyArray_FROM_OTF(normals_obj,NPY_INT32,NPY_IN_ARRAY);
+	PyObject *slab_low_array = PyArray_FROM_OTF(slab_low_obj,NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *slab_high_array = PyArray_FROM_OTF(slab_high_obj,NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *weights_array = NULL;
+
+	if(weights_obj!=Py_None){
+		weights_array = PyArray_FROM_OTF(weights_obj,NPY_FLOAT32,NPY_IN_ARRAY);
+	}
+
+	//check if anything failed
+	if(positions_array==NULL || binsX_array==NULL || binsY_array==NULL || binsZ_array==NULL || normals_array==NULL || slab_low_array==NULL || slab_high_array==NULL || (weights_obj!=Py_None && weights_array==NULL)){
+		
+		Py_XDECREF(positions_array);
+		Py_XDECREF(binsX_array);
+		Py_XDECREF(binsY_array);
+		Py_XDECREF(binsZ_array);
+		Py_XDECREF(normals_array);
+		Py_XDECREF(slab_low_array);
+		Py_XDECREF(slab_high_array);
+		Py_XDECREF(weights_array);
+
+		return NULL;
+	}
+
+	//Data pointers
+	weights = (weights_array==NULL) ? NULL : (float *)PyArray_DATA(weights_array);
+	double *bins_data[3] = {(double *)PyArray_DATA(binsX_array),(double *)PyArray_DATA(binsY_array),(double *)PyArray_DATA(binsZ_array)};
+
+	for(a=0;a<3;a++){
+		left[a] = bins_data[a][0];
+		size[a] = bins_data[a][1] - bins_data[a][0];
+	}
+
+	//Get info about the number of particles, planes and bins (the same number of bins on all the axes)
+	int NumPart = (int)PyArray_DIM(positions_array,0);
+	int npix = (int)PyArray_DIM(binsX_array,0) - 1;
+	int Nnormals = (int)PyArray_DIM(normals_array,0);
+	int Nslabs = (int)PyArray_DIM(slab_low_array,0);
+
+	//Allocate the new array for the planes
+	npy_intp planesDims[] = {(npy_intp) Nnormals,(npy_intp) Nslabs,(npy_intp) npix,(npy_intp) npix};
+	PyObject *planes_array = PyArray_ZEROS(4,planesDims,NPY_FLOAT32,0);
+
+	if(planes_array==NULL){
+
+		Py_DECREF(positions_array);
+		Py_DECREF(binsX_array);
+		Py_DECREF(binsY_array);
+		Py_DECREF(binsZ_array);
+		Py_DECREF(normals_array);
+		Py_DECREF(slab_low_array);
+		Py_DECREF(slab_high_array);
+		Py_XDECREF(weights_array);
+
+		return NULL;
+
+	}
+
+	//Snap the particles on the planes
+	gridSlabs((float *)PyArray_DATA(positions_array),weights,NumPart,left,size,npix,(int *)PyArray_DATA(normals_array),Nnormals,(double *)PyArray_DATA(slab_low_array),(double *)PyArray_DATA(slab_high_array),Nslabs,num_threads,(float *)PyArray_DATA(planes_array));
+
+	//return the planes
+	Py_DECREF(positions_array);
+	Py_DECREF(binsX_array);
+	Py_DECREF(binsY_array);
+	Py_DECREF(binsZ_array);
+	Py_DECREF(normals_array);
+	Py_DECREF(slab_low_array);
+	Py_DECREF(slab_high_array);
+	Py_XDECREF(weights_array);
+
+	return planes_array;
+
+}
+
 //adaptive() implementation
 static PyObject * _nbody_adaptive(PyObject *self,PyObject *args){
 
@@ -30,6 +30,9 @@ static char peakLocations_docstring[] = "Find the peak locations in a 2D map";
 static char gradient_docstring[] = "Compute the gradient of a 2D image";
 static char hessian_docstring[] = "Compute the hessian of a 2D image";
 static char gradLaplacian_docstring[] = "Compute the gradient of the laplacian of a 2D image"; 
+static char lookup_docstring[] = "Look up a range of precomputed planes, interleaved pixel by pixel, at a set of points, writing into a preallocated (num_out,Npoints) array (double or single precision, as the planes)";
+static char jacobianStep_docstring[] = "Update the lensing jacobian and its deflection in place after a lens crossing (double or single precision, as the jacobian)";
+static char gradientHessian_docstring[] = "Compute the gradient and the hessian of a 2D image at a set of points in a single pass, writing into a preallocated (5,Npoints) array (double or single precision, as the output)";
 static char minkowski_docstring[] = "Measure the three Minkowski functionals of a 2D image";
 static char rfft2_azimuthal_docstring[] = "Measure azimuthal average of Fourier transforms of 2D image";
 static char bispectrum_docstring[] = "Measure the bispectrum from the Fourier transform of a 2D image";
@@ -41,6 +44,9 @@ static PyObject *_topology_peakLocations(PyObject *self,PyObject *args);
 static PyObject *_topology_gradient(PyObject *self,PyObject *args);
 static PyObject *_topology_hessian(PyObject *self,PyObject *args);
 static PyObject *_topology_gradLaplacian(PyObject *self,PyObject *args);
+static PyObject *_topology_gradientHessian(PyObject *self,PyObject *args);
+static PyObject *_topology_lookup(PyObject *self,PyObject *args);
+static PyObject *_topology_jacobianStep(PyObject *self,PyObject *args);
 static PyObject *_topology_minkowski(PyObject *self,PyObject *args);
 static PyObject *_topology_rfft2_azimuthal(PyObject *self,PyObject *args);
 static PyObject *_topology_bispectrum(PyObject *self,PyObject *args);
@@ -55,6 +61,9 @@ static PyMethodDef module_methods[] = {
 	{"gradient",_topology_gradient,METH_VARARGS,gradient_docstring},
 	{"hessian",_topology_hessian,METH_VARARGS,hessian_docstring},
 	{"gradLaplacian",_topology_gradLaplacian,METH_VARARGS,gradLaplacian_docstring},
+	{"gradientHessian",_topology_gradientHessian,METH_VARARGS,gradientHessian_docstring},
+	{"lookup",_topology_lookup,METH_VARARGS,lookup_docstring},
+	{"jacobianStep",_topology_jacobianStep,METH_VARARGS,jacobianStep_docstring},
 	{"minkowski",_topology_minkowski,METH_VARARGS,minkowski_docstring},
 	{"rfft2_azimuthal",_topology_rfft2_azimuthal,METH_VARARGS,rfft2_azimuthal_docstring},
 	{"bispectrum",_topology_bispectrum,METH_VARARGS,bispectrum_docstring},
@@ -793,6 +802,253 @@ static PyObject *_topology_gradLaplacian(PyObject *self,PyObject *args){
 
 }
 
+//gradientHessian() implementation
+static PyObject *_topology_gradientHessian(PyObject *self,PyObject *args){
+
+	PyObject *map_obj,*x_obj,*y_obj,*out_obj;
+	double resolution;
+	int offset_i,offset_j;
+
+	/*Parse the input*/
+	if(!PyArg_ParseTuple(args,"OOOdiiO",&map_obj,&x_obj,&y_obj,&resolution,&offset_i,&offset_j,&out_obj)){ 
+		return NULL;
+	}
+
+	/*The output must be a preallocated, writeable, C contiguous array of doubles or floats: its type sets the precision of the calculation*/
+	if(!PyArray_Check(out_obj) || (PyArray_TYPE((PyArrayObject *)out_obj)!=NPY_DOUBLE && PyArray_TYPE((PyArrayObject *)out_obj)!=NPY_FLOAT) || !PyArray_ISCARRAY((PyArrayObject *)out_obj)){
+		PyErr_SetString(PyExc_ValueError,"out must be a writeable, C contiguous array of doubles or floats!");
+		return NULL;
+	}
+
+	int type = PyArray_TYPE((PyArrayObject *)out_obj);
+
+	/*Interpret the input as numpy arrays, cast to the precision of the calculation*/
+	PyObject *map_array = PyArray_FROM_OTF(map_obj,type,NPY_IN_ARRAY|NPY_FORCECAST);
+	PyObject *x_array = PyArray_FROM_OTF(x_obj,type,NPY_IN_ARRAY|NPY_FORCECAST);
+	PyObject *y_array = PyArray_FROM_OTF(y_obj,type,NPY_IN_ARRAY|NPY_FORCECAST);
+
+	if(map_array==NULL || x_array==NULL || y_array==NULL){
+		Py_XDECREF(map_array);
+		Py_XDECREF(x_array);
+		Py_XDECREF(y_array);
+		return NULL;
+	}
+
+	/*Check the sizes*/
+	int Npoints = (int)PyArray_SIZE(x_array);
+	if(PyArray_SIZE(y_array)!=Npoints || PyArray_SIZE((PyArrayObject *)out_obj)!=5*(npy_intp)Npoints){
+		PyErr_SetString(PyExc_ValueError,"x and y must have the same size, out must have 5 times the size of x!");
+		Py_DECREF(map_array);
+		Py_DECREF(x_array);
+		Py_DECREF(y_array);
+		return NULL;
+	}
+
+	/*Get the size of the map (in pixels)*/
+	long Nside = (long)PyArray_DIM(map_array,0);
+
+	/*Get data pointers*/
+	void *map_data = PyArray_DATA(map_array);
+	void *x_data = PyArray_DATA(x_array);
+	void *y_data = PyArray_DATA(y_array);
+	void *out_data = PyArray_DATA((PyArrayObject *)out_obj);
+
+	/*Call the underlying C function that computes the derivatives, without holding the GIL*/
+	Py_BEGIN_ALLOW_THREADS
+	if(type==NPY_DOUBLE){
+		gradient_hessian_xy((double *)map_data,(double *)out_data,Nside,Npoints,(double *)x_data,(double *)y_data,resolution,offset_i,offset_j);
+	} else{
+		gradient_hessian_xy_float((float *)map_data,(float *)out_data,Nside,Npoints,(float *)x_data,(float *)y_data,resolution,offset_i,offset_j);
+	}
+	Py_END_ALLOW_THREADS
+
+	/*Clean up*/
+	Py_DECREF(map_array);
+	Py_DECREF(x_array);
+	Py_DECREF(y_array);
+
+	/*Done, now return*/
+	Py_RETURN_NONE;
+
+}
+
+//lookup() implementation
+static PyObject *_topology_lookup(PyObject *self,PyObject *args){
+
+	PyObject *planes_obj,*x_obj,*y_obj,*out_obj;
+	double resolution;
+	int offset_i,offset_j,first;
+
+	/*Parse the input*/
+	if(!PyArg_ParseTuple(args,"OOOdiiiO",&planes_obj,&x_obj,&y_obj,&resolution,&offset_i,&offset_j,&first,&out_obj)){ 
+		return NULL;
+	}
+
+	/*The planes must be a C contiguous (N,N,num_planes) array of doubles or floats (no copies of the planes are made): their type sets the precision of the lookups*/
+	if(!PyArray_Check(planes_obj) || (PyArray_TYPE((PyArrayObject *)planes_obj)!=NPY_DOUBLE && PyArray_TYPE((PyArrayObject *)planes_obj)!=NPY_FLOAT) || PyArray_NDIM((PyArrayObject *)planes_obj)!=3 || !PyArray_ISCONTIGUOUS((PyArrayObject *)planes_obj) || !PyArray_ISALIGNED((PyArrayObject *)planes_obj)){
+		PyErr_SetString(PyExc_ValueError,"planes must be a C contiguous (N,N,num_planes) array of doubles or floats!");
+		return NULL;
+	}
+
+	int type = PyArray_TYPE((PyArrayObject *)planes_obj);
+
+	/*The output must be a preallocated, writeable, C contiguous array of the same type as the planes*/
+	if(!PyArray_Check(out_obj) || PyArray_TYPE((PyArrayObject *)out_obj)!=type || !PyArray_ISCARRAY((PyArrayObject *)out_obj)){
+		PyErr_SetString(PyExc_ValueError,"out must be a writeable, C contiguous array of the same type as the planes!");
+		return NULL;
+	}
+
+	/*Interpret the input as numpy arrays, cast to the precision of the calculation*/
+	PyObject *x_array = PyArray_FROM_OTF(x_obj,type,NPY_IN_ARRAY|NPY_FORCECAST);
+	PyObject *y_array = PyArray_FROM_OTF(y_obj,type,NPY_IN_ARRAY|NPY_FORCECAST);
+
+	if(x_array==NULL || y_array==NULL){
+		Py_XDECREF(x_array);
+		Py_XDECREF(y_array);
+		return NULL;
+	}
+
+	/*Check the sizes*/
+	int num_planes = (int)PyArray_DIM((PyArrayObject *)planes_obj,2);
+	int Npoints = (int)PyArray_SIZE(x_array);
+	int num_out = (Npoints>0) ? (int)(PyArray_SIZE((PyArrayObject *)out_obj)/Npoints) : 0;
+	if(PyArray_SIZE(y_array)!=Npoints || PyArray_SIZE((PyArrayObject *)out_obj)!=num_out*(npy_intp)Npoints || first<0 || first+num_out>num_planes){
+		PyErr_SetString(PyExc_ValueError,"x and y must have the same size, out must have num_out times the size of x, with first+num_out not exceeding the number of planes!");
+		Py_DECREF(x_array);
+		Py_DECREF(y_array);
+		return NULL;
+	}
+
+	/*Get the size of the planes (in pixels)*/
+	long Nside = (long)PyArray_DIM((PyArrayObject *)planes_obj,1);
+
+	/*Get data pointers*/
+	void *planes_data = PyArray_DATA((PyArrayObject *)planes_obj);
+	void *x_data = PyArray_DATA(x_array);
+	void *y_data = PyArray_DATA(y_array);
+	void *out_data = PyArray_DATA((PyArrayObject *)out_obj);
+
+	/*Call the underlying C function that performs the lookups, without holding the GIL*/
+	Py_BEGIN_ALLOW_THREADS
+	if(type==NPY_DOUBLE){
+		lookup_xy((double *)planes_data,num_planes,(double *)out_data,first,num_out,Nside,Npoints,(double *)x_data,(double *)y_data,resolution,offset_i,offset_j);
+	} else{
+		lookup_xy_float((float *)planes_data,num_planes,(float *)out_data,first,num_out,Nside,Npoints,(float *)x_data,(float *)y_data,resolution,offset_i,offset_j);
+	}
+	Py_END_ALLOW_THREADS
+
+	/*Clean up*/
+	Py_DECREF(x_array);
+	Py_DECREF(y_array);
+
+	/*Done, now return*/
+	Py_RETURN_NONE;
+
+}
+
+//jacobianStep() implementation
+static PyObject *_topology_jacobianStep(PyObject *self,PyObject *args){
+
+	PyObject *jacobian_obj,*jacobian_deflection_obj,*shear_obj,*weight_obj;
+	PyObject *weights_array = NULL;
+	double a,c,weight = 1.0;
+
+	/*Parse the input*/
+	if(!PyArg_ParseTuple(args,"OOOddO",&jacobian_obj,&jacobian_deflection_obj,&shear_obj,&a,&c,&weight_obj)){ 
+		return NULL;
+	}
+
+	/*The jacobian type (double or float) sets the precision of the update*/
+	if(!PyArray_Check(jacobian_obj) || (PyArray_TYPE((PyArrayObject *)jacobian_obj)!=NPY_DOUBLE && PyArray_TYPE((PyArrayObject *)jacobian_obj)!=NPY_FLOAT)){
+		PyErr_SetString(PyExc_ValueError,"the jacobian must be an array of doubles or floats!");
+		return NULL;
+	}
+
+	int type = PyArray_TYPE((PyArrayObject *)jacobian_obj);
+	npy_intp itemsize = (type==NPY_DOUBLE) ? sizeof(double) : sizeof(float);
+
+	/*The jacobian and its deflection are updated in place: they must be writeable (4,Npoints) arrays of the same type, contiguous along the ray axis*/
+	if(PyArray_NDIM((PyArrayObject *)jacobian_obj)!=2 || PyArray_DIM((PyArrayObject *)jacobian_obj,0)!=4 || PyArray_STRIDE((PyArrayObject *)jacobian_obj,1)!=itemsize || !PyArray_ISWRITEABLE((PyArrayObject *)jacobian_obj) || !PyArray_ISALIGNED((PyArrayObject *)jacobian_obj)){
+		PyErr_SetString(PyExc_ValueError,"the jacobian must be a writeable (4,Npoints) array, contiguous along the second axis!");
+		return NULL;
+	}
+
+	if(!PyArray_Check(jacobian_deflection_obj) || PyArray_TYPE((PyArrayObject *)jacobian_deflection_obj)!=type || PyArray_NDIM((PyArrayObject *)jacobian_deflection_obj)!=2 || PyArray_DIM((PyArrayObject *)jacobian_deflection_obj,0)!=4 || PyArray_STRIDE((PyArrayObject *)jacobian_deflection_obj,1)!=itemsize || !PyArray_ISWRITEABLE((PyArrayObject *)jacobian_deflection_obj) || !PyArray_ISALIGNED((PyArrayObject *)jacobian_deflection_obj)){
+		PyErr_SetString(PyExc_ValueError,"the jacobian deflection must be a writeable (4,Npoints) array of the same type as the jacobian, contiguous along the second axis!");
+		return NULL;
+	}
+
+	npy_intp Npoints = PyArray_DIM((PyArrayObject *)jacobian_obj,1);
+	if(PyArray_DIM((PyArrayObject *)jacobian_deflection_obj,1)!=Npoints){
+		PyErr_SetString(PyExc_ValueError,"the jacobian and its deflection must have the same shape!");
+		return NULL;
+	}
+
+	/*Row strides in units of array elements*/
+	long jacobian_stride = (long)(PyArray_STRIDE((PyArrayObject *)jacobian_obj,0)/itemsize);
+	long jacobian_deflection_stride = (long)(PyArray_STRIDE((PyArrayObject *)jacobian_deflection_obj,0)/itemsize);
+
+	/*Interpret the shear matrix as a numpy array, cast to the precision of the calculation*/
+	PyObject *shear_array = PyArray_FROM_OTF(shear_obj,type,NPY_IN_ARRAY|NPY_FORCECAST);
+	if(shear_array==NULL){
+		return NULL;
+	}
+
+	if(PyArray_SIZE(shear_array)!=3*Npoints){
+		PyErr_SetString(PyExc_ValueError,"the shear matrix must have shape (3,Npoints)!");
+		Py_DECREF(shear_array);
+		return NULL;
+	}
+
+	/*The weight can be a number or an array with one weight per ray*/
+	if(!PyArray_Check(weight_obj)){
+		
+		weight = PyFloat_AsDouble(weight_obj);
+		if(weight==-1.0 && PyErr_Occurred()){
+			Py_DECREF(shear_array);
+			return NULL;
+		}
+	
+	} else{
+
+		weights_array = PyArray_FROM_OTF(weight_obj,type,NPY_IN_ARRAY|NPY_FORCECAST);
+		if(weights_array==NULL){
+			Py_DECREF(shear_array);
+			return NULL;
+		}
+
+		if(PyArray_SIZE(weights_array)!=Npoints){
+			PyErr_SetString(PyExc_ValueError,"there must be one weight per ray!");
+			Py_DECREF(shear_array);
+			Py_DECREF(weights_array);
+			return NULL;
+		}
+	}
+
+	/*Get data pointers*/
+	void *jacobian_data = PyArray_DATA((PyArrayObject *)jacobian_obj);
+	void *jacobian_deflection_data = PyArray_DATA((PyArrayObject *)jacobian_deflection_obj);
+	void *shear_data = PyArray_DATA(shear_array);
+	void *weights_data = (weights_array==NULL) ? NULL : PyArray_DATA(weights_array);
+
+	/*Call the underlying C function that updates the jacobian, without holding the GIL*/
+	Py_BEGIN_ALLOW_THREADS
+	if(type==NPY_DOUBLE){
+		jacobian_step((double *)jacobian_data,jacobian_stride,(double *)jacobian_deflection_data,jacobian_deflection_stride,(double *)shear_data,(long)Npoints,(long)Npoints,a,c,(double *)weights_data,weight);
+	} else{
+		jacobian_step_float((float *)jacobian_data,jacobian_stride,(float *)jacobian_deflection_data,jacobian_deflection_stride,(float *)shear_data,(long)Npoints,(long)Npoints,a,c,(float *)weights_data,weight);
+	}
+	Py_END_ALLOW_THREADS
+
+	/*Clean up*/
+	Py_DECREF(shear_array);
+	Py_XDECREF(weights_array);
+
+	/*Done, now return*/
+	Py_RETURN_NONE;
+
+}
+
 //minkowski() implementation
 static PyObject *_topology_minkowski(PyObject *self,PyObject *args){
 
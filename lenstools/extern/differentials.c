@@ -125,4 +125,177 @@ void gradLaplacian(double *map,double *grad_map_x,double *grad_map_y,long map_si
 
 
 	}
-}
\ No newline at end of file
+}
+//Gradient and hessian of a map at the pixels hit by a set of points, in a single pass over the points; the pixel indices are computed dividing the point coordinates by the pixel size (in the same units) and shifted by the (row,column) offsets
+void gradient_hessian_xy(double *map,double *out,long map_size,int Npoints,double *x_points,double *y_points,double resolution,int offset_i,int offset_j){
+
+	int n;
+	long i,j;
+	double *grad_x=out, *grad_y=out+Npoints, *hess_xx=out+2*Npoints, *hess_yy=out+3*Npoints, *hess_xy=out+4*Npoints;
+	double center;
+
+	for(n=0;n<Npoints;n++){
+
+		//Pixel indices (truncation towards zero, periodic boundary conditions)
+		j = ((long)((int)(x_points[n]/resolution)) - offset_j) % map_size;
+		i = ((long)((int)(y_points[n]/resolution)) - offset_i) % map_size;
+		if(j<0) j+=map_size;
+		if(i<0) i+=map_size;
+
+		center = map[coordinate(j,i,map_size)];
+
+		grad_x[n]=(map[coordinate(j+1,i,map_size)]-map[coordinate(j-1,i,map_size)])/2.0;
+		grad_y[n]=(map[coordinate(j,i+1,map_size)]-map[coordinate(j,i-1,map_size)])/2.0;
+
+		hess_xx[n]=(map[coordinate(j+2,i,map_size)]+map[coordinate(j-2,i,map_size)]-2*center)/4.0;
+		hess_yy[n]=(map[coordinate(j,i+2,map_size)]+map[coordinate(j,i-2,map_size)]-2*center)/4.0;
+		hess_xy[n]=(map[coordinate(j+1,i+1,map_size)]+map[coordinate(j-1,i-1,map_size)]-map[coordinate(j-1,i+1,map_size)]-map[coordinate(j+1,i-1,map_size)])/4.0;
+
+	}
+
+}
+
+//Lookup of precomputed planes at a set of points: the planes are interleaved pixel by pixel, shape (map_size,map_size,num_planes), so that all the values of a pixel are contiguous in memory; out[p*Npoints+n] is the value of plane first+p at the pixel hit by point n (num_out planes), with the same pixel indexing as gradient_hessian_xy
+void lookup_xy(double *planes,int num_planes,double *out,int first,int num_out,long map_size,int Npoints,double *x_points,double *y_points,double resolution,int offset_i,int offset_j){
+
+	int n,p;
+	long i,j;
+	double *pixel;
+
+	for(n=0;n<Npoints;n++){
+
+		//Pixel indices (truncation towards zero, periodic boundary conditions)
+		j = ((long)((int)(x_points[n]/resolution)) - offset_j) % map_size;
+		i = ((long)((int)(y_points[n]/resolution)) - offset_i) % map_size;
+		if(j<0) j+=map_size;
+		if(i<0) i+=map_size;
+
+		pixel = planes + (i*map_size + j)*num_planes + first;
+		for(p=0;p<num_out;p++){
+			out[p*(long)Npoints+n] = pixel[p];
+		}
+
+	}
+
+}
+
+//Single lens crossing step of the jacobian recursion, in place: the jacobian deflection (4,Npoints) is updated as jd = a*jd + c*(S.J) where S is the (xx,yy,xy) shear matrix at the ray positions; the jacobian is then updated as J += w*jd, with w a per ray weight (or a constant if weights is NULL). The components are stored in rows separated by the given strides (in units of doubles)
+void jacobian_step(double *jacobian,long jacobian_stride,double *jacobian_deflection,long jacobian_deflection_stride,double *shear,long shear_stride,long Npoints,double a,double c,double *weights,double weight){
+
+	long n;
+	double *j0=jacobian, *j1=jacobian+jacobian_stride, *j2=jacobian+2*jacobian_stride, *j3=jacobian+3*jacobian_stride;
+	double *jd0=jacobian_deflection, *jd1=jacobian_deflection+jacobian_deflection_stride, *jd2=jacobian_deflection+2*jacobian_deflection_stride, *jd3=jacobian_deflection+3*jacobian_deflection_stride;
+	double *s_xx=shear, *s_yy=shear+shear_stride, *s_xy=shear+2*shear_stride;
+	double w;
+
+	for(n=0;n<Npoints;n++){
+
+		//Products with the (symmetric) shear matrix
+		jd0[n] = jd0[n]*a + c*(s_xx[n]*j0[n] + s_xy[n]*j2[n]);
+		jd1[n] = jd1[n]*a + c*(s_xx[n]*j1[n] + s_xy[n]*j3[n]);
+		jd2[n] = jd2[n]*a + c*(s_xy[n]*j0[n] + s_yy[n]*j2[n]);
+		jd3[n] = jd3[n]*a + c*(s_xy[n]*j1[n] + s_yy[n]*j3[n]);
+
+		//Add the distortions to the jacobian
+		w = (weights==NULL) ? weight : weights[n];
+		if(w==1.0){
+			j0[n] += jd0[n];
+			j1[n] += jd1[n];
+			j2[n] += jd2[n];
+			j3[n] += jd3[n];
+		} else if(w!=0.0){
+			j0[n] += jd0[n]*w;
+			j1[n] += jd1[n]*w;
+			j2[n] += jd2[n]*w;
+			j3[n] += jd3[n]*w;
+		}
+
+	}
+
+}
+
+//Single precision versions of gradient_hessian_xy, lookup_xy and jacobian_step (pixel indices and weight factors are computed in double precision as in the double precision versions)
+void gradient_hessian_xy_float(float *map,float *out,long map_size,int Npoints,float *x_points,float *y_points,double resolution,int offset_i,int offset_j){
+
+	int n;
+	long i,j;
+	float *grad_x=out, *grad_y=out+Npoints, *hess_xx=out+2*Npoints, *hess_yy=out+3*Npoints, *hess_xy=out+4*Npoints;
+	float center;
+
+	for(n=0;n<Npoints;n++){
+
+		//Pixel indices (truncation towards zero, periodic boundary conditions)
+		j = ((long)((int)(x_points[n]/resolution)) - offset_j) % map_size;
+		i = ((long)((int)(y_points[n]/resolution)) - offset_i) % map_size;
+		if(j<0) j+=map_size;
+		if(i<0) i+=map_size;
+
+		center = map[coordinate(j,i,map_size)];
+
+		grad_x[n]=(map[coordinate(j+1,i,map_size)]-map[coordinate(j-1,i,map_size)])/2.0f;
+		grad_y[n]=(map[coordinate(j,i+1,map_size)]-map[coordinate(j,i-1,map_size)])/2.0f;
+
+		hess_xx[n]=(map[coordinate(j+2,i,map_size)]+map[coordinate(j-2,i,map_size)]-2*center)/4.0f;
+		hess_yy[n]=(map[coordinate(j,i+2,map_size)]+map[coordinate(j,i-2,map_size)]-2*center)/4.0f;
+		hess_xy[n]=(map[coordinate(j+1,i+1,map_size)]+map[coordinate(j-1,i-1,map_size)]-map[coordinate(j-1,i+1,map_size)]-map[coordinate(j+1,i-1,map_size)])/4.0f;
+
+	}
+
+}
+
+void lookup_xy_float(float *planes,int num_planes,float *out,int first,int num_out,long map_size,int Npoints,float *x_points,float *y_points,double resolution,int offset_i,int offset_j){
+
+	int n,p;
+	long i,j;
+	float *pixel;
+
+	for(n=0;n<Npoints;n++){
+
+		//Pixel indices (truncation towards zero, periodic boundary conditions)
+		j = ((long)((int)(x_points[n]/resolution)) - offset_j) % map_size;
+		i = ((long)((int)(y_points[n]/resolution)) - offset_i) % map_size;
+		if(j<0) j+=map_size;
+		if(i<0) i+=map_size;
+
+		pixel = planes + (i*map_size + j)*num_planes + first;
+		for(p=0;p<num_out;p++){
+			out[p*(long)Npoints+n] = pixel[p];
+		}
+
+	}
+
+}
+
+void jacobian_step_float(float *jacobian,long jacobian_stride,float *jacobian_deflection,long jacobian_deflection_stride,float *shear,long shear_stride,long Npoints,double a,double c,float *weights,double weight){
+
+	long n;
+	float *j0=jacobian, *j1=jacobian+jacobian_stride, *j2=jacobian+2*jacobian_stride, *j3=jacobian+3*jacobian_stride;
+	float *jd0=jacobian_deflection, *jd1=jacobian_deflection+jacobian_deflection_stride, *jd2=jacobian_deflection+2*jacobian_deflection_stride, *jd3=jacobian_deflection+3*jacobian_deflection_stride;
+	float *s_xx=shear, *s_yy=shear+shear_stride, *s_xy=shear+2*shear_stride;
+	float fa=(float)a, fc=(float)c, w;
+
+	for(n=0;n<Npoints;n++){
+
+		//Products with the (symmetric) shear matrix
+		jd0[n] = jd0[n]*fa + fc*(s_xx[n]*j0[n] + s_xy[n]*j2[n]);
+		jd1[n] = jd1[n]*fa + fc*(s_xx[n]*j1[n] + s_xy[n]*j3[n]);
+		jd2[n] = jd2[n]*fa + fc*(s_xy[n]*j0[n] + s_yy[n]*j2[n]);
+		jd3[n] = jd3[n]*fa + fc*(s_xy[n]*j1[n] + s_yy[n]*j3[n]);
+
+		//Add the distortions to the jacobian
+		w = (weights==NULL) ? (float)weight : weights[n];
+		if(w==1.0f){
+			j0[n] += jd0[n];
+			j1[n] += jd1[n];
+			j2[n] += jd2[n];
+			j3[n] += jd3[n];
+		} else if(w!=0.0f){
+			j0[n] += jd0[n]*w;
+			j1[n] += jd1[n]*w;
+			j2[n] += jd2[n]*w;
+			j3[n] += jd3[n]*w;
+		}
+
+	}
+
+}
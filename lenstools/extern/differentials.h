@@ -4,5 +4,11 @@
 void gradient_xy(double *map,double *grad_map_x,double *grad_map_y,long map_size,int Npoints,int *x_points,int *y_points);
 void hessian(double *map,double *hess_xx_map,double *hess_yy_map,double *hess_xy_map,long map_size,int Npoints, int *x_points,int *y_points);
 void gradLaplacian(double *map,double *grad_map_x,double *grad_map_y,long map_size,int Npoints,int *x_points,int *y_points);
+void gradient_hessian_xy(double *map,double *out,long map_size,int Npoints,double *x_points,double *y_points,double resolution,int offset_i,int offset_j);
+void lookup_xy(double *planes,int num_planes,double *out,int first,int num_out,long map_size,int Npoints,double *x_points,double *y_points,double resolution,int offset_i,int offset_j);
+void jacobian_step(double *jacobian,long jacobian_stride,double *jacobian_deflection,long jacobian_deflection_stride,double *shear,long shear_stride,long Npoints,double a,double c,double *weights,double weight);
+void gradient_hessian_xy_float(float *map,float *out,long map_size,int Npoints,float *x_points,float *y_points,double resolution,int offset_i,int offset_j);
+void lookup_xy_float(float *planes,int num_planes,float *out,int first,int num_out,long map_size,int Npoints,float *x_points,float *y_points,double resolution,int offset_i,int offset_j);
+void jacobian_step_float(float *jacobian,long jacobian_stride,float *jacobian_deflection,long jacobian_deflection_stride,float *shear,long shear_stride,long Npoints,double a,double c,float *weights,double weight);
 
 #endif
\ No newline at end of file
@@ -1,6 +1,10 @@
 #include <stdlib.h>
 #include <math.h>
 
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
 #include "coordinates.h"
 #include "grid.h"
 
@@ -8,6 +12,11 @@
 #define CONCENTRATION_DEFAULT 1.0
 #define NFW_CUT 0.1
 
+//Mass assignment schemes
+#define ASSIGN_NGP 0
+#define ASSIGN_CIC 1
+#define ASSIGN_TSC 2
+
 
 //NFW density profile
 double nfwKernel(double dsquared,double w,double rv,double c){
@@ -171,6 +180,251 @@ int grid3d(float *positions,float *weights,double *radius,double *concentration,
 }
 
 
+//Snap particles on a stack of 2d planes in a single pass: one plane for each (normal,slab) pair, each plane collects the particles that fall in the slab along the normal direction; planes has shape (Nnormals,Nslabs,npix,npix) and the plane directions are the two axes different from the normal, in increasing order. Only the planes p with p%numOwners==owner are filled
+static void gridSlabsOwned(float *positions,float *weights,int Npart,double *left,double *size,int npix,int *normals,int Nnormals,double *slabLow,double *slabHigh,int Nslabs,int owner,int numOwners,float *planes){
+
+	long n;
+	int d,s,a,ip,jp;
+	int directions[3][2] = {{1,2},{0,2},{0,1}};
+	double pixel[3],posNormal;
+	float w;
+
+	for(n=0;n<Npart;n++){
+
+		//Compute the position on the grid along each axis in the fastest way
+		for(a=0;a<3;a++) pixel[a] = (positions[3*n + a] - left[a])/size[a];
+		
+		if(weights==NULL){
+			w = 1.0;
+		} else{
+			w = weights[n];
+		}
+
+		//Add the particle to all the slabs it belongs to
+		for(d=0;d<Nnormals;d++){
+
+			if(pixel[directions[normals[d]][0]]<0 || pixel[directions[normals[d]][0]]>=npix || pixel[directions[normals[d]][1]]<0 || pixel[directions[normals[d]][1]]>=npix) continue;
+			
+			ip = (int)pixel[directions[normals[d]][0]];
+			jp = (int)pixel[directions[normals[d]][1]];
+			posNormal = positions[3*n + normals[d]];
+
+			for(s=0;s<Nslabs;s++){
+				if(((d*Nslabs + s)%numOwners)==owner && posNormal>=slabLow[s] && posNormal<slabHigh[s]) planes[(((long)(d*Nslabs + s))*npix + ip)*npix + jp] += w;
+			}
+
+		}
+
+	}
+
+}
+
+//With OpenMP, each thread fills its own subset of the planes in a pass over the particles (so the result does not depend on the number of threads)
+int gridSlabs(float *positions,float *weights,int Npart,double *left,double *size,int npix,int *normals,int Nnormals,double *slabLow,double *slabHigh,int Nslabs,int numThreads,float *planes){
+
+	int t;
+
+	#ifdef _OPENMP
+	if(numThreads<1) numThreads = omp_get_max_threads();
+	#else
+	numThreads = 1;
+	#endif
+
+	if(numThreads>Nnormals*Nslabs) numThreads = Nnormals*Nslabs;
+	if(numThreads<1) numThreads = 1;
+
+	#pragma omp parallel for num_threads(numThreads) schedule(static,1)
+	for(t=0;t<numThreads;t++) gridSlabsOwned(positions,weights,Npart,left,size,npix,normals,Nnormals,slabLow,slabHigh,Nslabs,t,numThreads,planes);
+
+	return 0;
+
+}
+
+//One dimensional mass assignment weights of a particle at grid coordinate x (in units of the cell size, cell n spans [n,n+1)): fills the index of the first cell touched and the weights of the cells touched, returns the number of cells touched
+static inline int assignmentWeights(double x,int scheme,long *first,double *w){
+
+	double d;
+
+	switch(scheme){
+
+		case ASSIGN_CIC:
+
+			d = x - 0.5;
+			*first = (long)floor(d);
+			d -= *first;
+			w[0] = 1.0 - d;
+			w[1] = d;
+			return 2;
+
+		case ASSIGN_TSC:
+
+			*first = (long)floor(x);
+			d = x - (*first + 0.5);
+			*first -= 1;
+			w[0] = 0.5*(0.5-d)*(0.5-d);
+			w[1] = 0.75 - d*d;
+			w[2] = 0.5*(0.5+d)*(0.5+d);
+			return 3;
+
+		default:
+
+			*first = (long)floor(x);
+			w[0] = 1.0;
+			return 1;
+
+	}
+
+}
+
+//Assign the mass of a particle to the grid, only in the cells with x index in [minI,maxI) (the cells that fall outside of the grid are discarded)
+static inline void assignParticle(float *positions,float *weights,long n,double leftX,double leftY,double leftZ,double sizeX,double sizeY,double sizeZ,long minI,long maxI,int ny,int nz,int scheme,float *grid){
+
+	long firstI,firstJ,firstK,ii,jj,kk;
+	int a,b,l,ni,nj,nk;
+	double wi[3],wj[3],wk[3],w;
+
+	w = (weights==NULL) ? 1.0 : (double)weights[n];
+
+	ni = assignmentWeights((positions[3*n] - leftX)/sizeX,scheme,&firstI,wi);
+	nj = assignmentWeights((positions[3*n + 1] - leftY)/sizeY,scheme,&firstJ,wj);
+	nk = assignmentWeights((positions[3*n + 2] - leftZ)/sizeZ,scheme,&firstK,wk);
+
+	for(a=0;a<ni;a++){
+		
+		ii = firstI + a;
+		if(ii<minI || ii>=maxI) continue;
+
+		for(b=0;b<nj;b++){
+			
+			jj = firstJ + b;
+			if(jj<0 || jj>=ny) continue;
+
+			for(l=0;l<nk;l++){
+				
+				kk = firstK + l;
+				if(kk<0 || kk>=nz) continue;
+
+				grid[(ii*ny + jj)*nz + kk] += (float)(w*wi[a]*wj[b]*wk[l]);
+			}
+		}
+	}
+
+}
+
+//Range of the x cell indices touched by a particle, clipped to the grid (empty if *minI>*maxI)
+static inline void particleRangeX(float *positions,long n,double leftX,double sizeX,int nx,int scheme,long *minI,long *maxI){
+
+	double wi[3];
+	int ni = assignmentWeights((positions[3*n] - leftX)/sizeX,scheme,minI,wi);
+
+	*maxI = *minI + ni - 1;
+	if(*minI<0) *minI = 0;
+	if(*maxI>nx-1) *maxI = nx-1;
+
+}
+
+//Mass assignment (NGP, CIC or TSC) of the particles on a 3d regularly spaced grid; with OpenMP, the grid is split in slabs along x, one for each thread, the particles are bucketed by slab with a stable counting sort and each thread grids the particles in its slab in the original order, so the result does not depend on the number of threads
+int grid3dAssign(float *positions,float *weights,int Npart,double leftX,double leftY,double leftZ,double sizeX,double sizeY,double sizeZ,int nx,int ny,int nz,int scheme,int numThreads,float *grid){
+
+	long n;
+
+	#ifdef _OPENMP
+	if(numThreads<1) numThreads = omp_get_max_threads();
+	#else
+	numThreads = 1;
+	#endif
+
+	if(numThreads>nx) numThreads = nx;
+
+	//Single thread: grid the particles in order
+	if(numThreads<=1){
+
+		for(n=0;n<Npart;n++) assignParticle(positions,weights,n,leftX,leftY,leftZ,sizeX,sizeY,sizeZ,0,nx,ny,nz,scheme,grid);
+		return 0;
+
+	}
+
+	#ifdef _OPENMP
+
+	//Slab o spans the x indices [o*nx/T,(o+1)*nx/T), chunk c of the particles is [c*N/T,(c+1)*N/T)
+	int T = numThreads;
+	long k,minI,maxI;
+	int t,o,c;
+	long *counts,*offsets,*start;
+	int *order;
+
+	if((counts = (long *)calloc(T*T,sizeof(long)))==NULL) return 1;
+	if((offsets = (long *)malloc(sizeof(long)*T*T))==NULL){
+		free(counts);
+		return 1;
+	}
+	if((start = (long *)malloc(sizeof(long)*(T+1)))==NULL){
+		free(counts);
+		free(offsets);
+		return 1;
+	}
+
+	//Count the particles of each chunk that touch each slab
+	#pragma omp parallel num_threads(T) private(n,minI,maxI,o)
+	{
+		int chunk = omp_get_thread_num();
+		long last = ((long)Npart*(chunk+1))/T;
+
+		for(n=((long)Npart*chunk)/T;n<last;n++){
+			particleRangeX(positions,n,leftX,sizeX,nx,scheme,&minI,&maxI);
+			if(minI>maxI) continue;
+			for(o=(int)((minI*T)/nx);o<=(int)((maxI*T)/nx);o++) counts[chunk*T + o]++;
+		}
+	}
+
+	//Offsets: slab major, chunk minor, so that the particles of each slab keep their original order
+	k = 0;
+	for(o=0;o<T;o++){
+		start[o] = k;
+		for(c=0;c<T;c++){
+			offsets[c*T + o] = k;
+			k += counts[c*T + o];
+		}
+	}
+	start[T] = k;
+
+	if((order = (int *)malloc(sizeof(int)*(k>0 ? k : 1)))==NULL){
+		free(counts);
+		free(offsets);
+		free(start);
+		return 1;
+	}
+
+	//Bucket the particles by slab
+	#pragma omp parallel num_threads(T) private(n,minI,maxI,o)
+	{
+		int chunk = omp_get_thread_num();
+		long last = ((long)Npart*(chunk+1))/T;
+
+		for(n=((long)Npart*chunk)/T;n<last;n++){
+			particleRangeX(positions,n,leftX,sizeX,nx,scheme,&minI,&maxI);
+			if(minI>maxI) continue;
+			for(o=(int)((minI*T)/nx);o<=(int)((maxI*T)/nx);o++) order[offsets[chunk*T + o]++] = (int)n;
+		}
+	}
+
+	//Each thread grids the particles in its own slab
+	#pragma omp parallel for num_threads(T) private(k) schedule(static,1)
+	for(t=0;t<T;t++){
+		for(k=start[t];k<start[t+1];k++) assignParticle(positions,weights,order[k],leftX,leftY,leftZ,sizeX,sizeY,sizeZ,((long)nx*t + T - 1)/T,((long)nx*(t+1) + T - 1)/T,ny,nz,scheme,grid);
+	}
+
+	free(counts);
+	free(offsets);
+	free(start);
+	free(order);
+
+	#endif
+
+	return 0;
+
+}
+
 //adaptive smoothing
 int adaptiveSmoothing(int NumPart,float *positions,float *weights,double *rp,double *concentration,double *binning0, double *binning1,double center,int direction0,int direction1,int normal,int size0,int size1,int projectAll,double *lensingPlane,double(*kernel)(double,double,double,double)){
 
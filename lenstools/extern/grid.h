@@ -5,6 +5,8 @@
 
 int grid2d(double *x,double *y,double *s,double *map,int Nobjects,int Npixel,double map_size);
 int grid3d(float *positions,float *weights,double *radius,double *concentration,int Npart,double leftX,double leftY,double leftZ,double sizeX,double sizeY,double sizeZ,int nx,int ny,int nz,float *grid,double(*kernel)(double,double,double,double));
+int grid3dAssign(float *positions,float *weights,int Npart,double leftX,double leftY,double leftZ,double sizeX,double sizeY,double sizeZ,int nx,int ny,int nz,int scheme,int numThreads,float *grid);
+int gridSlabs(float *positions,float *weights,int Npart,double *left,double *size,int npix,int *normals,int Nnormals,double *slabLow,double *slabHigh,int Nslabs,int numThreads,float *planes);
 int adaptiveSmoothing(int NumPart,float *positions,float *weights,double *rp,double *concentration,double *binning0, double *binning1,double center,int direction0,int direction1,int normal,int size0,int size1,int projectAll,double *lensingPlane,double(*kernel)(double,double,double,double));
 
 static inline double quadraticKernel(double dsquared,double w,double rv,double c){
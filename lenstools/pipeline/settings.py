@@ -162,6 +162,22 @@ class PlaneSettings(LTSettings):
 		self.smooth = 1
 		self.kind = "potential"
 
+		#Mass assignment scheme and number of threads for the particle gridding
+		self.mass_assignment = "NGP"
+		self.num_threads = 1
+
+		#If not None, the particle positions are read (and gridded) this many at a time instead of all at once
+		self.chunk_size = None
+
+		#Memory (in GB) available on each task to the stack of planes gridded in a single pass over the particles; the planes that do not fit are gridded in further passes
+		self.memory_budget = 1.0
+
+		#If True, the particles of all the snapshot files are divided evenly between the MPI tasks, instead of each task reading one file
+		self.distribute_particles = False
+
+		#Save the derivative planes (deflection angles and shear matrix) alongside each potential plane
+		self.save_derivatives = False
+
 		#Allow for kwargs override
 		for key in kwargs:
 			setattr(self,key,kwargs[key])
@@ -238,6 +254,36 @@ class PlaneSettings(LTSettings):
 		except NoOptionError:
 			pass
 
+		try:
+			settings.save_derivatives = options.getboolean(section,"save_derivatives")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.mass_assignment = options.get(section,"mass_assignment")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.num_threads = options.getint(section,"num_threads")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.chunk_size = options.getint(section,"chunk_size")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.memory_budget = options.getfloat(section,"memory_budget")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.distribute_particles = options.getboolean(section,"distribute_particles")
+		except NoOptionError:
+			pass
+
 		#Return to user
 		return settings
 
@@ -279,6 +325,22 @@ class PlaneLightConeSettings(LTSettings):
 		self.smooth = 1
 		self.kind = "potential"
 
+		#Mass assignment scheme and number of threads for the particle gridding
+		self.mass_assignment = "NGP"
+		self.num_threads = 1
+
+		#If not None, the particle positions are read (and gridded) this many at a time instead of all at once
+		self.chunk_size = None
+
+		#Memory (in GB) available on each task to the stack of planes gridded in a single pass over the particles; the planes that do not fit are gridded in further passes
+		self.memory_budget = 1.0
+
+		#If True, the particles of all the snapshot files are divided evenly between the MPI tasks, instead of each task reading one file
+		self.distribute_particles = False
+
+		#Save the derivative planes (deflection angles and shear matrix) alongside each potential plane
+		self.save_derivatives = False
+
 		#On the fly raytracing
 		self.do_lensing = False
 		self.integration_type = "full"
@@ -348,6 +410,36 @@ class PlaneLightConeSettings(LTSettings):
 		except NoOptionError:
 			pass
 
+		try:
+			settings.save_derivatives = options.getboolean(section,"save_derivatives")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.mass_assignment = options.get(section,"mass_assignment")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.num_threads = options.getint(section,"num_threads")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.chunk_size = options.getint(section,"chunk_size")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.memory_budget = options.getfloat(section,"memory_budget")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.distribute_particles = options.getboolean(section,"distribute_particles")
+		except NoOptionError:
+			pass
+
 		#Return to user
 		return settings
 
@@ -396,9 +488,39 @@ class MapSettings(LTSettings):
 		self.angle_unit = u.deg
 		self.source_redshift = 2.0
 
+		#If not None, maps are computed for each of these source redshifts (instead of source_redshift) from a single ray tracing pass
+		self.source_redshifts = None
+
 		#Random seed used to generate multiple map realizations
 		self.seed = 0
 
+		#Memory budget (in GB) of the lens plane cache shared between realizations (0 disables the cache)
+		self.plane_cache_size = 0.0
+
+		#Maximum number of light rays moved across each lens at once (0 moves all the rays at once)
+		self.ray_chunk_size = 0
+
+		#Number of lens planes read ahead of the one being crossed by a background thread (0 disables prefetching)
+		self.prefetch_lenses = 0
+
+		#Look up deflections and shear matrices in the derivative planes saved alongside the lens planes (if present and up to date)
+		self.derivative_planes = False
+
+		#Share the lens planes between the MPI tasks on the same node (one copy per node instead of one copy per task)
+		self.shared_planes = False
+
+		#Hand out the realizations to the MPI tasks on demand (the master task schedules, the other tasks trace) instead of in fixed blocks
+		self.dynamic_scheduling = False
+
+		#Number of realizations traced together against a shared lens stack (planes drawn by more realizations are loaded once)
+		self.batch_realizations = 1
+
+		#Split each map between the MPI tasks in tiles of light rays: each task reads only the windows of the lens planes its rays can hit
+		self.domain_decomposition = False
+
+		#Hold the lens planes, their derivatives and the light ray state in single precision (half the memory and bandwidth)
+		self.single_precision = False
+
 		#Transpose lenses up to a certain index
 		self.transpose_up_to = -1
 
@@ -476,12 +598,62 @@ class MapSettings(LTSettings):
 		
 		self.source_redshift = options.getfloat(section,"source_redshift")
 
+		try:
+			self.source_redshifts = [ float(z) for z in options.get(section,"source_redshifts").split(",") ]
+		except NoOptionError:
+			pass
+
 		self.seed = options.getint(section,"seed")
 		try:
 			self.transpose_up_to = options.getint(section,"transpose_up_to")
 		except NoOptionError:
 			pass
 
+		try:
+			self.plane_cache_size = options.getfloat(section,"plane_cache_size")
+		except NoOptionError:
+			pass
+
+		try:
+			self.ray_chunk_size = options.getint(section,"ray_chunk_size")
+		except NoOptionError:
+			pass
+
+		try:
+			self.prefetch_lenses = options.getint(section,"prefetch_lenses")
+		except NoOptionError:
+			pass
+
+		try:
+			self.derivative_planes = options.getboolean(section,"derivative_planes")
+		except NoOptionError:
+			pass
+
+		try:
+			self.shared_planes = options.getboolean(section,"shared_planes")
+		except NoOptionError:
+			pass
+
+		try:
+			self.dynamic_scheduling = options.getboolean(section,"dynamic_scheduling")
+		except NoOptionError:
+			pass
+
+		try:
+			self.batch_realizations = options.getint(section,"batch_realizations")
+		except NoOptionError:
+			pass
+
+		try:
+			self.domain_decomposition = options.getboolean(section,"domain_decomposition")
+		except NoOptionError:
+			pass
+
+		try:
+			self.single_precision = options.getboolean(section,"single_precision")
+		except NoOptionError:
+			pass
+
 		###########################################################################################
 
 		try:
@@ -629,6 +801,27 @@ class CatalogSettings(LTSettings):
 		#Random seed used to generate multiple catalog realizations
 		self.seed = 0
 
+		#Memory budget (in GB) of the lens plane cache shared between realizations (0 disables the cache)
+		self.plane_cache_size = 0.0
+
+		#Maximum number of light rays moved across each lens at once (0 moves all the rays at once)
+		self.ray_chunk_size = 0
+
+		#Number of lens planes read ahead of the one being crossed by a background thread (0 disables prefetching)
+		self.prefetch_lenses = 0
+
+		#Look up deflections and shear matrices in the derivative planes saved alongside the lens planes (if present and up to date)
+		self.derivative_planes = False
+
+		#Share the lens planes between the MPI tasks on the same node (one copy per node instead of one copy per task)
+		self.shared_planes = False
+
+		#Hand out the realizations to the MPI tasks on demand (the master task schedules, the other tasks trace) instead of in fixed blocks
+		self.dynamic_scheduling = False
+
+		#Hold the lens planes, their derivatives and the light ray state in single precision (half the memory and bandwidth)
+		self.single_precision = False
+
 		#Set of lens planes to be used during ray tracing
 		self.plane_set = "Planes"
 
@@ -682,6 +875,41 @@ class CatalogSettings(LTSettings):
 		#Set of lens planes to be used during ray tracing
 		settings.seed = options.getint(section,"seed")
 
+		try:
+			settings.plane_cache_size = options.getfloat(section,"plane_cache_size")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.ray_chunk_size = options.getint(section,"ray_chunk_size")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.prefetch_lenses = options.getint(section,"prefetch_lenses")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.derivative_planes = options.getboolean(section,"derivative_planes")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.shared_planes = options.getboolean(section,"shared_planes")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.dynamic_scheduling = options.getboolean(section,"dynamic_scheduling")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.single_precision = options.getboolean(section,"single_precision")
+		except NoOptionError:
+			pass
+
 		#Set of lens planes to be used during ray tracing
 		settings.plane_set = options.get(section,"plane_set")
 
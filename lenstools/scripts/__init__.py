@@ -17,6 +17,7 @@ integration_types = {
 "postBorn1+2" : "Convergence at Born + second post Born order in the lensing potential",
 "postBorn1+2-ll" : "Convergence at Born + second post Born order (lens-lens only)",
 "postBorn1+2-gp" : "Convergence at Born + second post Born order (geodesic perturbation only)",
-"omega2" : "Rotation at second order in the lensing potential"
+"omega2" : "Rotation at second order in the lensing potential",
+"combined" : "Born, lens-lens, geodesic perturbation and ray traced convergence, in a single pass through the lenses (one map each)"
 
 }
\ No newline at end of file
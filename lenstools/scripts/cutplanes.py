@@ -24,6 +24,7 @@ from lenstools.utils import MPIWhirlPool
 from lenstools import configuration
 
 import numpy as np
+import astropy.units as u
 from astropy.cosmology import z_at_value
 
 #FFT engine
@@ -125,16 +126,6 @@ def cnstTime(pool,batch,settings,batch_id,override):
 	smooth = settings.smooth
 	kind = settings.kind
 
-	#Place holder for the lensing density on the plane
-	density_projected = np.empty((plane_resolution,)*2,dtype=np.float32)
-
-	#Open a RMA window on the density placeholder
-	if pool is not None:
-		pool.openWindow(density_projected)
-		
-		if pool.is_master():
-			logdriver.debug("Opened density window of type {0}".format(pool._window_type))
-
 	#Pre--compute multipoles for solving Poisson equation
 	lx,ly = np.meshgrid(fftengine.fftfreq(plane_resolution),fftengine.rfftfreq(plane_resolution),indexing="ij")
 	l_squared = lx**2 + ly**2
@@ -148,8 +139,11 @@ def cnstTime(pool,batch,settings,batch_id,override):
 	"plane_resolution" : plane_resolution,
 	"thickness_resolution" : thickness_resolution,
 	"smooth" : smooth,
+	"assignment" : settings.mass_assignment,
+	"num_threads" : settings.num_threads,
+	"chunk_size" : settings.chunk_size,
+	"memory_budget" : settings.memory_budget*u.Gbyte,
 	"kind" : kind,
-	"density_placeholder" : density_projected,
 	"l_squared" : l_squared
 
 	}
@@ -175,7 +169,10 @@ def cnstTime(pool,batch,settings,batch_id,override):
 		if pool is not None:
 			logdriver.info("Task {0} reading nbody snapshot from {1}".format(pool.comm.rank,snapshot_filename))
 
-		snap = snapshot_handler.open(snapshot_filename,pool=pool)
+		if settings.distribute_particles:
+			snap = snapshot_handler.openDistributed(snapshot_filename,pool=pool)
+		else:
+			snap = snapshot_handler.open(snapshot_filename,pool=pool)
 
 		#Insert correct comoving distance and cosmology into header
 		if "comoving_distance" not in snap.header:
@@ -185,22 +182,28 @@ def cnstTime(pool,batch,settings,batch_id,override):
 		if pool is not None:
 			logdriver.debug("Task {0} read nbody snapshot from {1}".format(pool.comm.rank,snapshot_filename))
 
-		#Get the positions of the particles
-		if not hasattr(snap,"positions"):
+		#Get the positions of the particles (unless they are read chunk by chunk, or file by file, while gridding)
+		if not(hasattr(snap,"positions")) and (settings.chunk_size is None) and not(settings.distribute_particles):
 			snap.getPositions(first=snap._first,last=snap._last)
 
 		#Log memory usage
 		if (pool is None) or (pool.is_master()):
 			logstderr.debug("Read particle positions: peak memory usage {0:.3f} (task)".format(peakMemory()))
 
-		#Close the snapshot file
-		snap.close()
+		#Close the snapshot file (if the positions are read chunk by chunk, this is done once the planes are cut)
+		if (settings.chunk_size is None) and not(settings.distribute_particles):
+			snap.close()
 
 		#Update the summary info file
 		if (pool is None) or (pool.is_master()):
 			infofile.write("s={0},d={1},z={2}\n".format(n,snap.header["comoving_distance"],snap.header["redshift"]))
 
-		#Cut the lens planes
+		#Cut the lens planes: the particles are binned on all the slabs in a single pass, then the planes are solved one at a time
+		if pool is None or pool.is_master():
+			logdriver.info("Gridding particles on {0} slabs (cut points {1}, normals {2})".format(len(cut_points)*len(normals),cut_points,normals))
+
+		planes = snap.cutPlanesGaussianGrid(normals=normals,centers=cut_points,thickness=thickness,left_corner=np.zeros(3)*snap.Mpc_over_h,**kwargs)
+
 		for cut,pos in enumerate(cut_points):
 			for normal in normals:
 
@@ -211,7 +214,7 @@ def cnstTime(pool,batch,settings,batch_id,override):
 				#####Do the cutting#########
 				############################
 				
-				plane,resolution,NumPart = snap.cutPlaneGaussianGrid(normal=normal,center=pos,thickness=thickness,left_corner=np.zeros(3)*snap.Mpc_over_h,**kwargs)
+				plane,resolution,NumPart = next(planes)
 				
 				#######################################################################################################################################
 
@@ -233,6 +236,11 @@ def cnstTime(pool,batch,settings,batch_id,override):
 					plane_wrap.save(plane_file)
 					logdriver.debug("Saved plane to {0}".format(plane_file))
 
+					#Derivative planes are computed from the pixels as they were saved, so that the ray tracer recognizes them
+					if kind=="potential" and getattr(settings,"save_derivatives",False):
+						logdriver.info("Saving derivatives of plane {0}".format(plane_file))
+						PotentialPlane.load(plane_file).saveDerivatives()
+
 
 				#Log peak memory usage
 				peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(pool)
@@ -245,16 +253,14 @@ def cnstTime(pool,batch,settings,batch_id,override):
 				if pool is not None:
 					pool.comm.Barrier()
 
+		#Close the snapshot file
+		if (settings.chunk_size is not None) or settings.distribute_particles:
+			snap.close()
+
 	#Safety barrier sync
 	if pool is not None:
 		pool.comm.Barrier()
 
-		#Close the RMA window
-		pool.closeWindow()
-		
-		if pool.is_master():
-			logdriver.debug("Closed density window of type {0}".format(pool._window_type))
-
 	#Close the infofile
 	if (pool is None) or (pool.is_master()):
 		infofile.close()
@@ -361,9 +367,6 @@ def lightCone(pool,batch,settings,batch_id,override):
 	#Kind (density, potential or born)
 	kind = settings.kind
 
-	#Place holder for the lensing density on the plane
-	density_projected = np.empty((plane_resolution,)*2,dtype=np.float32)
-
 	################################################################################
 	#Compute the discrete comoving distances which will be the center of the lenses#
 	################################################################################
@@ -377,13 +380,6 @@ def lightCone(pool,batch,settings,batch_id,override):
 	chi_end = chi_max - thickness/2
 	chi_centers = np.linspace(chi_start.value,chi_end.value,num_lenses)*chi_max.unit
 
-	#Open a RMA window on the density placeholder
-	if pool is not None:
-		pool.openWindow(density_projected)
-		
-		if pool.is_master():
-			logdriver.debug("Opened density window of type {0}".format(pool._window_type))
-
 	#Pre--compute multipoles for solving Poisson equation
 	lx,ly = np.meshgrid(fftengine.fftfreq(plane_resolution),fftengine.rfftfreq(plane_resolution),indexing="ij")
 	l_squared = lx**2 + ly**2
@@ -397,7 +393,10 @@ def lightCone(pool,batch,settings,batch_id,override):
 	"plane_resolution" : plane_resolution,
 	"thickness_resolution" : thickness_resolution,
 	"smooth" : smooth,
-	"density_placeholder" : density_projected,
+	"assignment" : settings.mass_assignment,
+	"num_threads" : settings.num_threads,
+	"chunk_size" : settings.chunk_size,
+	"memory_budget" : settings.memory_budget*u.Gbyte,
 	"l_squared" : l_squared
 
 	}
@@ -419,21 +418,29 @@ def lightCone(pool,batch,settings,batch_id,override):
 	if pool is not None:
 		logdriver.info("Task {0} reading nbody snapshot from {1}".format(pool.comm.rank,snapshot_filename))
 
-	snap = snapshot_handler.open(snapshot_filename,pool=pool)
-
-	if pool is not None:
-		logdriver.debug("Task {0} read nbody snapshot from {1}, particles {2}-{3}".format(pool.comm.rank,snapshot_filename,snap._first,snap._last-1))
+	if settings.distribute_particles:
+		
+		snap = snapshot_handler.openDistributed(snapshot_filename,pool=pool)
+		if pool is not None:
+			logdriver.debug("Task {0} reads nbody snapshot particles (file,first,last) {1}".format(pool.comm.rank,snap._parts))
+	
+	else:
+		
+		snap = snapshot_handler.open(snapshot_filename,pool=pool)
+		if pool is not None:
+			logdriver.debug("Task {0} read nbody snapshot from {1}, particles {2}-{3}".format(pool.comm.rank,snapshot_filename,snap._first,snap._last-1))
 
-	#Get the positions of the particles
-	if not hasattr(snap,"positions"):
+	#Get the positions of the particles (unless they are read chunk by chunk, or file by file, while gridding)
+	if not(hasattr(snap,"positions")) and (settings.chunk_size is None) and not(settings.distribute_particles):
 		snap.getPositions(first=snap._first,last=snap._last)
 
 	#Log memory usage
 	if (pool is None) or (pool.is_master()):
 		logstderr.debug("Read particle positions: peak memory usage {0:.3f} (task)".format(peakMemory()))
 
-	#Close the snapshot file
-	snap.close()
+	#Close the snapshot file (if the positions are read chunk by chunk, this is done once the planes are cut)
+	if (settings.chunk_size is None) and not(settings.distribute_particles):
+		snap.close()
 
 	#############################
 	#Check weak lensing settings#
@@ -465,6 +472,12 @@ def lightCone(pool,batch,settings,batch_id,override):
 	#Cycle over the lens centers#
 	#############################
 
+	#The particles are binned on the slabs of all the lenses in a single pass, then the planes are solved one at a time
+	if pool is None or pool.is_master():
+		logdriver.info("Gridding particles on {0} slabs".format(len(chi_centers)*len(normals)))
+
+	planes = snap.cutPlanesGaussianGrid(normals=normals,centers=chi_centers,thickness=thickness,left_corner=np.zeros(3)*snap.Mpc_over_h,kind=kind,**kwargs)
+
 	for n,center in enumerate(chi_centers):
 
 		#Compute the redshift
@@ -485,7 +498,7 @@ def lightCone(pool,batch,settings,batch_id,override):
 				#####Do the cutting#########
 				############################
 				
-				plane,resolution,NumPart = snap.cutPlaneGaussianGrid(normal=normal,center=pos,thickness=thickness,left_corner=np.zeros(3)*snap.Mpc_over_h,kind=kind,**kwargs)
+				plane,resolution,NumPart = next(planes)
 				
 				#######################################################################################################################################
 
@@ -511,6 +524,11 @@ def lightCone(pool,batch,settings,batch_id,override):
 						plane_wrap.save(plane_file)
 						logdriver.debug("Saved plane to {0}".format(plane_file))
 
+						#Derivative planes are computed from the pixels as they were saved, so that the ray tracer recognizes them
+						if kind=="potential" and getattr(settings,"save_derivatives",False):
+							logdriver.info("Saving derivatives of plane {0}".format(plane_file))
+							PotentialPlane.load(plane_file).saveDerivatives()
+
 				#Log peak memory usage
 				peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(pool)
 				if (pool is None) or (pool.is_master()):
@@ -522,16 +540,14 @@ def lightCone(pool,batch,settings,batch_id,override):
 				if pool is not None:
 					pool.comm.Barrier()
 
+	#Close the snapshot file
+	if (settings.chunk_size is not None) or settings.distribute_particles:
+		snap.close()
+
 	#Safety barrier sync
 	if pool is not None:
 		pool.comm.Barrier()
 
-		#Close the RMA window
-		pool.closeWindow()
-		
-		if pool.is_master():
-			logdriver.debug("Closed density window of type {0}".format(pool._window_type))
-
 	#Close the infofile
 	if (pool is None) or (pool.is_master()):
 		infofile.close()
@@ -77,14 +77,6 @@ def matterPowerSpectrum(pool,batch,settings,node_id,**kwargs):
 	#Construct the array of bin edges
 	k_egdes  = np.linspace(settings.kmin,settings.kmax,settings.num_k_bins+1).to(model.Mpc_over_h**-1)
 
-	#Placeholder for the density MPI communications
-	density_placeholder = np.empty((settings.fft_grid_size,)*3,dtype=np.float32)
-	if pool is not None:
-		pool.openWindow(density_placeholder)
-
-		if pool.is_master():
-			logdriver.debug("Opened density window of type {0}".format(pool._window_type))
-
 	#Cycle over snapshots
 	for n in range(settings.first_snapshot,settings.last_snapshot+1):
 
@@ -112,7 +104,7 @@ def matterPowerSpectrum(pool,batch,settings,node_id,**kwargs):
 					sys.exit(1)
 
 			snap = fmt.open(realization.snapshotPath(n,sub=None),pool=pool)
-			k,power_ensemble[r],hits = snap.powerSpectrum(k_egdes,resolution=settings.fft_grid_size,return_num_modes=True,density_placeholder=density_placeholder)
+			k,power_ensemble[r],hits = snap.powerSpectrum(k_egdes,resolution=settings.fft_grid_size,return_num_modes=True)
 			snap.close()
 
 			#Safety barrier sync
@@ -146,14 +138,9 @@ def matterPowerSpectrum(pool,batch,settings,node_id,**kwargs):
 	#Completed#
 	###########
 
-	#Close the RMA window
+	#Safety barrier sync
 	if pool is not None:
 		pool.comm.Barrier()
-		pool.closeWindow()
-		
-		if pool.is_master():
-			logdriver.debug("Closed density window of type {0}".format(pool._window_type))
-
 
 	if pool is None or pool.is_master():
 		logdriver.info("DONE!!")
@@ -3,8 +3,9 @@
 ########################################################
 from __future__ import division,with_statement
 
-import sys,os
+import sys,os,platform
 import time
+import json
 import gc
 
 from operator import add
@@ -17,7 +18,7 @@ from lenstools.utils.mpi import MPIWhirlPool
 from lenstools import ConvergenceMap,OmegaMap,ShearMap
 from lenstools.catalog import Catalog,ShearCatalog
 
-from lenstools.simulations.raytracing import RayTracer,DensityPlane
+from lenstools.simulations.raytracing import RayTracer,RayTracerBatch,DensityPlane,PlaneCache,SharedPlaneStore
 from lenstools.pipeline.simulation import SimulationBatch
 from lenstools.pipeline.settings import MapSettings,TelescopicMapSettings,CatalogSettings
 
@@ -43,25 +44,286 @@ def _subdirectories(num_realizations,realizations_in_subdir):
 
 	return s
 
+#############################################################
+#########Ray tracing options shared between realizations#####
+#############################################################
+
+def _plane_cache(settings):
+
+	if getattr(settings,"plane_cache_size",0.0)>0:
+		logdriver.info("Lens planes will be cached in memory, with a budget of {0:.3f} GB".format(settings.plane_cache_size))
+		return PlaneCache(settings.plane_cache_size*u.Gbyte)
+	else:
+		return None
+
+def _shared_store(pool,settings):
+
+	if (pool is not None) and getattr(settings,"shared_planes",False):
+		if pool.is_master():
+			logdriver.info("Lens planes will be shared between the tasks on the same node")
+		return SharedPlaneStore(pool)
+	else:
+		return None
+
+def _chunk_size(settings):
+
+	if getattr(settings,"ray_chunk_size",0)>0:
+		return settings.ray_chunk_size
+	else:
+		return None
+
+def _prefetch(settings):
+	return max(getattr(settings,"prefetch_lenses",0),0)
+
+def _derivatives(settings):
+	return bool(getattr(settings,"derivative_planes",False))
+
+def _double_precision(settings):
+	return not(getattr(settings,"single_precision",False))
+
+#############################################################
+#########Distribute the realizations between MPI tasks#######
+#############################################################
+
+def _dynamic_scheduling(pool,settings):
+
+	if (pool is None) or not(getattr(settings,"dynamic_scheduling",False)):
+		return False
+
+	#A single MPI task has no workers to hand the realizations out to
+	if pool.size<1:
+		return False
+
+	#Shared lens planes are loaded collectively by the tasks on the same node, which must then trace the same number of realizations
+	if getattr(settings,"shared_planes",False):
+		if pool.is_master():
+			logdriver.warning("Dynamic scheduling is not compatible with shared lens planes, realizations will be assigned in fixed blocks")
+		return False
+
+	return True
+
+def _check_resume(pool,settings,resume):
+
+	#Shared lens planes need the same number of realizations on every task, which the realizations left over by a previous run do not guarantee
+	if resume and (pool is not None) and (pool.size>0) and getattr(settings,"shared_planes",False):
+		raise ValueError("Resuming a run (--resume) is not supported with shared lens planes (shared_planes = True), turn one of the two off!")
+
+def _batch_size(pool,settings):
+
+	batch_size = max(getattr(settings,"batch_realizations",1),1)
+	if batch_size==1:
+		return 1
+
+	#Batched realizations load their planes by themselves, and are traced without callbacks
+	if getattr(settings,"shared_planes",False) or getattr(settings,"tomographic_convergence",False):
+		if (pool is None) or (pool.is_master()):
+			logdriver.warning("Realizations cannot be batched with shared lens planes or tomographic convergence, they will be traced one at a time")
+		return 1
+
+	if (pool is None) or (pool.is_master()):
+		logdriver.info("Realizations will be traced in batches of {0} against a shared lens stack".format(batch_size))
+
+	return batch_size
+
+def _domain_decomposition(pool,settings):
+
+	if (pool is None) or not(getattr(settings,"domain_decomposition",False)):
+		return False
+
+	#Each task reads its own windows of the lens planes, tracing the whole lens system
+	if getattr(settings,"shared_planes",False) or getattr(settings,"derivative_planes",False) or getattr(settings,"tomographic_convergence",False):
+		if pool.is_master():
+			logdriver.warning("Domain decomposition is not compatible with shared lens planes, derivative planes or tomographic convergence, each map will be traced by a single task")
+		return False
+
+	if pool.is_master():
+		logdriver.info("Each map will be split in tiles of light rays between {0} tasks, realizations will be traced one at a time".format(pool.size+1))
+
+	return True
+
+def _domain_tile(pool,resolution):
+
+	#Near square grid of tiles, one for each task
+	num_tasks = pool.size + 1
+	grid_rows = max([ n for n in range(1,int(np.sqrt(num_tasks))+1) if not(num_tasks%n) ])
+	grid_cols = num_tasks // grid_rows
+	assert resolution>=grid_cols,"The map resolution is too low to be split between {0} tasks!".format(num_tasks)
+
+	row,col = divmod(pool.rank,grid_cols)
+	rows = np.array_split(np.arange(resolution),grid_rows)[row]
+	cols = np.array_split(np.arange(resolution),grid_cols)[col]
+
+	return slice(rows[0],rows[-1]+1),slice(cols[0],cols[-1]+1)
+
+def _run_realizations(pool,settings,realizations,process,syshandler,home,kind,resume=False,batch_size=None,collective=False):
+
+	manifest_filename = os.path.join(home,"manifest_{0}.txt".format(kind))
+
+	#Skip the realizations that a previous run already completed (decided on the master, so that all the tasks agree)
+	if resume:
+		
+		if (pool is None) or (pool.is_master()):
+			done = _completed_realizations(syshandler,manifest_filename,settings.seed)
+			missing = [ r for r in realizations if r not in done ]
+			logdriver.info("Resuming from {0}: {1} realizations already completed, {2} left".format(manifest_filename,len(realizations)-len(missing),len(missing)))
+			realizations = missing
+
+		if pool is not None:
+			realizations = pool.comm.bcast(realizations,root=0)
+
+	#If collective is True, all the tasks work together on each realization (whose outputs are written by the master)
+
+	#If batch_size is None, process generates a single realization, otherwise it takes a list of (at most batch_size) realizations and returns the outputs of each 
+	if batch_size is None:
+		batch_size = 1
+		process_batch = lambda batch_realizations:[ process(r) for r in batch_realizations ]
+	else:
+		process_batch = process
+
+	def batches(realizations):
+		return [ realizations[n:n+batch_size] for n in range(0,len(realizations),batch_size) ]
+
+	#Time each batch of realizations (the realizations in a batch share its time evenly), along with the task that processed it, and record the realizations in the manifest as soon as they are completed
+	def timed(batch_realizations):
+		start = time.time()
+		outputs = process_batch(batch_realizations)
+		seconds = (time.time()-start) / len(batch_realizations)
+		timings = list()
+		for r,realization_outputs in zip(batch_realizations,outputs):
+			timings.append((r,(0 if pool is None else pool.rank),platform.node(),seconds))
+			if not(collective) or pool.is_master():
+				_record_realization(syshandler,manifest_filename,timings[-1],settings.seed+r,realization_outputs)
+		return timings
+
+	#Progress log
+	completed = [0]
+	def progress(timings,num_realizations):
+		for timing in timings:
+			completed[0] += 1
+			logstderr.info("Progress: {0:.2f}%, realization {1} completed by task {2} in {3:.3f}s".format(100*completed[0]/num_realizations,timing[0]+1,timing[1],timing[3]))
+
+	if not(collective) and _dynamic_scheduling(pool,settings):
+
+		#The master hands out the realizations (in batches) to the other tasks on demand
+		if pool.is_master() and len(realizations):
+			logdriver.info("Realizations {0}-{1} will be handed out on demand to {2} tasks".format(realizations[0]+1,realizations[-1]+1,pool.size))
+		timings = pool.schedule(timed,batches(realizations),callback=lambda t:progress(t,len(realizations)))
+		if pool.is_master():
+			timings = reduce(add,timings,list())
+
+	else:
+
+		#Each task takes care of a fixed block of realizations (if pool is None or the tasks work together, all of them)
+		if (pool is not None) and not(collective):
+			if getattr(settings,"shared_planes",False):
+				assert len(realizations)%(pool.size+1)==0,"Shared lens planes need perfect load-balancing, the number of realizations must be a multiple of the number of MPI tasks!"
+			realizations = [ int(r) for r in np.array_split(realizations,pool.size+1)[pool.rank] ]
+
+		if len(realizations):
+			logdriver.debug("Task {0} will generate realizations from {1} to {2}".format(0 if pool is None else pool.rank,realizations[0]+1,realizations[-1]+1))
+
+		timings = list()
+		for batch_realizations in batches(realizations):
+			timings += timed(batch_realizations)
+			if (pool is None) or (pool.is_master()):
+				progress(timings[-len(batch_realizations):],len(realizations))
+
+		#Collect the timings on the master
+		if (pool is not None) and not(collective):
+			timings = pool.comm.gather(timings,root=0)
+			if pool.is_master():
+				timings = reduce(add,timings)
+
+	#Log peak memory usage of all the tasks
+	peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(pool)
+
+	if (pool is None) or (pool.is_master()):
+
+		logstderr.info("Peak memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
+		_timing_report(timings,syshandler,os.path.join(home,"timing_{0}.txt".format(kind)))
+
+def _timing_report(timings,syshandler,report_filename):
+
+	timings = sorted(timings)
+	if not len(timings):
+		return
+
+	#One line per realization
+	logdriver.info("Writing realization timing report to {0}".format(report_filename))
+	with syshandler.open(report_filename,"w") as fp:
+		fp.write("#realization,task,host,seconds\n")
+		for r,task,host,seconds in timings:
+			fp.write("{0},{1},{2},{3:.3f}\n".format(r+1,task,host,seconds))
+
+	#Summary: the load imbalance is the ratio between the busiest task time and the mean task time
+	seconds = np.array([ t[3] for t in timings ])
+	busy = dict()
+	for r,task,host,s in timings:
+		busy[task] = busy.get(task,0.0) + s
+	busy_time = np.array(list(busy.values()))
+
+	logdriver.info("Realization time: {0:.3f}s (mean), {1:.3f}s (min), {2:.3f}s (max) over {3} realizations".format(seconds.mean(),seconds.min(),seconds.max(),len(seconds)))
+	logdriver.info("Task busy time: {0:.3f}s (mean), {1:.3f}s (max) over {2} tasks, load imbalance {3:.3f}".format(busy_time.mean(),busy_time.max(),len(busy_time),busy_time.max()/busy_time.mean()))
+
+#############################################################
+#########Manifest of the completed realizations##############
+#############################################################
+
+def _record_realization(syshandler,manifest_filename,timing,seed,outputs):
+
+	#One JSON record per line, appended with a single write by the task that completed the realization
+	r,task,host,seconds = timing
+	record = dict(realization=r+1,seed=seed,outputs=outputs or list(),task=task,host=host,seconds=round(seconds,3))
+
+	with syshandler.open(manifest_filename,"a") as fp:
+		fp.write(json.dumps(record)+"\n")
+		fp.flush()
+
+def _completed_realizations(syshandler,manifest_filename,seed):
+
+	if not syshandler.exists(manifest_filename):
+		return set()
+
+	#The last record of each realization wins
+	records = dict()
+	with syshandler.open(manifest_filename,"r") as fp:
+		for line in fp:
+			try:
+				record = json.loads(line)
+				records[record["realization"]-1] = record
+			except (ValueError,KeyError):
+				logdriver.warning("Skipping malformed manifest record: {0}".format(line.strip()))
+
+	#A realization is complete if it was generated with the current seed and all its outputs are still there
+	completed = set()
+	for r,record in records.items():
+		if (record.get("seed")==seed+r) and all([ syshandler.exists(f) for f in record.get("outputs",list()) ]):
+			completed.add(r)
+
+	return completed
+
 #####################################################################################
 #######Callback to call during raytracing to save the convergence at every step######
 #####################################################################################
 
-def convergence_callback(jacobian,tracer,k,realization,angle,map_batch,settings):
+def convergence_callback(jacobian,tracer,k,realization,angle,map_batch,settings,outputs=None):
 	convMap = ConvergenceMap(data=1.0-0.5*(jacobian[0]+jacobian[3]),angle=angle)
 	savename = os.path.join(map_batch.storage_subdir,"WLconv_z{0:.2f}_{1:04d}r.{2}".format(tracer.redshift[k],realization+1,settings.format))
 	logdriver.debug("Saving convergence map to {0}".format(savename)) 
 	convMap.save(savename)
+	if outputs is not None:
+		outputs.append(savename)
 
 ################################################
 #######Single redshift ray tracing##############
 ################################################
 
-def singleRedshift(pool,batch,settings,batch_id):
+def singleRedshift(pool,batch,settings,batch_id,resume=False):
 
 	#Safety check
 	assert isinstance(pool,MPIWhirlPool) or (pool is None)
 	assert isinstance(batch,SimulationBatch)
+	_check_resume(pool,settings,resume)
 
 	parts = batch_id.split("|")
 
@@ -116,6 +378,7 @@ def singleRedshift(pool,batch,settings,batch_id):
 	#Read map angle,redshift and resolution from the settings
 	map_angle = settings.map_angle
 	source_redshift = settings.source_redshift
+	source_redshifts = sorted(getattr(settings,"source_redshifts",None) or [source_redshift])
 	resolution = settings.map_resolution
 
 	if len(parts)==2:
@@ -157,23 +420,13 @@ def singleRedshift(pool,batch,settings,batch_id):
 
 
 
-	#Decide which map realizations this MPI task will take care of (if pool is None, all of them)
+	#Realizations to generate (they are distributed between the MPI tasks by the scheduler)
 	try:
 		realization_offset = settings.first_realization - 1
 	except AttributeError:
 		realization_offset = 0
 
-	if pool is None:
-		first_map_realization = 0 + realization_offset
-		last_map_realization = map_realizations + realization_offset
-		realizations_per_task = map_realizations
-		logdriver.debug("Generating lensing map realizations from {0} to {1}".format(first_map_realization+1,last_map_realization))
-	else:
-		assert map_realizations%(pool.size+1)==0,"Perfect load-balancing enforced, map_realizations must be a multiple of the number of MPI tasks!"
-		realizations_per_task = map_realizations//(pool.size+1)
-		first_map_realization = realizations_per_task*pool.rank + realization_offset
-		last_map_realization = realizations_per_task*(pool.rank+1) + realization_offset
-		logdriver.debug("Task {0} will generate lensing map realizations from {1} to {2}".format(pool.rank,first_map_realization+1,last_map_realization))
+	realizations = list(range(realization_offset,map_realizations+realization_offset))
 
 	#Planes will be read from this path
 	plane_path = os.path.join("{0}","ic{1}","{2}")
@@ -208,14 +461,21 @@ def singleRedshift(pool,batch,settings,batch_id):
 	if (pool is None) or (pool.is_master()):
 		logstderr.info("Initial memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
 
-	#We need one of these for cycles for each map random realization
-	for rloc,r in enumerate(range(first_map_realization,last_map_realization)):
+	#Lens planes are read through this cache (or shared between the tasks on the same node), if enabled
+	plane_cache = _plane_cache(settings)
+	shared_store = _shared_store(pool,settings)
+
+	#Each map can be split between the tasks, which read only the windows of the lens planes that their light rays hit
+	domain_decomposition = _domain_decomposition(pool,settings)
+
+	#Lens system of one map random realization
+	def lens_system(r):
 
 		#Set random seed to generate the realizations
 		np.random.seed(settings.seed + r)
 
 		#Instantiate the RayTracer
-		tracer = RayTracer()
+		tracer = RayTracer(plane_cache=plane_cache,prefetch=_prefetch(settings),derivatives=_derivatives(settings),shared_store=shared_store,windowed=domain_decomposition,double_precision=_double_precision(settings))
 
 		#Force garbage collection
 		gc.collect()
@@ -286,88 +546,149 @@ def singleRedshift(pool,batch,settings,batch_id):
 		logdriver.info("Reordering completed in {0:.3f}s".format(now-last_timestamp))
 		last_timestamp = now
 
-		#Start a bucket of light rays from a regular grid of initial positions
-		b = np.linspace(0.0,map_angle.value,resolution)
-		xx,yy = np.meshgrid(b,b)
-		pos = np.array([xx,yy]) * map_angle.unit
-
-		if settings.tomographic_convergence:
+		return tracer
 
-			#Trace the ray deflections and save the convergence at every step
-			tracer.shoot(pos,z=source_redshift,kind="jacobians",callback=convergence_callback,realization=r,angle=map_angle,map_batch=map_batch,settings=settings)
+	#Compute and save the maps of one realization, for each source redshift
+	def save_maps(r,jacobians):
 
-		else:
+		last_timestamp = time.time()
 
-			#Trace the ray deflections
-			jacobian = tracer.shoot(pos,z=source_redshift,kind="jacobians")
+		#Files written for this realization (recorded in the manifest)
+		outputs = list()
 
-			now = time.time()
-			logdriver.info("Jacobian ray tracing for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
-			last_timestamp = now
+		#Compute and save the maps for each source redshift
+		for source_redshift,jacobian in zip(source_redshifts,jacobians):
 
 			#Compute shear,convergence and omega from the jacobians
 			if settings.convergence or settings.reduced_shear or settings.reduced_shear_convergence:
-		
+	
 				convMap = ConvergenceMap(data=1.0-0.5*(jacobian[0]+jacobian[3]),angle=map_angle,cosmology=map_batch.cosmology,redshift=source_redshift)
-				
+			
 				if settings.convergence:
 					savename = batch.syshandler.map(os.path.join(save_path,"WLconv_z{0:.2f}_{1:04d}r.{2}".format(source_redshift,r+1,settings.format)))
 					logdriver.info("Saving convergence map to {0}".format(savename)) 
 					convMap.save(savename)
+					outputs.append(savename)
 					logdriver.debug("Saved convergence map to {0}".format(savename)) 
 
 			##############################################################################################################################
-	
+
 			if settings.shear or settings.convergence_ks or settings.reduced_shear or settings.reduced_shear_convergence:
-		
+	
 				shearMap = ShearMap(data=np.array([0.5*(jacobian[3]-jacobian[0]),-0.5*(jacobian[1]+jacobian[2])]),angle=map_angle,cosmology=map_batch.cosmology,redshift=source_redshift)
 
 				if settings.shear:
 					savename = batch.syshandler.map(os.path.join(save_path,"WLshear_z{0:.2f}_{1:04d}r.{2}".format(source_redshift,r+1,settings.format)))
 					logdriver.info("Saving shear map to {0}".format(savename))
 					shearMap.save(savename)
+					outputs.append(savename)
 
 				if settings.convergence_ks:
 					convMap = shearMap.convergence() 
 					savename = batch.syshandler.map(os.path.join(save_path,"WLconv-ks_z{0:.2f}_{1:04d}r.{2}".format(source_redshift,r+1,settings.format)))
 					logdriver.info("Saving convergence (KS) map to {0}".format(savename))
 					convMap.save(savename)
+					outputs.append(savename)
 
 				if settings.reduced_shear or settings.reduced_shear_convergence:
 					for ng in (0,1):
 						shearMap.data[ng] /= (1. - convMap.data)
-					
+				
 					if settings.reduced_shear:
 						savename = batch.syshandler.map(os.path.join(save_path,"WLredshear_z{0:.2f}_{1:04d}r.{2}".format(source_redshift,r+1,settings.format)))
 						logdriver.info("Saving reduced shear map to {0}".format(savename))
 						shearMap.save(savename)
+						outputs.append(savename)
 
 					if settings.reduced_shear_convergence:
 						convMap = shearMap.convergence()
 						savename = batch.syshandler.map(os.path.join(save_path,"WLredconv_z{0:.2f}_{1:04d}r.{2}".format(source_redshift,r+1,settings.format)))
 						logdriver.info("Saving reduced shear corrected convergence map to {0}".format(savename))
 						convMap.save(savename)
+						outputs.append(savename)
 
 			##############################################################################################################################
-	
+
 			if settings.omega:
-		
+	
 				omegaMap = OmegaMap(data=-0.5*(jacobian[2]-jacobian[1]),angle=map_angle,cosmology=map_batch.cosmology,redshift=source_redshift)
 				savename = batch.syshandler.map(os.path.join(save_path,"WLomega_z{0:.2f}_{1:04d}r.{2}".format(source_redshift,r+1,settings.format)))
 				logdriver.info("Saving omega map to {0}".format(savename))
 				omegaMap.save(savename)
+				outputs.append(savename)
 
 		now = time.time()
 		
 		#Log peak memory usage to stdout
-		peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(pool)
 		logdriver.info("Weak lensing calculations for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
-		logdriver.info("Peak memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
+		logdriver.info("Peak memory usage: {0:.3f} (task)".format(peakMemory()))
+
+		return outputs
+
+	#Trace a batch of map random realizations (against a shared lens stack if there is more than one)
+	def process(batch_realizations):
+
+		#Start a bucket of light rays from a regular grid of initial positions
+		b = np.linspace(0.0,map_angle.value,resolution)
+		xx,yy = np.meshgrid(b,b)
+		pos = np.array([xx,yy]) * map_angle.unit
+
+		if settings.tomographic_convergence:
+
+			#Trace the ray deflections and save the convergence at every step
+			r, = batch_realizations
+			outputs = list()
+			lens_system(r).shoot(pos,z=source_redshifts[-1],kind="jacobians",chunk_size=_chunk_size(settings),callback=convergence_callback,realization=r,angle=map_angle,map_batch=map_batch,settings=settings,outputs=outputs)
+			return [outputs]
+
+		#Each task traces its own tile of the light rays (with the same random lens system), and the master puts the jacobians together
+		if domain_decomposition:
+
+			r, = batch_realizations
+			rows,cols = _domain_tile(pool,resolution)
+			
+			last_timestamp = time.time()
+			jacobians = lens_system(r).shoot(pos[:,rows,cols],z=source_redshifts,kind="jacobians",chunk_size=_chunk_size(settings))
+			logdriver.info("Jacobian ray tracing for tile ({0}-{1},{2}-{3}) of realization {4} completed in {5:.3f}s".format(rows.start,rows.stop-1,cols.start,cols.stop-1,r+1,time.time()-last_timestamp))
+
+			tiles = pool.comm.gather((rows,cols,jacobians),root=0)
+			if not(pool.is_master()):
+				return [list()]
+
+			full_jacobians = [ np.empty((4,resolution,resolution)) for source_redshift in source_redshifts ]
+			for rows,cols,tile_jacobians in tiles:
+				for n,jacobian in enumerate(tile_jacobians):
+					full_jacobians[n][:,rows,cols] = jacobian
+
+			return [save_maps(r,full_jacobians)]
+
+		#The random rolls of each realization in a batch continue its own random sequence
+		if len(batch_realizations)==1:
+			tracer = lens_system(batch_realizations[0])
+		else:
+			tracer = RayTracerBatch()
+			for r in batch_realizations:
+				tracer.add(lens_system(r))
+
+		last_timestamp = time.time()
+
+		#Trace the ray deflections (once for all the source redshifts, and together for all the realizations in the batch)
+		if len(batch_realizations)==1:
+			jacobians = [tracer.shoot(pos,z=source_redshifts,kind="jacobians",chunk_size=_chunk_size(settings))]
+		else:
+			jacobians = tracer.shoot(pos,z=source_redshifts,kind="jacobians",chunk_size=_chunk_size(settings))
+
+		logdriver.info("Jacobian ray tracing for realizations {0} completed in {1:.3f}s".format(",".join([ str(r+1) for r in batch_realizations ]),time.time()-last_timestamp))
+
+		return [ save_maps(r,jacobian) for r,jacobian in zip(batch_realizations,jacobians) ]
+
+	#Distribute the realizations between the MPI tasks, record them in the manifest and write a timing report
+	_run_realizations(pool,settings,realizations,process,batch.syshandler,map_batch.home_subdir,"maps",resume,batch_size=(1 if domain_decomposition else _batch_size(pool,settings)),collective=domain_decomposition)
+
+	#Free the node shared memory that holds the last lens planes
+	if shared_store is not None:
+		shared_store.release()
 
-		#Log progress and peak memory usage to stderr
-		if (pool is None) or (pool.is_master()):
-			logstderr.info("Progress: {0:.2f}%, peak memory usage: {1:.3f} (task), {2[0]:.3f} (all {2[1]} tasks)".format(100*(rloc+1.)/realizations_per_task,peak_memory_task,peak_memory_all))
-	
 	#Safety sync barrier
 	if pool is not None:
 		pool.comm.Barrier()
@@ -390,11 +711,12 @@ def save_intermediate(add_on,tracer,k,ctype,map_batch=None,map_angle=None,realiz
 
 ########################################################################################################################
 
-def losIntegrate(pool,batch,settings,batch_id):
+def losIntegrate(pool,batch,settings,batch_id,resume=False):
 
 	#Safety check
 	assert isinstance(pool,MPIWhirlPool) or (pool is None)
 	assert isinstance(batch,SimulationBatch)
+	_check_resume(pool,settings,resume)
 
 	parts = batch_id.split("|")
 
@@ -497,23 +819,13 @@ def losIntegrate(pool,batch,settings,batch_id):
 	if (pool is None) or (pool.is_master()):
 		logdriver.info("Line of sight integration type: {0}".format(settings.integration_type))
 
-	#Decide which map realizations this MPI task will take care of (if pool is None, all of them)
+	#Realizations to generate (they are distributed between the MPI tasks by the scheduler)
 	try:
 		realization_offset = settings.first_realization - 1
 	except AttributeError:
 		realization_offset = 0
 
-	if pool is None:
-		first_map_realization = 0 + realization_offset
-		last_map_realization = map_realizations + realization_offset
-		realizations_per_task = map_realizations
-		logdriver.debug("Generating lensing map realizations from {0} to {1}".format(first_map_realization+1,last_map_realization))
-	else:
-		assert map_realizations%(pool.size+1)==0,"Perfect load-balancing enforced, map_realizations must be a multiple of the number of MPI tasks!"
-		realizations_per_task = map_realizations//(pool.size+1)
-		first_map_realization = realizations_per_task*pool.rank + realization_offset
-		last_map_realization = realizations_per_task*(pool.rank+1) + realization_offset
-		logdriver.debug("Task {0} will generate lensing map realizations from {1} to {2}".format(pool.rank,first_map_realization+1,last_map_realization))
+	realizations = list(range(realization_offset,map_realizations+realization_offset))
 
 	#Planes will be read from this path
 	plane_path = os.path.join("{0}","ic{1}","{2}")
@@ -548,17 +860,24 @@ def losIntegrate(pool,batch,settings,batch_id):
 	if (pool is None) or (pool.is_master()):
 		logstderr.info("Initial memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
 
-	#We need one of these for cycles for each map random realization
-	for rloc,r in enumerate(range(first_map_realization,last_map_realization)):
+	#Lens planes are read through this cache (or shared between the tasks on the same node), if enabled
+	plane_cache = _plane_cache(settings)
+	shared_store = _shared_store(pool,settings)
+
+	#Generate one map random realization
+	def process(r):
 
 		#Set random seed to generate the realizations
 		np.random.seed(settings.seed + r)
 
+		#Files written for this realization (recorded in the manifest)
+		outputs = list()
+
 		#Instantiate the RayTracer
 		if settings.lens_type=="PotentialPlane":
-			tracer = RayTracer()
+			tracer = RayTracer(plane_cache=plane_cache,prefetch=_prefetch(settings),derivatives=_derivatives(settings),shared_store=shared_store,double_precision=_double_precision(settings))
 		elif settings.lens_type=="DensityPlane":
-			tracer = RayTracer(lens_type=DensityPlane)
+			tracer = RayTracer(lens_type=DensityPlane,plane_cache=plane_cache,prefetch=_prefetch(settings),shared_store=shared_store,double_precision=_double_precision(settings))
 		else:
 			raise ValueError("Lens type {0} not recognized!".format(settings.lens_type))
 
@@ -679,6 +998,10 @@ def losIntegrate(pool,batch,settings,batch_id):
 			image = tracer.omegaPostBorn2(pos,z=source_redshift,save_intermediate=False)
 			img_type = OmegaMap
 
+		elif settings.integration_type=="combined":
+			terms = tracer.convergenceLOS(pos,z=source_redshift,terms=("born","ll","gp"),jacobians=True,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1)
+			img_type = ConvergenceMap
+
 		else:
 			raise NotImplementedError
 
@@ -686,27 +1009,43 @@ def losIntegrate(pool,batch,settings,batch_id):
 		logdriver.info("Line of sight integration for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
 		last_timestamp = now
 
-		#Save the image
-		savename = batch.syshandler.map(os.path.join(save_path,"{0}_z{1:.2f}_{2:04d}r".format(settings.integration_type,source_redshift,r+1)))
-		if settings.transpose_up_to>=0:
-			savename += "_t{0}".format(settings.transpose_up_to)
-		savename += ".{0}".format(settings.format)
+		#The combined integration produces one map for each term
+		if settings.integration_type=="combined":
+			images = [("born",terms["born"]),("postBorn2-ll",terms["ll"]),("postBorn2-gp",terms["gp"]),("full",1.0-0.5*(terms["jacobians"][0]+terms["jacobians"][3]))]
+		else:
+			images = [(settings.integration_type,image)]
+
+		#Save the images
+		for image_type,image in images:
 
-		logdriver.info("Saving {0} map to {1}".format(settings.integration_type,savename))
-		img_type(data=image,angle=map_angle,cosmology=map_batch.cosmology,redshift=source_redshift).save(savename)
-		logdriver.debug("Saving {0} map to {1}".format(settings.integration_type,savename)) 
+			savename = batch.syshandler.map(os.path.join(save_path,"{0}_z{1:.2f}_{2:04d}r".format(image_type,source_redshift,r+1)))
+			if settings.transpose_up_to>=0:
+				savename += "_t{0}".format(settings.transpose_up_to)
+			savename += ".{0}".format(settings.format)
+
+			logdriver.info("Saving {0} map to {1}".format(image_type,savename))
+			img_type(data=image,angle=map_angle,cosmology=map_batch.cosmology,redshift=source_redshift).save(savename)
+			outputs.append(savename)
 
 		now = time.time()
 		
 		#Log peak memory usage to stdout
-		peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(pool)
 		logdriver.info("Weak lensing calculations for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
-		logdriver.info("Peak memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
+		logdriver.info("Peak memory usage: {0:.3f} (task)".format(peakMemory()))
+
+		return outputs
+
+	#Distribute the realizations between the MPI tasks, record them in the manifest and write a timing report
+	kind = settings.integration_type
+	if settings.transpose_up_to>=0:
+		kind += "_t{0}".format(settings.transpose_up_to)
+
+	_run_realizations(pool,settings,realizations,process,batch.syshandler,map_batch.home_subdir,kind,resume)
+
+	#Free the node shared memory that holds the last lens planes
+	if shared_store is not None:
+		shared_store.release()
 
-		#Log progress and peak memory usage to stderr
-		if (pool is None) or (pool.is_master()):
-			logstderr.info("Progress: {0:.2f}%, peak memory usage: {1:.3f} (task), {2[0]:.3f} (all {2[1]} tasks)".format(100*(rloc+1.)/realizations_per_task,peak_memory_task,peak_memory_all))
-	
 	#Safety sync barrier
 	if pool is not None:
 		pool.comm.Barrier()
@@ -722,11 +1061,12 @@ def losIntegrate(pool,batch,settings,batch_id):
 #######Galaxy catalog ray tracing##############
 ###############################################
 
-def simulatedCatalog(pool,batch,settings,batch_id):
+def simulatedCatalog(pool,batch,settings,batch_id,resume=False):
 
 	#Safety check
 	assert isinstance(pool,MPIWhirlPool) or (pool is None)
 	assert isinstance(batch,SimulationBatch)
+	_check_resume(pool,settings,resume)
 	assert isinstance(settings,CatalogSettings)
 
 	#Separate the id into cosmo_id and geometry_id
@@ -837,23 +1177,13 @@ def simulatedCatalog(pool,batch,settings,batch_id):
 	if pool is not None:
 		pool.comm.Barrier() 
 
-	#Decide which map realizations this MPI task will take care of (if pool is None, all of them)
+	#Realizations to generate (they are distributed between the MPI tasks by the scheduler)
 	try:
 		realization_offset = settings.first_realization - 1
 	except AttributeError:
 		realization_offset = 0
 
-	if pool is None:
-		first_realization = 0 + realization_offset
-		last_realization = catalog_realizations + realization_offset
-		realizations_per_task = catalog_realizations
-		logdriver.debug("Generating lensing catalog realizations from {0} to {1}".format(first_realization+1,last_realization))
-	else:
-		assert catalog_realizations%(pool.size+1)==0,"Perfect load-balancing enforced, catalog_realizations must be a multiple of the number of MPI tasks!"
-		realizations_per_task = catalog_realizations//(pool.size+1)
-		first_realization = realizations_per_task*pool.rank + realization_offset
-		last_realization = realizations_per_task*(pool.rank+1) + realization_offset
-		logdriver.debug("Task {0} will generate lensing catalog realizations from {1} to {2}".format(pool.rank,first_realization+1,last_realization))
+	realizations = list(range(realization_offset,catalog_realizations+realization_offset))
 
 
 	#Planes will be read from this path
@@ -873,14 +1203,21 @@ def simulatedCatalog(pool,batch,settings,batch_id):
 	if (pool is None) or (pool.is_master()):
 		logstderr.info("Initial memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
 
-	#We need one of these for cycles for each map random realization
-	for rloc,r in enumerate(range(first_realization,last_realization)):
+	#Lens planes are read through this cache (or shared between the tasks on the same node), if enabled
+	plane_cache = _plane_cache(settings)
+	shared_store = _shared_store(pool,settings)
+
+	#Generate one catalog random realization
+	def process(r):
 
 		#Set random seed to generate the realizations
 		np.random.seed(settings.seed + r)
 
+		#Files written for this realization (recorded in the manifest)
+		outputs = list()
+
 		#Instantiate the RayTracer
-		tracer = RayTracer()
+		tracer = RayTracer(plane_cache=plane_cache,prefetch=_prefetch(settings),derivatives=_derivatives(settings),shared_store=shared_store,double_precision=_double_precision(settings))
 
 		#Force garbage collection
 		gc.collect()
@@ -947,7 +1284,7 @@ def simulatedCatalog(pool,batch,settings,batch_id):
 		last_timestamp = now
 
 		#Trace the ray deflections through the lenses
-		jacobian = tracer.shoot(initial_positions,z=galaxy_redshift,kind="jacobians")
+		jacobian = tracer.shoot(initial_positions,z=galaxy_redshift,kind="jacobians",chunk_size=_chunk_size(settings))
 
 		now = time.time()
 		logdriver.info("Jacobian ray tracing for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
@@ -983,18 +1320,22 @@ def simulatedCatalog(pool,batch,settings,batch_id):
 				logdriver.info("Saving simulated shear catalog to {0}".format(shear_catalog_savename))
 			
 			shear_catalog[galaxies_before:galaxies_before+galaxies_in_catalog[n]].write(shear_catalog_savename,overwrite=True)
+			outputs.append(shear_catalog_savename)
 
 		now = time.time()
-
+		
 		#Log peak memory usage to stdout
-		peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(pool)
 		logdriver.info("Weak lensing calculations for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
-		logdriver.info("Peak memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
+		logdriver.info("Peak memory usage: {0:.3f} (task)".format(peakMemory()))
 
-		#Log progress and peak memory usage to stderr
-		if (pool is None) or (pool.is_master()):
-			logstderr.info("Progress: {0:.2f}%, peak memory usage: {1:.3f} (task), {2[0]:.3f} (all {2[1]} tasks)".format(100*(rloc+1.)/realizations_per_task,peak_memory_task,peak_memory_all))
+		return outputs
+
+	#Distribute the realizations between the MPI tasks, record them in the manifest and write a timing report
+	_run_realizations(pool,settings,realizations,process,batch.syshandler,catalog.home_subdir,"catalogs",resume)
 
+	#Free the node shared memory that holds the last lens planes
+	if shared_store is not None:
+		shared_store.release()
 
 	#Safety sync barrier
 	if pool is not None:
@@ -273,6 +273,10 @@ class Gadget2Snapshot(NbodySnapshot):
 	def int2root(cls,name,n):
 		return name + "_{0:03d}".format(n)
 
+	@classmethod
+	def partFilename(cls,root,n):
+		return root + ".{0}".format(n)
+
 	############################################################################################
 
 	def getHeader(self):
@@ -495,6 +499,80 @@ class Gadget2Snapshot(NbodySnapshot):
 
 	############################################################################################
 
+	def memmap(self,block="positions"):
+
+		"""
+		Memory maps a particle block of the snapshot file, without reading it in: the data is paged in from disk only when (and where) the returned array is accessed. The units are the raw ones of the file
+
+		:param block: particle block to map
+		:type block: str. ("positions","velocities" or "ids")
+
+		:returns: read only numpy memmap, of shape (N,3) and type float32 for positions and velocities, of shape (N,) and type int32 for the IDs
+
+		"""
+
+		assert block in ["positions","velocities","ids"],"The particle block must be one of positions, velocities or ids!"
+
+		numPart = self._header["num_particles_file"]
+
+		#Calculate the offset from the beginning of the file: 4 bytes (endianness) + 256 bytes (header) + 8 bytes (void)
+		offset = 4 + 256 + 8
+
+		#Skip the particle positions (and velocities) followed by other 8 void bytes
+		if block in ["velocities","ids"]:
+			offset += 4 * 3 * numPart + 8
+
+		if block=="ids":
+			offset += 4 * 3 * numPart + 8
+
+		#Map the block
+		if block=="ids":
+			return np.memmap(self.fp.name,dtype=np.int32,mode="r",offset=offset,shape=(numPart,))
+		else:
+			return np.memmap(self.fp.name,dtype=np.float32,mode="r",offset=offset,shape=(numPart,3))
+
+	def iterPositions(self,chunk_size=1048576,first=None,last=None):
+
+		"""
+		Iterates over the particles positions in chunks of bounded size, reading them from a memory map of the position block: only one chunk at a time is held in memory
+
+		:param chunk_size: maximum number of particles in each chunk
+		:type chunk_size: int.
+
+		:param first: first particle in the file to be read, if None 0 is assumed
+		:type first: int. or None
+
+		:param last: last particle in the file to be read, if None the total number of particles is assumed
+		:type last: int. or None
+
+		:returns: generator of numpy arrays with the particle positions, in file order
+
+		"""
+
+		assert chunk_size>0,"The chunk size must be positive!"
+
+		#Particles do not have structure
+		self.weights = None
+		self.virial_radius = None
+		self.concentration = None
+
+		return self._iterPositionChunks(self.memmap("positions")[first:last],chunk_size)
+
+	def _iterPositionChunks(self,positions,chunk_size):
+
+		for n in range(0,len(positions),chunk_size):
+			
+			#Copy the chunk out of the memory map and scale units
+			chunk = np.array(positions[n:n+chunk_size])
+			try:
+				chunk = (chunk * self.kpc_over_h).to(self.Mpc_over_h)
+			except AttributeError:
+				chunk = chunk * u.kpc
+
+			yield chunk
+
+	############################################################################################
+
 	def write(self,filename,files=1):
 
 		"""
@@ -25,8 +25,17 @@ def readFITSHeader(filename):
 	with fits.open(filename) as fp:
 		return fp[0].header
 
+#Contiguous slices that cover size pixels starting from first, with periodic boundary conditions
+def _periodicSlices(first,size,period):
+
+	first = first % period
+	if first+size<=period:
+		return [slice(first,first+size)]
+	else:
+		return [slice(first,period),slice(0,first+size-period)]
+
 #Read
-def readFITS(cls,filename,init_cosmology=True):
+def readFITS(cls,filename,init_cosmology=True,window=None,double_precision=True):
 
 	#Read the FITS file with the plane information (if there are two HDU's the second one is the imaginary part)
 	if fitsio is not None:
@@ -94,20 +103,46 @@ def readFITS(cls,filename,init_cosmology=True):
 	except (ValueError,KeyError):
 		unit = u.rad**2
 
+	#The pixels are held in double or single precision
+	if double_precision:
+		real_type,complex_type = np.float64,np.complex128
+	else:
+		real_type,complex_type = np.float32,np.complex64
+
 	#Instantiate the new PotentialPlane instance
-	if fitsio is not None:
+	if window is not None:
+
+		#Read only a square window of size x size pixels starting at pixel (first_row,first_col), wrapped periodically: the pixel size is preserved
+		if len(hdu)!=1:
+			raise ValueError("A window can be read only from a plane saved in real space!")
+
+		first_row,first_col,size = window
+		num_pixels = header["NAXIS1"]
+		assert 0<size<=num_pixels,"The window must fit in the plane!"
+		angle = angle * size / num_pixels
+
+		#Only the pixels in the window are read from disk
+		if fitsio is not None:
+			image = hdu[0]
+		else:
+			image = hdu[0].section
+
+		data = np.concatenate([ np.concatenate([ image[rows,cols] for cols in _periodicSlices(first_col,size,num_pixels) ],axis=1) for rows in _periodicSlices(first_row,size,num_pixels) ],axis=0)
+		new_plane = cls(data.astype(real_type),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
+
+	elif fitsio is not None:
 
 		if len(hdu)==1:
-			new_plane = cls(hdu[0].read(),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
+			new_plane = cls(hdu[0].read().astype(real_type),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
 		else:
-			new_plane = cls(hdu[1].read() + 1.0j*hdu[1].read(),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
+			new_plane = cls((hdu[0].read() + 1.0j*hdu[1].read()).astype(complex_type),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
 
 	else:
 			
 		if len(hdu)==1:
-			new_plane = cls(hdu[0].data.astype(np.float64),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
+			new_plane = cls(hdu[0].data.astype(real_type),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
 		else:
-			new_plane = cls((hdu[0].data + 1.0j*hdu[1].data).astype(np.complex128),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
+			new_plane = cls((hdu[0].data + 1.0j*hdu[1].data).astype(complex_type),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
 
 	#Close the FITS file and return
 	hdu.close()
@@ -165,4 +200,25 @@ def saveFITS(self,filename,double_precision):
 
 	hdulist.writeto(filename,overwrite=True)
 
-########################################################################################################################################
\ No newline at end of file
+########################################################################################################################################
+#Derivative planes (deflection angles and shear matrix components) of a lens plane, stacked in a single cube
+def saveDerivativesFITS(derivatives,filename,key,scheme,double_precision):
+
+	if double_precision:
+		hdu = fits.PrimaryHDU(derivatives)
+	else:
+		hdu = fits.PrimaryHDU(derivatives.astype(np.float32))
+
+	hdu.header["KEY"] = (key,"Checksum of the plane the derivatives were computed from")
+	hdu.header["SCHEME"] = (scheme,"Derivatives computed in real (finite differences) or fourier space")
+	hdu.header["CONTENT"] = ("ax,ay,sxx,syy,sxy","Deflection angles (rad) and shear matrix components")
+
+	fits.HDUList([hdu]).writeto(filename,overwrite=True)
+
+def readDerivativesFITS(filename,double_precision=True):
+
+	with fits.open(filename) as hdu:
+		header = hdu[0].header
+		return np.ascontiguousarray(hdu[0].data,dtype=(np.float64 if double_precision else np.float32)),header["KEY"],header["SCHEME"]
+
+########################################################################################################################################
@@ -4,6 +4,7 @@ from abc import ABCMeta,abstractproperty,abstractmethod
 
 from operator import mul
 from functools import reduce
+from itertools import chain
 
 import sys,os
 
@@ -15,7 +16,7 @@ from .. import extern as ext
 import numpy as np
 
 #astropy stuff, invaluable here
-from astropy.units import Mbyte,kpc,Mpc,cm,km,g,s,hour,day,deg,arcmin,rad,Msun,quantity,def_unit
+from astropy.units import byte,Mbyte,kpc,Mpc,cm,km,g,s,hour,day,deg,arcmin,rad,Msun,quantity,def_unit
 from astropy.constants import c
 from astropy.cosmology import w0waCDM,z_at_value
 
@@ -26,6 +27,9 @@ fftengine = NUMPYFFTPack()
 #KD-Tree
 from scipy.spatial import cKDTree as KDTree
 
+#Mass assignment schemes of the gridding kernels
+assignment_schemes = {"NGP":0,"CIC":1,"TSC":2}
+
 #Plotting engine
 try:
 	import matplotlib.pyplot as plt
@@ -99,6 +103,13 @@ class NbodySnapshot(object):
 	#Check that header has all required keys#
 	_header_keys = ['redshift','scale_factor','masses','num_particles_file','num_particles_total','box_size','num_files','Om0','Ode0','w0','wa','h']
 
+	#Particle limits handled by this instance (set by setLimits when reading from a file)#
+	_first = None
+	_last = None
+
+	#Particle ranges (file name,first,last) read by this instance, if it was opened with openDistributed#
+	_parts = None
+
 	def _check_header(self):
 
 		for key in self._header_keys:
@@ -205,6 +216,89 @@ class NbodySnapshot(object):
 		
 		return cls(fp,pool,header_kwargs=header_kwargs)
 
+	@classmethod
+	def partFilename(cls,root,n):
+
+		"""
+		Builds the file name of the n-th file of a snapshot that is split in multiple files; by default snapshots are contained in a single file
+
+		:param root: root file name of the snapshot
+		:type root: str.
+
+		:param n: file number
+		:type n: int.
+
+		:rtype: str.
+
+		"""
+
+		return root
+
+	@classmethod
+	def openDistributed(cls,filename,pool=None,header_kwargs=dict()):
+
+		"""
+		Opens a snapshot, possibly split in multiple files, distributing its particles between the MPI tasks: the particles of all the files are divided in contiguous ranges of equal size, one for each task, regardless of the number of files. Each task reads (one file, or chunk, at a time) only the particles in its range when gridding, and the density grids (or plane stacks) are reduced across the tasks once
+
+		:param filename: root file name of the snapshot: if no file with this name exists, the snapshot is assumed to be split in the files named by partFilename
+		:type filename: str.
+
+		:param pool: MPI pool that distributes the particles (if None, a single task reads all of them)
+		:type pool: MPIWhirlPool instance
+
+		:param header_kwargs: keyword arguments to pass to the getHeader method
+		:type header_kwargs: dict.
+
+		:returns: snapshot instance, opened on the first file that the particle range of this task spans
+
+		"""
+
+		#The master reads the headers of all the files and broadcasts the number of particles they contain
+		if (pool is None) or (pool.is_master()):
+
+			if os.path.exists(filename):
+				files = [filename]
+			else:
+				with cls.open(cls.partFilename(filename,0),header_kwargs=header_kwargs) as snap:
+					files = [ cls.partFilename(filename,n) for n in range(snap.header["num_files"]) ]
+
+			num_particles = list()
+			for f in files:
+				with cls.open(f,header_kwargs=header_kwargs) as snap:
+					num_particles.append(int(snap.header["num_particles_file"]))
+
+		else:
+			files,num_particles = None,None
+
+		if pool is not None:
+			files,num_particles = pool.comm.bcast((files,num_particles),root=0)
+
+		#Contiguous particle range of this task
+		if pool is not None:
+			num_tasks,rank = pool.size+1,pool.rank
+		else:
+			num_tasks,rank = 1,0
+
+		num_particles_total = sum(num_particles)
+		assert num_particles_total>=num_tasks,"There must be at least one particle per task!"
+		first,last = (num_particles_total*rank)//num_tasks,(num_particles_total*(rank+1))//num_tasks
+
+		#Intersect it with the particles in each file
+		parts = list()
+		offset = 0
+		for f,n in zip(files,num_particles):
+			if (offset<last) and (offset+n>first):
+				parts.append((f,max(first-offset,0),min(last-offset,n)))
+			offset += n
+
+		#The files are opened one at a time when the particles are read
+		snap = cls.open(parts[0][0],header_kwargs=header_kwargs)
+		snap.pool = pool
+		snap._parts = parts
+		snap._header_kwargs = header_kwargs
+
+		return snap
+
 	@property
 	def header(self):
 
@@ -400,8 +494,83 @@ class NbodySnapshot(object):
 
 		self.velocities = velocities
 
+	############################################################################################################################################################################
 
-	def massDensity(self,resolution=0.5*Mpc,smooth=None,left_corner=None,save=False,density_placeholder=None):
+	def iterPositions(self,chunk_size=1048576,first=None,last=None):
+
+		"""
+		Iterates over the particles positions in chunks of bounded size, so that the whole position array never needs to be held in memory; the default implementation reads each chunk with getPositions, subclasses can override it with something faster
+
+		:param chunk_size: maximum number of particles in each chunk
+		:type chunk_size: int.
+
+		:param first: first particle in the file to be read, if None 0 is assumed
+		:type first: int. or None
+
+		:param last: last particle in the file to be read, if None the total number of particles is assumed
+		:type last: int. or None
+
+		:returns: generator of numpy arrays with the particle positions, in file order
+
+		"""
+
+		assert chunk_size>0,"The chunk size must be positive!"
+
+		if first is None:
+			first = 0
+
+		if last is None:
+			last = self._header["num_particles_file"]
+
+		for n in range(first,last,chunk_size):
+			yield self.getPositions(first=n,last=min(n+chunk_size,last),save=False)
+
+	def _positionChunks(self,chunk_size=None,first=None,last=None):
+
+		#Particle ranges assigned by openDistributed: read each file, all at once or chunk by chunk
+		if (self._parts is not None) and not(hasattr(self,"positions")):
+
+			n = 0
+			for filename,part_first,part_last in self._parts:
+				with self.__class__.open(filename,header_kwargs=self._header_kwargs) as part:
+
+					if chunk_size is None:
+						chunks = [part.getPositions(first=part_first,last=part_last,save=False)]
+					else:
+						chunks = part.iterPositions(chunk_size,first=part_first,last=part_last)
+
+					for positions in chunks:
+						
+						assert (part.weights is None) and (part.virial_radius is None),"Only particles without structure can be distributed between tasks!"
+						self.weights,self.virial_radius,self.concentration = None,None,None
+						
+						yield positions,slice(n,n+len(positions))
+						n += len(positions)
+
+		#Positions already in memory, or read all at once: a single chunk
+		elif hasattr(self,"positions"):
+			yield self.positions,slice(None)
+		elif chunk_size is None:
+			yield self.getPositions(first=first,last=last,save=False),slice(None)
+		
+		#Read chunk_size particles at a time, along with the slice of the per-particle arrays (weights) they correspond to
+		else:
+			
+			n = 0
+			for positions in self.iterPositions(chunk_size,first=first,last=last):
+				yield positions,slice(n,n+len(positions))
+				n += len(positions)
+
+	def _minPosition(self,positions,chunk_size=None,first=None,last=None):
+
+		#If the positions are read in chunks (or from multiple files), the minimum needs a pass over all of them
+		if hasattr(self,"positions") or ((chunk_size is None) and (self._parts is None)):
+			return positions.min(axis=0)
+
+		return np.array([ p.min(axis=0).to(positions.unit).value for p,particles in self._positionChunks(chunk_size,first=first,last=last) ]).min(axis=0) * positions.unit
+
+
+	def massDensity(self,resolution=0.5*Mpc,smooth=None,left_corner=None,save=False,density_placeholder=None,assignment="NGP",num_threads=1,chunk_size=None):
 
 		"""
 		Uses a C backend gridding function to compute the matter mass density fluctutation for the current snapshot: the density is evaluated using a nearest neighbor search
@@ -418,24 +587,32 @@ class NbodySnapshot(object):
 		:param save: if True saves the density histogram and resolution as instance attributes
 		:type save: bool.
 
-		:param density placeholder: if not None, it is used as a fixed memory chunk for MPI communications of the density
+		:param density placeholder: ignored, kept for backwards compatibility (the density is reduced in place across the MPI tasks, without fixed memory chunks for the communications)
 		:type density_placeholder: array
 
+		:param assignment: mass assignment scheme, "NGP" (nearest grid point), "CIC" (cloud in cell) or "TSC" (triangular shaped cloud)
+		:type assignment: str.
+
+		:param num_threads: number of threads used for the mass assignment (None uses the OpenMP default); the result does not depend on it
+		:type num_threads: int. or None
+
+		:param chunk_size: if not None and the positions are not already in memory, read and grid chunk_size particles at a time (see iterPositions), so that the memory usage does not depend on the number of particles
+		:type chunk_size: int. or None
+
 		:returns: tuple(numpy 3D array with the (unsmoothed) matter density fluctuation on a grid,bin resolution along the axes)  
 
 		"""
 
 		#Sanity checks
 		assert type(resolution) in [np.int,quantity.Quantity]
+		assert assignment in assignment_schemes,"Mass assignment scheme must be one of {0}".format(list(assignment_schemes.keys()))
 		
 		if type(resolution)==quantity.Quantity:	
 			assert resolution.unit.physical_type=="length"
 
-		#Check if positions are already available, otherwise retrieve them
-		if hasattr(self,"positions"):
-			positions = self.positions
-		else:
-			positions = self.getPositions(save=False)
+		#Check if positions are already available, otherwise retrieve them (all at once or chunk by chunk)
+		chunks = self._positionChunks(chunk_size)
+		positions,particles = next(chunks)
 
 		assert hasattr(self,"weights")
 		assert hasattr(self,"virial_radius")
@@ -443,7 +620,7 @@ class NbodySnapshot(object):
 
 		#Bin extremes (we start from the leftmost position up to the box size)
 		if left_corner is None:
-			xmin,ymin,zmin = positions.min(axis=0)
+			xmin,ymin,zmin = self._minPosition(positions,chunk_size)
 		else:
 			xmin,ymin,zmin = left_corner
 
@@ -463,36 +640,34 @@ class NbodySnapshot(object):
 			zi = np.linspace(zmin.to(positions.unit).value,(zmin + self._header["box_size"]).to(positions.unit).value,resolution+1)
 
 
-		#Compute the number count histogram
-		assert positions.value.dtype==np.float32
-
 		#Weights
 		if self.weights is not None:
 			weights = (self.weights * self._header["num_particles_total"] / ((len(xi) - 1) * (len(yi) - 1) * (len(zi) - 1))).astype(np.float32)
 		else:
 			weights = None
 
-		if self.virial_radius is not None:
-			rv = self.virial_radius.to(positions.unit).value
-		else:
-			rv = None
+		#Compute the number count histogram, one chunk at a time (particles with a virial radius, which are always held in memory, are spread with their NFW profile)
+		density = None
+		for positions,particles in chain([(positions,particles)],chunks):
 
-		density = ext._nbody.grid3d(positions.value,(xi,yi,zi),weights,rv,self.concentration) * (len(xi)-1) * (len(yi)-1) * (len(zi)-1) / self._header["num_particles_total"]
+			assert positions.value.dtype==np.float32
+			chunk_weights = weights[particles] if (weights is not None) else None
 
-		#Accumulate from the other processors
-		if self.pool is not None:
+			if self.virial_radius is not None:
+				chunk_density = ext._nbody.grid3d(positions.value,(xi,yi,zi),chunk_weights,self.virial_radius.to(positions.unit).value,self.concentration)
+			else:
+				chunk_density = ext._nbody.grid3d_assign(positions.value,(xi,yi,zi),chunk_weights,assignment_schemes[assignment],num_threads or 0)
 
-			if density_placeholder is not None:
+			if density is None:
+				density = chunk_density
+			else:
+				density += chunk_density
 
-				density_placeholder[:] = density
-				self.pool.comm.Barrier()
-				self.pool.accumulate()
+		density *= (len(xi)-1) * (len(yi)-1) * (len(zi)-1) / self._header["num_particles_total"]
 
-			else:
-			
-				self.pool.openWindow(density)
-				self.pool.accumulate()
-				self.pool.closeWindow()
+		#Accumulate from the other processors
+		if self.pool is not None:
+			self.pool.reduce(density)
 
 		#Recompute resolution to make sure it represents the bin size correctly
 		bin_resolution = ((xi[1:]-xi[:-1]).mean() * positions.unit,(yi[1:]-yi[:-1]).mean() * positions.unit,(zi[1:]-zi[:-1]).mean() * positions.unit)
@@ -519,7 +694,7 @@ class NbodySnapshot(object):
 
 	###################################################################################################################################################
 
-	def cutPlaneGaussianGrid(self,normal=2,thickness=0.5*Mpc,center=7.0*Mpc,plane_resolution=4096,left_corner=None,thickness_resolution=1,smooth=1,kind="density",**kwargs):
+	def cutPlaneGaussianGrid(self,normal=2,thickness=0.5*Mpc,center=7.0*Mpc,plane_resolution=4096,left_corner=None,thickness_resolution=1,smooth=1,kind="density",assignment="NGP",num_threads=1,chunk_size=None,**kwargs):
 
 		"""
 		Cuts a density (or lensing potential) plane out of the snapshot by computing the particle number density on a slab and performing Gaussian smoothing; the plane coordinates are cartesian comoving
@@ -548,6 +723,15 @@ class NbodySnapshot(object):
 		:param kind: decide if computing a density or gravitational potential plane (this is computed solving the poisson equation)
 		:type kind: str. ("density" or "potential")
 
+		:param assignment: mass assignment scheme (particles with a virial radius are always spread with their NFW profile), "NGP" (nearest grid point), "CIC" (cloud in cell) or "TSC" (triangular shaped cloud)
+		:type assignment: str.
+
+		:param num_threads: number of threads used for the mass assignment (None uses the OpenMP default); the result does not depend on it
+		:type num_threads: int. or None
+
+		:param chunk_size: if not None and the positions are not already in memory, read and grid chunk_size particles at a time (see iterPositions), so that the memory usage does not depend on the number of particles
+		:type chunk_size: int. or None
+
 		:param kwargs: accepted keyword are: 'density_placeholder', a pre-allocated numpy array, with a RMA window opened on it; this facilitates the communication with different processors by using a single RMA window during the execution. 'l_squared' a pre-computed meshgrid of squared multipoles used for smoothing
 		:type kwargs: dict.
 
@@ -560,22 +744,18 @@ class NbodySnapshot(object):
 		assert kind in ["density","potential"],"Specify density or potential plane!"
 		assert type(thickness)==quantity.Quantity and thickness.unit.physical_type=="length"
 		assert type(center)==quantity.Quantity and center.unit.physical_type=="length"
+		assert assignment in assignment_schemes,"Mass assignment scheme must be one of {0}".format(list(assignment_schemes.keys()))
 
 		#Redshift must be bigger than 0 or we cannot proceed
 		if ("redshift" in self.header) and (self.header["redshift"]<=0.0):
 			raise ValueError("The snapshot redshift must be >0 for the lensing density to be defined!")
 
-		#Cosmological normalization factor
-		cosmo_normalization = 1.5 * self.header["H0"]**2 * self.header["Om0"] / c**2
-
 		#Direction of the plane
 		plane_directions = [ d for d in range(3) if d!=normal ]
 
-		#Get the particle positions if not available get
-		if hasattr(self,"positions"):
-			positions = self.positions
-		else:
-			positions = self.getPositions(first=self._first,last=self._last,save=False)
+		#Get the particle positions if not available get (all at once or chunk by chunk)
+		chunks = self._positionChunks(chunk_size,first=self._first,last=self._last)
+		positions,particles = next(chunks)
 
 		assert hasattr(self,"weights")
 		assert hasattr(self,"virial_radius")
@@ -583,7 +763,7 @@ class NbodySnapshot(object):
 
 		#Lower left corner of the plane
 		if left_corner is None:
-			left_corner = positions.min(axis=0)
+			left_corner = self._minPosition(positions,chunk_size,first=self._first,last=self._last)
 
 		#Create a list that holds the bins
 		binning = [None,None,None]
@@ -636,25 +816,6 @@ class NbodySnapshot(object):
 		#Recompute resolution to make sure it represents the bin size correctly
 		bin_resolution = [ (binning[n][1:]-binning[n][:-1]).mean() * positions.unit for n in (0,1,2) ]
 
-		############################################################################################################
-		#################################Longitudinal normalization factor##########################################
-		#If the comoving distance is not provided in the header, the position along the normal direction is assumed#
-		############################################################################################################
-
-		if "comoving_distance" in self.header:
-			
-			#Constant time snapshots
-			density_normalization = bin_resolution[normal] * self.header["comoving_distance"] / self.header["scale_factor"]
-		
-		else:
-
-			#Light cone projection: use the lens center as the common comoving distance
-			zlens = z_at_value(self.cosmology.comoving_distance,center)
-			density_normalization = bin_resolution[normal] * center * (1.+zlens)
-
-		#Now use gridding to compute the density along the slab
-		assert positions.value.dtype==np.float32
-
 		#Log
 		if self.pool is not None:
 			logplanes.debug("Task {0} began gridding procedure".format(self.pool.rank))
@@ -665,7 +826,22 @@ class NbodySnapshot(object):
 		#Gridding#
 		##########
 
-		density = ext._nbody.grid3d_nfw(positions.value,tuple(binning),weights,rv,self.concentration)
+		#Now use gridding to compute the density along the slab, one chunk at a time
+		density = None
+		for positions,particles in chain([(positions,particles)],chunks):
+
+			assert positions.value.dtype==np.float32
+			chunk_weights = weights[particles] if (weights is not None) else None
+			
+			if rv is not None:
+				chunk_density = ext._nbody.grid3d_nfw(positions.value,tuple(binning),chunk_weights,rv,self.concentration)
+			else:
+				chunk_density = ext._nbody.grid3d_assign(positions.value,tuple(binning),chunk_weights,assignment_schemes[assignment],num_threads or 0)
+
+			if density is None:
+				density = chunk_density
+			else:
+				density += chunk_density
 
 		###################################################################################################################################
 
@@ -718,9 +894,7 @@ class NbodySnapshot(object):
 				#Log
 				logplanes.debug("Task {0} collected {1:.3e} particles".format(self.pool.rank,NumPartTask))
 				
-				self.pool.openWindow(density_projected)
-				self.pool.accumulate()
-				self.pool.closeWindow()
+				self.pool.reduce(density_projected)
 
 		#Safety barrier sync
 		if self.pool is not None:
@@ -738,6 +912,41 @@ class NbodySnapshot(object):
 		if (self.pool is not None) and not(self.pool.is_master()):
 			return (None,)*3
 
+		#Normalize the density and solve the Poisson equation
+		lensing_potential,bin_resolution = self._solvePlane(density_projected,bin_resolution,normal,center,smooth,kind,kwargs.get("l_squared"))
+
+		#Return
+		return lensing_potential,bin_resolution,NumPartTotal
+
+
+	def _solvePlane(self,density_projected,bin_resolution,normal,center,smooth,kind,l_squared=None):
+
+		"""
+		Normalizes a plane of projected particle counts to the lensing density and, if prompted, smooths it or solves the Poisson equation for the lensing potential (the density plane is normalized in place)
+
+		:returns: tuple(numpy 2D array with the density (or lensing potential),bin resolution along the plane directions)
+
+		"""
+
+		#Cosmological normalization factor
+		cosmo_normalization = 1.5 * self.header["H0"]**2 * self.header["Om0"] / c**2
+
+		############################################################################################################
+		#################################Longitudinal normalization factor##########################################
+		#If the comoving distance is not provided in the header, the position along the normal direction is assumed#
+		############################################################################################################
+
+		if "comoving_distance" in self.header:
+			
+			#Constant time snapshots
+			density_normalization = bin_resolution[normal] * self.header["comoving_distance"] / self.header["scale_factor"]
+		
+		else:
+
+			#Light cone projection: use the lens center as the common comoving distance
+			zlens = z_at_value(self.cosmology.comoving_distance,center)
+			density_normalization = bin_resolution[normal] * center * (1.+zlens)
+
 		#Normalize the density to the density fluctuation
 		density_projected /= self._header["num_particles_total"]
 		density_projected *= (self._header["box_size"]**3 / (bin_resolution[0]*bin_resolution[1]*bin_resolution[2])).decompose().value
@@ -746,17 +955,13 @@ class NbodySnapshot(object):
 		######################################Ready to solve poisson equation via FFTs###################################################
 		#################################################################################################################################
 
-		bin_resolution.pop(normal)
+		bin_resolution = [ bin_resolution[d] for d in range(3) if d!=normal ]
 
 		#If smoothing is enabled or potential calculations are needed, we need to FFT the density field
 		if (smooth is not None) or kind=="potential":
 
 			#Compute the multipoles
-			if "l_squared" in kwargs.keys():
-
-				l_squared = kwargs["l_squared"]
-			
-			else:
+			if l_squared is None:
 				lx,ly = np.meshgrid(fftengine.fftfreq(density_projected.shape[0]),fftengine.rfftfreq(density_projected.shape[1]),indexing="ij")
 				l_squared = lx**2 + ly**2
 				
@@ -811,9 +1016,212 @@ class NbodySnapshot(object):
 		else:
 			lensing_potential = lensing_potential.value
 
-		#Return
-		return lensing_potential,bin_resolution,NumPartTotal
+		return lensing_potential,bin_resolution
+
+	def cutPlanesGaussianGrid(self,normals=(0,1,2),centers=(7.0*Mpc,),thickness=0.5*Mpc,plane_resolution=4096,left_corner=None,thickness_resolution=1,smooth=1,kind="density",assignment="NGP",num_threads=1,chunk_size=None,memory_budget=1024*Mbyte,**kwargs):
+
+		"""
+		Cuts a stack of density (or lensing potential) planes out of the snapshot, one for each (center,normal) pair: the particles are binned on all the slabs that fit in the memory budget in a single pass over their positions, then each plane is smoothed (or turned into a lensing potential solving the Poisson equation) as in cutPlaneGaussianGrid, one at a time
+
+		:param normals: directions of the normals to the planes (0 is x, 1 is y and 2 is z)
+		:type normals: list of int. (0,1,2)
+
+		:param centers: locations of the planes along the normal directions
+		:type centers: list of floats with units
+
+		:param thickness: thickness of the planes
+		:type thickness: float. with units
+
+		:param plane_resolution: plane resolution (perpendicular to the normal)
+		:type plane_resolution: float. with units (or int.)
+
+		:param left_corner: specify the position of the lower left corner of the box; if None, the minimum of the (x,y,z) of the contained particles is assumed
+		:type left_corner: tuple of quantities or None
+
+		:param thickness_resolution: plane resolution (along the normal)
+		:type thickness_resolution: float. with units (or int.)
+
+		:param smooth: if not None, performs a smoothing of the density (or potential) with a gaussian kernel of scale "smooth x the pixel resolution"
+		:type smooth: int. or None
+
+		:param kind: decide if computing a density or gravitational potential plane (this is computed solving the poisson equation)
+		:type kind: str. ("density" or "potential")
+
+		:param assignment: mass assignment scheme (NGP bins all the slabs with a single kernel call, the other schemes and particles with a virial radius are deposited on one slab at a time), "NGP" (nearest grid point), "CIC" (cloud in cell) or "TSC" (triangular shaped cloud)
+		:type assignment: str.
+
+		:param num_threads: number of threads used for the mass assignment (None uses the OpenMP default); the result does not depend on it
+		:type num_threads: int. or None
+
+		:param chunk_size: if not None and the positions are not already in memory, read and grid chunk_size particles at a time (see iterPositions), so that the memory usage does not depend on the number of particles
+		:type chunk_size: int. or None
+
+		:param memory_budget: memory available to the stack of slabs on each task: if the slabs of all the centers do not fit, the centers are processed in groups, with one pass over the particles (and one reduction across tasks) for each group; if None, the whole stack is gridded at once
+		:type memory_budget: quantity (e.g. 2*u.Gbyte) or None
+
+		:param kwargs: accepted keyword is 'l_squared', a pre-computed meshgrid of squared multipoles used for smoothing
+		:type kwargs: dict.
+
+		:returns: generator of tuple(numpy 2D array with the density (or lensing potential),bin resolution along the axes, number of particles on the plane), one for each (center,normal) pair, in this order and with the normal varying fastest; the tasks that are not the MPI master get (None,None,None)
+
+		"""
+
+		#Sanity checks
+		assert kind in ["density","potential"],"Specify density or potential plane!"
+		assert type(thickness)==quantity.Quantity and thickness.unit.physical_type=="length"
+		
+		for normal in normals:
+			assert normal in range(3),"There are only 3 dimensions!"
+		
+		for center in centers:
+			assert type(center)==quantity.Quantity and center.unit.physical_type=="length"
+
+		#Redshift must be bigger than 0 or we cannot proceed
+		if ("redshift" in self.header) and (self.header["redshift"]<=0.0):
+			raise ValueError("The snapshot redshift must be >0 for the lensing density to be defined!")
+
+		#Get the particle positions if not available get (all at once or chunk by chunk)
+		chunks = self._positionChunks(chunk_size,first=self._first,last=self._last)
+		positions,particles = next(chunks)
+
+		assert hasattr(self,"weights")
+		assert hasattr(self,"virial_radius")
+		assert hasattr(self,"concentration")
+
+		#Lower left corner of the planes
+		if left_corner is None:
+			left_corner = self._minPosition(positions,chunk_size,first=self._first,last=self._last)
+
+		#Binning in the plane directions (the same along all the axes)
+		assert type(plane_resolution) in [np.int,quantity.Quantity]
+		
+		if type(plane_resolution)==quantity.Quantity:
+			assert plane_resolution.unit.physical_type=="length"
+			plane_resolution = plane_resolution.to(positions.unit)
+			binning = tuple([ np.arange(left_corner[d].to(positions.unit).value,(left_corner[d] + self._header["box_size"]).to(positions.unit).value,plane_resolution.value) for d in range(3) ])
+		else:
+			binning = tuple([ np.linspace(left_corner[d].to(positions.unit).value,(left_corner[d] + self._header["box_size"]).to(positions.unit).value,plane_resolution+1) for d in range(3) ])
+
+		assert len(set([ len(b) for b in binning ]))==1,"The planes must have the same number of pixels for all the normals!"
+
+		#Slabs along the normal direction: each one is bounded by the first and last bin edges along the normal, as in cutPlaneGaussianGrid
+		assert type(thickness_resolution) in [np.int,quantity.Quantity]
+		thickness = thickness.to(positions.unit)
+		slab_edges,slab_low,slab_high,normal_resolution = list(),list(),list(),list()
+		
+		for center in centers:
+
+			center = center.to(positions.unit)
+			
+			if type(thickness_resolution)==quantity.Quantity:
+				assert thickness_resolution.unit.physical_type=="length"
+				edges = np.arange((center - thickness/2).value,(center + thickness/2).value,thickness_resolution.to(positions.unit).value)
+			else:
+				edges = np.linspace((center - thickness/2).value,(center + thickness/2).value,thickness_resolution+1)
+
+			slab_edges.append(edges)
+			slab_low.append(edges[0])
+			slab_high.append(edges[0] + (len(edges)-1)*(edges[1]-edges[0]))
+			normal_resolution.append((edges[1:]-edges[:-1]).mean() * positions.unit)
+
+		#Weights
+		if self.weights is not None:
+			weights = self.weights.astype(np.float32)
+		else:
+			weights = None
+
+		#Virial radius
+		if self.virial_radius is not None:
+			assert weights is not None,"Particles have virial radiuses, you should specify their weight!"
+			rv = self.virial_radius.to(positions.unit).value
+		else:
+			rv = None
+
+		#Group the centers so that the slabs of each group fit in the memory budget (at least one center at a time)
+		stack_nbytes = len(normals) * (len(binning[0])-1)**2 * np.dtype(np.float32).itemsize
+		if memory_budget is None:
+			group_size = len(centers)
+		else:
+			group_size = int(min(max(memory_budget.to(byte).value//stack_nbytes,1),len(centers)))
+
+		groups = [ range(first,min(first+group_size,len(centers))) for first in range(0,len(centers),group_size) ]
+		plane_bin_resolution = [ (binning[d][1:]-binning[d][:-1]).mean() * positions.unit for d in range(3) ]
+
+		#Log
+		if self.pool is not None:
+			logplanes.debug("Task {0} began gridding procedure on {1} slabs in {2} groups".format(self.pool.rank,len(centers)*len(normals),len(groups)))
+		else:
+			logplanes.debug("Began gridding procedure on {0} slabs in {1} groups".format(len(centers)*len(normals),len(groups)))
+
+		for group_number,group in enumerate(groups):
+
+			#The first group continues the pass over the particles started above, the others need a new one
+			if group_number==0:
+				group_chunks = chain([(positions,particles)],chunks)
+			else:
+				group_chunks = self._positionChunks(chunk_size,first=self._first,last=self._last)
+
+			#Grid all the slabs of the group in a single pass over the particles, one chunk at a time: the group stack is reduced across tasks only once
+			planes = None
+			for positions,particles in group_chunks:
+
+				assert positions.value.dtype==np.float32
+				chunk_weights = weights[particles] if (weights is not None) else None
+
+				if (rv is None) and (assignment=="NGP"):
+					chunk_planes = ext._nbody.grid_slabs(positions.value,binning,np.array(normals,dtype=np.int32),np.array(slab_low)[group],np.array(slab_high)[group],chunk_weights,num_threads or 0)
+				
+				else:
+
+					#NFW profiles and CIC/TSC clouds are deposited on one slab at a time, as in cutPlaneGaussianGrid (the mass that spreads outside of the slab is not counted)
+					chunk_planes = np.zeros((len(normals),len(group),len(binning[0])-1,len(binning[0])-1),dtype=np.float32)
+					
+					for k,edges in enumerate([ slab_edges[center] for center in group ]):
+						for n,normal in enumerate(normals):
+
+							slab_binning = list(binning)
+							slab_binning[normal] = edges
+							slab_binning = tuple(slab_binning)
+
+							if rv is not None:
+								slab_weights = (chunk_weights * self._header["num_particles_total"] / reduce(mul,[ len(b)-1 for b in slab_binning ])).astype(np.float32)
+								chunk_planes[n,k] = ext._nbody.grid3d_nfw(positions.value,slab_binning,slab_weights,rv,self.concentration).sum(normal)
+							else:
+								chunk_planes[n,k] = ext._nbody.grid3d_assign(positions.value,slab_binning,chunk_weights,assignment_schemes[assignment],num_threads or 0).sum(normal)
+
+				if planes is None:
+					planes = chunk_planes
+				else:
+					planes += chunk_planes
+
+			if (self.pool is None) or (self.pool.is_master()):
+				logstderr.debug("Done with gridding procedure on group {0} of {1}: peak memory usage {2:.3f} (task)".format(group_number+1,len(groups),peakMemory()))
+
+			#Accumulate the planes from the other processors
+			if self.pool is not None:
+				
+				self.pool.reduce(planes)
+				
+				self.pool.comm.Barrier()
+
+			#Normalize (and solve the Poisson equation) one plane at a time
+			for k,center in enumerate(group):
+				for n,normal in enumerate(normals):
+
+					#If this task is not the master, there is nothing to do
+					if (self.pool is not None) and not(self.pool.is_master()):
+						yield (None,)*3
+						continue
+
+					bin_resolution = list(plane_bin_resolution)
+					bin_resolution[normal] = normal_resolution[center]
+					NumPartTotal = planes[n,k].sum()
+
+					lensing_potential,bin_resolution = self._solvePlane(planes[n,k],bin_resolution,normal,centers[center].to(positions.unit),smooth,kind,kwargs.get("l_squared"))
+					yield lensing_potential,bin_resolution,NumPartTotal
 
+			#Release the group stack before gridding the next group
+			planes = None
 
 	############################################################################################################################################################################
 
@@ -966,9 +1374,7 @@ class NbodySnapshot(object):
 		#Accumulate the density from the other processors
 		if self.pool is not None:
 			
-			self.pool.openWindow(density)
-			self.pool.accumulate()
-			self.pool.closeWindow()
+			self.pool.reduce(density)
 
 		#Integrate the density to find the total number of particles
 		NumPartTotal = (density.sum() * bin_resolution[0] * bin_resolution[1] * positions.unit**-2).decompose().value
@@ -1165,9 +1571,7 @@ class NbodySnapshot(object):
 		#Accumulate the density from the other processors
 		if self.pool is not None:
 			
-			self.pool.openWindow(density)
-			self.pool.accumulate()
-			self.pool.closeWindow()
+			self.pool.reduce(density)
 
 
 		#Compute the total number of particles on the lens plane
@@ -1291,7 +1695,7 @@ class NbodySnapshot(object):
 		:param return_num_modes: if True returns the mode counting for each k bin as the last element in the return tuple
 		:type return_num_modes: bool.
 
-		:param density placeholder: if not None, it is used as a fixed memory chunk for MPI communications in the density calculations
+		:param density placeholder: ignored, kept for backwards compatibility (see massDensity)
 		:type density_placeholder: array
 
 		:returns: tuple(k_values(bin centers),power spectrum at the specified k_values)
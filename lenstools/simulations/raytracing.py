@@ -1,9 +1,20 @@
 from ..image.convergence import Spin0,ConvergenceMap,OmegaMap
 from ..image.shear import Spin1,Spin2,ShearMap
 
+import os
 import sys
 import time
 import gc
+import copy
+import hashlib
+import threading
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+from collections import OrderedDict
 
 from .logs import logplanes,logray,logstderr,peakMemory
 
@@ -19,15 +30,118 @@ try:
 except ImportError:
 	matplotlib = None
 
+from ..extern import _topology
+
 #FFT engine
 from ..utils.fft import NUMPYFFTPack
 fftengine = NUMPYFFTPack()
 
-from astropy.units import km,s,Mpc,rad,deg,dimensionless_unscaled,quantity
+#FFT frequency meshgrids (lx,ly), cached for each plane size
+_lmesh_cache = dict()
+
+def _fourierMesh(num_pixels):
+
+	if num_pixels not in _lmesh_cache:
+		lmesh = np.array(np.meshgrid(fftengine.rfftfreq(num_pixels),fftengine.fftfreq(num_pixels)))
+		lmesh.flags.writeable = False
+		_lmesh_cache[num_pixels] = lmesh
+
+	return _lmesh_cache[num_pixels]
 
-from .io import readFITSHeader,readFITS,saveFITS
+from astropy.units import km,s,Mpc,rad,deg,dimensionless_unscaled,quantity,byte
+
+from .io import readFITSHeader,readFITS,saveFITS,readDerivativesFITS,saveDerivativesFITS
 from .camb import TransferFunction
 
+#Plain array of radians (always a copy), from an angle quantity or an array that is already in radians
+def _radians(angle,dtype=np.float64):
+
+	if isinstance(angle,quantity.Quantity):
+		return np.array(angle.to(rad).value,dtype=dtype)
+	else:
+		return np.array(angle,dtype=dtype)
+
+#Locate points in the quadrilateral cells of a distorted regular grid (grid has shape (2,rows,columns), points has shape (2,num_points)): the cells are registered in a spatial hash of their bounding boxes (about one cell per bucket), then the bilinear map of each candidate cell is inverted with a few Newton iterations. Returns the cell index (row*(columns-1)+column), the coordinates (u,v) of the points in their cell and a mask of the points that were located
+def _locateInGrid(grid,points,newton_steps=8,tolerance=1.0e-6):
+
+	rows,columns = grid.shape[1:]
+	num_points = points.shape[1]
+
+	#Cell vertices (a is the lower left corner, b lower right, c upper right, d upper left)
+	a = grid[:,:-1,:-1].reshape((2,-1))
+	b = grid[:,:-1,1:].reshape((2,-1))
+	c = grid[:,1:,1:].reshape((2,-1))
+	d = grid[:,1:,:-1].reshape((2,-1))
+
+	#Bounding boxes of the cells, spatial hash buckets
+	low = np.minimum(np.minimum(a,b),np.minimum(c,d))
+	high = np.maximum(np.maximum(a,b),np.maximum(c,d))
+	origin = low.min(axis=1)
+	num_buckets = np.array([columns-1,rows-1])
+	bucket_size = (high.max(axis=1) - origin) / num_buckets
+
+	def bucket(x,axis):
+		return np.clip(((x - origin[axis]) / bucket_size[axis]).astype(np.int64),0,num_buckets[axis]-1)
+
+	#Register each cell in all the buckets its bounding box overlaps
+	bucket_x,bucket_y = bucket(low[0],0),bucket(low[1],1)
+	span_x = bucket(high[0],0) - bucket_x + 1
+	span = span_x * (bucket(high[1],1) - bucket_y + 1)
+	offset = np.arange(span.sum()) - np.repeat(np.cumsum(span)-span,span)
+	span_x = np.repeat(span_x,span)
+	keys = (np.repeat(bucket_y,span) + offset//span_x)*num_buckets[0] + np.repeat(bucket_x,span) + offset%span_x
+	order = np.argsort(keys,kind="mergesort")
+	bucket_cells = np.repeat(np.arange(len(span)),span)[order]
+	bucket_start = np.searchsorted(keys[order],np.arange(num_buckets[0]*num_buckets[1]+1))
+
+	#Candidate (point,cell) pairs: all the cells registered in the bucket of each point
+	point_keys = bucket(points[1],1)*num_buckets[0] + bucket(points[0],0)
+	first = bucket_start[point_keys]
+	num_candidates = bucket_start[point_keys+1] - first
+	pair_point = np.repeat(np.arange(num_points),num_candidates)
+	pair_cell = bucket_cells[np.repeat(first,num_candidates) + np.arange(num_candidates.sum()) - np.repeat(np.cumsum(num_candidates)-num_candidates,num_candidates)]
+
+	#Invert the bilinear map a + u*e + v*f + u*v*g = p with Newton iterations, starting from the cell center
+	p = points[:,pair_point]
+	pa = a[:,pair_cell]
+	e = b[:,pair_cell] - pa
+	f = d[:,pair_cell] - pa
+	g = c[:,pair_cell] - b[:,pair_cell] - f
+	u = np.ones(len(pair_point))*0.5
+	v = np.ones(len(pair_point))*0.5
+
+	with np.errstate(divide="ignore",invalid="ignore"):
+		
+		for step in range(newton_steps):
+			
+			rx,ry = pa + u*e + v*f + u*v*g - p
+			ju_x,ju_y = e + v*g
+			jv_x,jv_y = f + u*g
+			det = ju_x*jv_y - jv_x*ju_y
+			u -= (jv_y*rx - jv_x*ry) / det
+			v -= (ju_x*ry - ju_y*rx) / det
+
+		#The point is in the cell if the Newton iterations converged to (u,v) in the unit square
+		residual = np.abs(pa + u*e + v*f + u*v*g - p).sum(0)
+		scale = np.abs(e).sum(0) + np.abs(f).sum(0)
+		inside = (u>=-tolerance) & (u<=1.0+tolerance) & (v>=-tolerance) & (v<=1.0+tolerance) & (residual<=tolerance*scale)
+
+	#Keep the first cell that contains each point
+	located_points,first_pair = np.unique(pair_point[inside],return_index=True)
+	pairs = np.where(inside)[0][first_pair]
+
+	cell = np.zeros(num_points,dtype=np.int64)
+	cell_u = np.zeros(num_points)
+	cell_v = np.zeros(num_points)
+	located = np.zeros(num_points,dtype=np.bool_)
+
+	cell[located_points] = pair_cell[pairs]
+	cell_u[located_points] = np.clip(u[pairs],0.0,1.0)
+	cell_v[located_points] = np.clip(v[pairs],0.0,1.0)
+	located[located_points] = True
+
+	return cell,cell_u,cell_v,located
+
 #Enable garbage collection if not active already
 if not gc.isenabled():
 	gc.enable()
@@ -61,11 +175,17 @@ class Plane(Spin0):
 
 		if data.dtype in [np.float,np.float32]:
 			self.space = "real"
-		elif data.dtype==np.complex:
+		elif data.dtype in [np.complex,np.complex64]:
 			self.space = "fourier"
 		else:
 			raise TypeError("data type not supported!")
 
+		#Pixel offsets (di,dj) of a lazy roll: the plane represents np.roll(np.roll(data,di,axis=0),dj,axis=1)
+		self._roll_offset = (0,0)
+
+		#Precomputed derivative planes (deflection angles and shear matrix) of the unrolled pixels, if attached, with shape (N,N,5)
+		self._derivatives = None
+
 	@staticmethod
 	def readHeader(filename,format=None):
 
@@ -147,6 +267,9 @@ class Plane(Spin0):
 			else:
 				raise IOError("File format not recognized from extension '{0}', please specify it manually".format(extension))
 
+		#Lazy roll offsets need to be applied to the pixels before saving
+		self._applyRoll()
+
 		if format=="fits":
 			saveFITS(self,filename=filename,double_precision=double_precision)
 		else:
@@ -154,7 +277,7 @@ class Plane(Spin0):
 
 
 	@classmethod
-	def load(cls,filename,format=None,init_cosmology=True):
+	def load(cls,filename,format=None,init_cosmology=True,window=None,double_precision=True):
 
 		"""
 		Loads the Plane from an external file, of which the format can be specified (only fits implemented so far)
@@ -168,6 +291,12 @@ class Plane(Spin0):
 		:param init_cosmology: if True, instantiates the cosmology attribute of the PotentialPlane
 		:type init_cosmology: bool.
 
+		:param window: if not None, only the square window of pixels (first_row,first_col,size) is read, with periodic boundary conditions; the loaded plane has the same pixel size, and an angle that is size pixels wide (real space planes only)
+		:type window: tuple.
+
+		:param double_precision: if False, the pixels are held in single precision (float32 or complex64)
+		:type double_precision: bool.
+
 		:returns: PotentialPlane instance that wraps the data contained in the file
 
 		"""
@@ -182,12 +311,12 @@ class Plane(Spin0):
 
 
 		if format=="fits":
-			return readFITS(cls,filename=filename,init_cosmology=init_cosmology)
+			return readFITS(cls,filename=filename,init_cosmology=init_cosmology,window=window,double_precision=double_precision)
 		else:
 			raise ValueError("Format {0} not implemented yet!!".format(format))
 
 
-	def randomRoll(self,seed=None,lmesh=None):
+	def randomRoll(self,seed=None,lmesh=None,lazy=False):
 
 		"""
 		Randomly shifts the plane along its axes, enforcing periodic boundary conditions
@@ -198,6 +327,9 @@ class Plane(Spin0):
 		:param lmesh: the FFT frequency meshgrid (lx,ly) necessary for the calculations in fourier space; if None, a new one is computed from scratch (must have the appropriate dimensions)
 		:type lmesh: array
 
+		:param lazy: if True, the pixels are not moved: the roll is recorded as a pixel offset that getValues, gradient, hessian and the lensing derivatives apply when indexing (the same random numbers are drawn as in the non lazy case). Other Spin0 methods see the unrolled pixels
+		:type lazy: bool.
+
 		"""
 
 		now = time.time()
@@ -206,7 +338,21 @@ class Plane(Spin0):
 		if seed is not None:
 			np.random.seed(seed)
 
-		if self.space=="real":
+		if lazy:
+
+			#Record the pixel offsets only
+			if self.space=="real":
+				di = np.random.randint(0,self.data.shape[0])
+				dj = np.random.randint(0,self.data.shape[1])
+			elif self.space=="fourier":
+				dj,di = -np.random.randint(0,self.data.shape[0],size=2)
+			else:
+				raise ValueError("space must be either real or fourier!")
+
+			N = self.data.shape[0]
+			self._roll_offset = (int(self._roll_offset[0]+di)%N,int(self._roll_offset[1]+dj)%N)
+
+		elif self.space=="real":
 
 			#Roll in real space
 			self.data = np.roll(np.roll(self.data,np.random.randint(0,self.data.shape[0]),axis=0),np.random.randint(0,self.data.shape[1]),axis=1)	
@@ -215,7 +361,7 @@ class Plane(Spin0):
 
 			#Rolling in Fourier space is just multiplying by phases
 			if lmesh is None:
-				l = np.array(np.meshgrid(fftengine.rfftfreq(self.data.shape[0]),fftengine.fftfreq(self.data.shape[0])))
+				l = _fourierMesh(self.data.shape[0])
 			else:
 				l = lmesh
 
@@ -225,7 +371,10 @@ class Plane(Spin0):
 			last_timestamp = now 
 
 			random_shift = np.random.randint(0,self.data.shape[0],size=2)
-			self.data *= np.exp(2.0j*np.pi*np.tensordot(random_shift,l,axes=(0,0)))
+			if self.data.flags.writeable:
+				self.data *= np.exp(2.0j*np.pi*np.tensordot(random_shift,l,axes=(0,0)))
+			else:
+				self.data = self.data * np.exp(2.0j*np.pi*np.tensordot(random_shift,l,axes=(0,0)))
 
 			#Timestamp
 			now = time.time()
@@ -237,6 +386,45 @@ class Plane(Spin0):
 			raise ValueError("space must be either real or fourier!")
 
 
+	def _applyRoll(self):
+
+		#Move the pixels according to the lazy roll offsets, if any
+		if self._roll_offset==(0,0):
+			return
+
+		if self.space=="real":
+			self.data = np.roll(np.roll(self.data,self._roll_offset[0],axis=0),self._roll_offset[1],axis=1)
+		else:
+			l = _fourierMesh(self.data.shape[0])
+			self.data = self.data * np.exp(-2.0j*np.pi*(self._roll_offset[1]*l[0] + self._roll_offset[0]*l[1]))
+
+		self._roll_offset = (0,0)
+		self._derivatives = None
+
+	def _rollOutput(self,values):
+
+		#Apply the lazy roll offsets to full plane outputs (shape (...,N,N)) computed from the unrolled pixels
+		if self._roll_offset==(0,0):
+			return values
+
+		return np.roll(np.roll(values,self._roll_offset[0],axis=-2),self._roll_offset[1],axis=-1)
+
+	def _realType(self):
+
+		#Floating point type of the real space quantities computed from the pixels
+		if self.data.dtype in [np.float32,np.complex64]:
+			return np.float32
+		else:
+			return np.float64
+
+	def _transposeRoll(self):
+
+		#Transpose the pixels, keeping track of the lazy roll offsets
+		self.data = self.data.T
+		self._roll_offset = self._roll_offset[::-1]
+		self._derivatives = None
+
+
 	def toReal(self):
 
 		"""
@@ -280,38 +468,90 @@ class Plane(Spin0):
 
 		assert isinstance(x,np.ndarray) and isinstance(y,np.ndarray)
 
+		#Return the map values at the specified coordinates
+		i,j = self._pixelIndices(x,y)
+		return self.data[i,j]
+
+	def _pixelIndices(self,x,y):
+
 		#x coordinates
 		if type(x)==quantity.Quantity:
 			
-			assert x.unit.physical_type=="angle"
+			assert x.unit.physical_type in ["angle","length"]
 
 			#Check if the resolution units are length units
-			if self.resolution.unit.physical_type=="length":
+			if self.resolution.unit.physical_type=="length" and x.unit.physical_type=="angle":
 				x = x.to(rad).value*self.comoving_distance 
 
-			j = np.mod(((x / self.resolution).decompose().value).astype(np.int32),self.data.shape[1])
+			j = ((x / self.resolution).decompose().value).astype(np.int32)
 
 		else:
 
-			j = np.mod((x / self.resolution.to(rad).value).astype(np.int32),self.data.shape[1])	
+			j = (x / self.resolution.to(rad).value).astype(np.int32)
 
 		#y coordinates
 		if type(y)==quantity.Quantity:
 			
-			assert y.unit.physical_type=="angle"
+			assert y.unit.physical_type in ["angle","length"]
 
 			#Check if the resolution units are length units
-			if self.resolution.unit.physical_type=="length":
+			if self.resolution.unit.physical_type=="length" and y.unit.physical_type=="angle":
 				y = y.to(rad).value*self.comoving_distance
 
-			i = np.mod(((y / self.resolution).decompose().value).astype(np.int32),self.data.shape[0])
+			i = ((y / self.resolution).decompose().value).astype(np.int32)
 
 		else:
 
-			i = np.mod((y / self.resolution.to(rad).value).astype(np.int32),self.data.shape[0])
+			i = (y / self.resolution.to(rad).value).astype(np.int32)
 
-		#Return the map values at the specified coordinates
-		return self.data[i,j]
+		#Apply the lazy roll offsets, enforcing periodic boundary conditions
+		i = np.mod(i-self._roll_offset[0],self.data.shape[0])
+		j = np.mod(j-self._roll_offset[1],self.data.shape[1])
+
+		return i,j
+
+	def gradient(self,x=None,y=None,save=True):
+
+		#Full plane: roll the output according to the lazy offsets
+		if (x is None) or (y is None):
+			gradient_x,gradient_y = self._rollOutput(np.array(super(Plane,self).gradient(save=False)))
+			if save:
+				self.gradient_x,self.gradient_y = gradient_x,gradient_y
+			return gradient_x,gradient_y
+
+		#Selected positions: offset the pixel indices
+		assert x.shape==y.shape,"x and y must have the same shape!"
+		i,j = self._pixelIndices(x,y)
+		gradient_x,gradient_y = _topology.gradient(self.data,j,i)
+		return gradient_x.reshape(x.shape),gradient_y.reshape(x.shape)
+
+	def hessian(self,x=None,y=None,save=True):
+
+		#Full plane: roll the output according to the lazy offsets
+		if (x is None) or (y is None):
+			hessian_xx,hessian_yy,hessian_xy = self._rollOutput(np.array(super(Plane,self).hessian(save=False)))
+			if save:
+				self.hessian_xx,self.hessian_yy,self.hessian_xy = hessian_xx,hessian_yy,hessian_xy
+			return hessian_xx,hessian_yy,hessian_xy
+
+		#Selected positions: offset the pixel indices
+		assert x.shape==y.shape,"x and y must have the same shape!"
+		i,j = self._pixelIndices(x,y)
+		hessian_xx,hessian_yy,hessian_xy = _topology.hessian(self.data,j,i)
+		return hessian_xx.reshape(x.shape),hessian_yy.reshape(x.shape),hessian_xy.reshape(x.shape)
+
+	def gradLaplacian(self,x=None,y=None):
+
+		#Full plane: roll the output according to the lazy offsets
+		if (x is None) or (y is None):
+			gl_x,gl_y = self._rollOutput(np.array(super(Plane,self).gradLaplacian()))
+			return gl_x,gl_y
+
+		#Selected positions: offset the pixel indices
+		assert x.shape==y.shape,"x and y must have the same shape!"
+		i,j = self._pixelIndices(x,y)
+		gl_x,gl_y = _topology.gradLaplacian(self.data,j,i)
+		return gl_x.reshape(x.shape),gl_y.reshape(x.shape)
 
 	def _grad(self,x=None,y=None,lmesh=None):
 
@@ -336,7 +576,7 @@ class Plane(Spin0):
 
 			#Compute deflections in fourier space
 			if lmesh is None:
-				l = np.array(np.meshgrid(fftengine.rfftfreq(self.data.shape[0]),fftengine.fftfreq(self.data.shape[0])))
+				l = _fourierMesh(self.data.shape[0])
 			else:
 				l = lmesh
 
@@ -353,7 +593,7 @@ class Plane(Spin0):
 			last_timestamp = now 
 
 			#Go back in real space
-			deflection = fftengine.irfft2(ft_deflection)
+			deflection = self._rollOutput(fftengine.irfft2(ft_deflection))
 
 			#Timestamp
 			now = time.time()
@@ -378,7 +618,7 @@ class Plane(Spin0):
 	def scaleWithTransfer(self,z,tfr,with_scale_factor=False,kmesh=None,scaling_method="uniform"):
 
 		"""
-		Scale the pixel values to a different redshift than the one of the plane by applying a suitable transfer function. This operation works in place
+		Scale the pixel values to a different redshift than the one of the plane by applying a suitable transfer function. This operation works in place (on a private copy of the pixels if they are read only, e.g. shared by a PlaneCache)
 
 		:param z: new redshift to evaluate the plane at
 		:type z: float.
@@ -407,6 +647,13 @@ class Plane(Spin0):
 		#Log
 		logplanes.debug("Scaling fluctuations on lens at redshift {0:.6f} to redshift {1:.6f} with method {2}".format(z0,z1,scaling_method))
 
+		#Never write into shared (read only) buffers
+		if not self.data.flags.writeable:
+			self.data = self.data.copy()
+
+		#Precomputed derivatives refer to the unscaled pixels
+		self._derivatives = None
+
 		if scaling_method=="uniform":
 			
 			#Scale all the pixels on the plane by the same factor
@@ -424,7 +671,7 @@ class Plane(Spin0):
 			ft_plane = fftengine.rfft2(self.data)
 
 			if kmesh is None:
-				lx,ly = np.array(np.meshgrid(fftengine.rfftfreq(self.data.shape[0]),fftengine.fftfreq(self.data.shape[0])))
+				lx,ly = _fourierMesh(self.data.shape[0])
 				kmesh = np.sqrt(lx**2+ly**2)*2.*np.pi / self.side_angle
 
 			#Multiply by the Fourier pixels by the transfer function
@@ -509,7 +756,7 @@ class DensityPlane(Plane):
 
 		#Initialize l meshgrid
 		if lmesh is None:
-			l = np.array(np.meshgrid(fftengine.rfftfreq(self.data.shape[0]),fftengine.fftfreq(self.data.shape[0])))
+			l = _fourierMesh(self.data.shape[0])
 		else:
 			l = lmesh
 
@@ -530,8 +777,10 @@ class DensityPlane(Plane):
 		density_ft *= -2.0*((self.resolution.to(rad).value)**2) / (l_squared * ((2.0*np.pi)**2))
 		density_ft[0,0] = 0.0
 
-		#Instantiate the new PotentialPlane
-		return PotentialPlane(data=fftengine.irfft2(density_ft),angle=self.side_angle,redshift=self.redshift,comoving_distance=self.comoving_distance,cosmology=self.cosmology,num_particles=self.num_particles,unit=rad**2)
+		#Instantiate the new PotentialPlane, which inherits the lazy roll offsets
+		potential = PotentialPlane(data=fftengine.irfft2(density_ft),angle=self.side_angle,redshift=self.redshift,comoving_distance=self.comoving_distance,cosmology=self.cosmology,num_particles=self.num_particles,unit=rad**2)
+		potential._roll_offset = self._roll_offset
+		return potential
 
 	def densityGradient(self,x=None,y=None,lmesh=None):
 
@@ -587,6 +836,14 @@ class PotentialPlane(Plane):
 
 		"""
 
+		#Look up the precomputed derivative planes, if attached
+		if self._derivatives is not None:
+			
+			if (x is not None) and (y is not None):
+				return self._lookupDerivatives(x,y,0,2) * rad
+			else:
+				return DeflectionPlane(np.array(self._rollOutput(np.moveaxis(self._derivatives[...,:2],-1,0))),angle=self.side_angle,redshift=self.redshift,comoving_distance=self.comoving_distance,cosmology=self.cosmology,unit=rad)
+
 		deflection = self._grad(x,y,lmesh)
 
 		assert deflection.unit.physical_type=="angle"
@@ -622,6 +879,14 @@ class PotentialPlane(Plane):
 
 		"""
 
+		#Look up the precomputed derivative planes, if attached
+		if self._derivatives is not None:
+
+			if (x is not None) and (y is not None):
+				return self._lookupDerivatives(x,y,2,3)
+			else:
+				return ShearTensorPlane(np.array(self._rollOutput(np.moveaxis(self._derivatives[...,2:],-1,0))),angle=self.side_angle,redshift=self.redshift,comoving_distance=self.comoving_distance,cosmology=self.cosmology,unit=dimensionless_unscaled)
+
 		now = time.time()
 		last_timestamp = now
 
@@ -642,7 +907,7 @@ class PotentialPlane(Plane):
 
 			#Compute deflections in fourier space
 			if lmesh is None:
-				lx,ly = np.array(np.meshgrid(fftengine.rfftfreq(self.data.shape[0]),fftengine.fftfreq(self.data.shape[0])))
+				lx,ly = _fourierMesh(self.data.shape[0])
 			else:
 				lx,ly = lmesh
 
@@ -656,7 +921,7 @@ class PotentialPlane(Plane):
 			tensor_xy = fftengine.irfft2(ft_tensor_xy)
 			tensor_yy = fftengine.irfft2(ft_tensor_yy)
 
-			tensor = np.array([tensor_xx,tensor_yy,tensor_xy])
+			tensor = self._rollOutput(np.array([tensor_xx,tensor_yy,tensor_xy]))
 
 		else:
 			raise ValueError("space must be either real or fourier!")
@@ -683,6 +948,263 @@ class PotentialPlane(Plane):
 
 	#########################################################################################################################################
 
+	def deflectionShear(self,x,y,out=None):
+
+		"""
+		Computes the deflection angles and the shear matrix for rays hitting the lens at (x,y) with a single pass over the rays (finite differences in real space, or lookups if derivative planes are attached); equivalent to calling deflectionAngles(x,y) and shearMatrix(x,y)
+
+		:param x: x positions of the rays hitting the lens; if unitless, the positions are assumed to be in radians
+		:type x: array or quantity
+
+		:param y: y positions of the rays hitting the lens; if unitless, the positions are assumed to be in radians
+		:type y: array or quantity
+
+		:param out: if not None, the results are written in this (preallocated) C contiguous array of doubles, which must have shape (5,)+x.shape
+		:type out: array
+
+		:returns: array of shape (5,)+x.shape, with the deflection angles (in radians) out[0:2] and the shear matrix components (xx,yy,xy) out[2:5]
+
+		"""
+
+		#Sanity checks
+		assert self.space=="real" or (self._derivatives is not None),"The fused deflection/shear calculation must proceed in real space!"
+		assert x.shape==y.shape,"x and y must have the same shape!"
+
+		if out is None:
+			out = np.empty((5,)+x.shape,dtype=self._realType())
+		else:
+			assert out.shape==(5,)+x.shape,"out must have shape (5,)+x.shape"
+
+		#Positions in radians
+		if isinstance(x,quantity.Quantity):
+			x = x.to(rad).value
+		if isinstance(y,quantity.Quantity):
+			y = y.to(rad).value
+
+		#The kernels work in the precision of the pixels
+		if out.dtype!=self._realType():
+			out[:] = self.deflectionShear(x,y)
+			return out
+
+		#Pure lookups if the derivative planes are attached
+		if self._derivatives is not None:
+			_topology.lookup(self._derivatives,x,y,self._pixelResolution(),self._roll_offset[0],self._roll_offset[1],0,out)
+			return out
+
+		#Pixel size in radians and conversion factors from pixel differences to deflections/shear
+		resolution = self._pixelResolution()
+		gradient_factor,hessian_factor = self._derivativeFactors()
+
+		#Single pass over the rays in C
+		_topology.gradientHessian(self.data,x,y,resolution,self._roll_offset[0],self._roll_offset[1],out)
+		out[:2] *= gradient_factor
+		out[2:] *= hessian_factor
+
+		return out
+
+	def _derivativeFactors(self):
+
+		#Conversion factors from the pixel derivatives of the potential to deflections (radians) and shear
+		if self.side_angle.unit.physical_type=="length":
+			gradient_factor = (self.unit*self.comoving_distance/(self.resolution*rad)).to(rad).value
+			hessian_factor = (self.unit*(self.comoving_distance**2)/((self.resolution**2)*(rad**2))).decompose().value
+		else:
+			gradient_factor = (self.unit/self.resolution).to(rad).value
+			hessian_factor = (self.unit/(self.resolution**2)).decompose().value
+
+		return gradient_factor,hessian_factor
+
+	def _fourierDerivatives(self,lmesh=None,work=None):
+
+		#Deflection angles and shear matrix (xx,yy,xy) of the unrolled pixels from a single stacked inverse FFT, interleaved pixel by pixel with shape (N,N,5)
+		assert self.space=="fourier","The stacked FFT derivatives need the plane in fourier space!"
+
+		if lmesh is None:
+			lx,ly = _fourierMesh(self.data.shape[0])
+		else:
+			lx,ly = lmesh
+
+		#The Fourier space products are written in the (preallocated) work buffer, stacked along the last axis
+		if work is None:
+			work = np.empty(self.data.shape+(5,),dtype=self.data.dtype)
+		else:
+			assert work.shape==self.data.shape+(5,) and work.dtype==self.data.dtype,"work must have shape data.shape+(5,) and the same type as the pixels"
+
+		np.multiply(self.data,lx,out=work[...,0])
+		np.multiply(self.data,ly,out=work[...,1])
+		np.multiply(work[...,0],lx,out=work[...,2])
+		np.multiply(work[...,1],ly,out=work[...,3])
+		np.multiply(work[...,0],ly,out=work[...,4])
+		work[...,:2] *= 2.0j*np.pi
+		work[...,2:] *= -(2.0*np.pi)**2
+
+		#One inverse transform for all the derivatives, then scale to units
+		derivatives = np.ascontiguousarray(fftengine.irfft2(work,axes=(0,1)),dtype=self._realType())
+		gradient_factor,hessian_factor = self._derivativeFactors()
+		derivatives[...,:2] *= gradient_factor
+		derivatives[...,2:] *= hessian_factor
+		derivatives.flags.writeable = False
+
+		return derivatives
+
+	def _pixelResolution(self):
+
+		#Size of a pixel in radians: the kernels divide the ray positions by it, as _pixelIndices does
+		if self.side_angle.unit.physical_type=="length":
+			return (self.resolution/self.comoving_distance).decompose().value
+		else:
+			return self.resolution.to(rad).value
+
+	def _lookupDerivatives(self,x,y,first,num):
+
+		#Positions in radians
+		if isinstance(x,quantity.Quantity):
+			x = x.to(rad).value
+		if isinstance(y,quantity.Quantity):
+			y = y.to(rad).value
+
+		#Look up derivatives first,...,first+num-1 at the ray positions
+		out = np.empty((num,)+x.shape,dtype=self._derivatives.dtype)
+		_topology.lookup(self._derivatives,x,y,self._pixelResolution(),self._roll_offset[0],self._roll_offset[1],first,out)
+		return out
+
+	#########################################################################################################################################
+
+	@staticmethod
+	def derivativesFilename(filename):
+
+		"""
+		Name of the file that contains the derivative planes of the lens plane saved in filename
+
+		:param filename: name of the file that contains the lens plane
+		:type filename: str.
+
+		:returns: str.
+
+		"""
+
+		root,extension = os.path.splitext(filename)
+		return root + "_derivatives" + extension
+
+	def derivativesKey(self):
+
+		"""
+		Checksum of the pixel values (and units) of the plane: derivative planes are attached to the plane only if they were computed from pixels with the same checksum. Only a regular grid of at most 256x256 pixels enters the checksum, so that it costs the same for every plane size
+
+		:returns: str.
+
+		"""
+
+		#Regular subset of the pixels: single precision pixels have the same checksum as their double precision counterpart
+		step = max(self.data.shape[0]//256,1)
+		checksum = hashlib.sha1()
+		checksum.update(np.ascontiguousarray(self.data[::step,::step],dtype=(np.float64 if self.space=="real" else np.complex128)))
+		checksum.update("{0} {1} {2} {3} {4}".format(self.space,self.data.shape,self.unit.to_string(),self.resolution,self.comoving_distance).encode("utf-8"))
+
+		return checksum.hexdigest()
+
+	def saveDerivatives(self,filename=None,double_precision=False,lmesh=None):
+
+		"""
+		Computes the deflection angles and the shear matrix on every pixel of the plane once, and saves them in a single file (keyed with the checksum of the plane pixels) so that ray tracing can look them up instead of computing them at every crossing. In real space the derivatives are computed with the same finite differences used on the fly; the plane should be read back from disk before calling this method, so that the checksum refers to the pixels that the ray tracer will see
+
+		:param filename: name of the file on which to save the derivatives; if None, it is derived from the name of the file the plane was read from
+		:type filename: str.
+
+		:param double_precision: if True saves the derivatives in double precision
+		:type double_precision: bool.
+
+		:param lmesh: the FFT frequency meshgrid (lx,ly) necessary for the calculations in fourier space; if None, a new one is computed from scratch
+		:type lmesh: array
+
+		:returns: name of the file on which the derivatives were saved
+
+		"""
+
+		if filename is None:
+			assert self.filename is not None,"The plane was not read from a file, please specify the name of the derivatives file"
+			filename = self.derivativesFilename(self.filename)
+
+		derivatives = self._computeDerivatives(lmesh=lmesh)
+		saveDerivativesFITS(derivatives,filename,key=self.derivativesKey(),scheme=self.space,double_precision=double_precision)
+		logplanes.debug("Saved derivatives of plane at z={0:.3f} to {1}".format(self.redshift,filename))
+
+		return filename
+
+	def loadDerivatives(self,filename=None):
+
+		"""
+		Attaches the derivative planes saved by saveDerivatives to the plane, after checking that they were computed from the same pixels: from then on the deflection angles and the shear matrix are looked up instead of computed. Missing or stale derivatives are not attached
+
+		:param filename: name of the file that contains the derivatives; if None, it is derived from the name of the file the plane was read from
+		:type filename: str.
+
+		:returns: True if the derivatives were attached, False otherwise
+
+		"""
+
+		if filename is None:
+			assert self.filename is not None,"The plane was not read from a file, please specify the name of the derivatives file"
+			filename = self.derivativesFilename(self.filename)
+
+		if not os.path.exists(filename):
+			logray.warning("Derivatives file {0} not found, derivatives will be computed on the fly".format(filename))
+			return False
+
+		#Check the header first, so that stale derivatives are never read
+		header = readFITSHeader(filename)
+		if (tuple([ header.get("NAXIS{0}".format(n)) for n in (3,2,1) ])!=(5,self.data.shape[0],self.data.shape[0])) or (header["KEY"]!=self.derivativesKey()):
+			logray.warning("Derivatives in {0} are stale (computed from different pixels), derivatives will be computed on the fly".format(filename))
+			return False
+
+		#Read the derivatives in the precision of the pixels
+		derivatives,key,scheme = readDerivativesFITS(filename,double_precision=(self._realType()==np.float64))
+		self._attachDerivatives(derivatives)
+		logray.debug("Attached derivatives ({0} scheme) from {1}".format(scheme,filename))
+
+		return True
+
+	def computeDerivatives(self,lmesh=None):
+
+		"""
+		Computes the deflection angles and the shear matrix on every pixel of the plane, and attaches them in memory as loadDerivatives would do: this pays off when many bundles of light rays cross the same plane
+
+		:param lmesh: the FFT frequency meshgrid (lx,ly) necessary for the calculations in fourier space; if None, a new one is computed from scratch
+		:type lmesh: array
+
+		"""
+
+		if self.space=="fourier":
+			self._derivatives = self._fourierDerivatives(lmesh=lmesh)
+		else:
+			self._attachDerivatives(self._computeDerivatives(lmesh=lmesh))
+
+		logray.debug("Attached derivatives ({0} scheme) computed in memory".format(self.space))
+
+	def _computeDerivatives(self,lmesh=None):
+
+		#Derivatives are computed on the unrolled pixels, the lazy roll offsets are applied at lookup time
+		if self.space=="real":
+			resolution = self._pixelResolution()
+			gradient_factor,hessian_factor = self._derivativeFactors()
+			pixels = (np.arange(self.data.shape[0])+0.5) * resolution
+			x,y = np.meshgrid(pixels,pixels)
+			derivatives = np.empty((5,)+x.shape,dtype=self._realType())
+			_topology.gradientHessian(self.data,x,y,resolution,0,0,derivatives)
+			derivatives[:2] *= gradient_factor
+			derivatives[2:] *= hessian_factor
+			return derivatives
+		else:
+			return np.moveaxis(self._fourierDerivatives(lmesh=lmesh),-1,0)
+
+	def _attachDerivatives(self,derivatives):
+
+		#The derivatives of each pixel are interleaved in memory, so that a lookup touches a single cache line; they are held in the same precision as the pixels
+		self._derivatives = np.ascontiguousarray(np.moveaxis(derivatives,0,-1),dtype=self._realType())
+		self._derivatives.flags.writeable = False
+
+	#########################################################################################################################################
+
 	def density(self,x=None,y=None):
 
 		"""
@@ -718,7 +1240,7 @@ class PotentialPlane(Plane):
 
 			ly,lx = np.meshgrid(fftengine.fftfreq(self.data.shape[0]),fftengine.rfftfreq(self.data.shape[0]),indexing="ij")
 			ft_laplacian = -1.0 * (2.0*np.pi)**2 * (lx**2 + ly**2) * self.data
-			laplacian = fftengine.irfft2(ft_laplacian) 			
+			laplacian = self._rollOutput(fftengine.irfft2(ft_laplacian))
 
 		else:
 			raise ValueError("space must be either real or fourier!")
@@ -969,140 +1491,554 @@ class ShearTensorPlane(Spin2):
 
 
 #######################################################
-###############RayTracer class#########################
+###############PlaneCache class########################
 #######################################################
 
-class RayTracer(object):
+class PlaneCache(object):
 
 	"""
-	Class handler of ray tracing operations: it mainly computes the path corrections of light rays that travel through a set of gravitational lenses
+	Process wide, memory bounded cache of lens planes read from disk, keyed by file name. When the memory budget is exceeded the least recently used planes are evicted first. The cached planes are read only: each request hands back a shallow copy of the cached plane that shares the underlying data buffer, so that many realizations can roll it (lazily) without touching the cached values
 
 	"""
 
-	def __init__(self,lens_mesh_size=None,lens_type=PotentialPlane):
+	def __init__(self,max_memory):
 
-		self.Nlenses = 0
-		self.lens = list()
-		self.distance = list()
-		self.redshift = list()
-		self.lens_type = lens_type
+		"""
+		:param max_memory: memory budget of the cache (e.g. 4*u.Gbyte)
+		:type max_memory: quantity
 
-		#If we know the size of the lens planes already we can compute, once and for all, the FFT meshgrid
-		if lens_mesh_size is not None:
-			self.lmesh = np.array(np.meshgrid(fftengine.rfftfreq(lens_mesh_size),fftengine.fftfreq(lens_mesh_size)))
-		else:
-			self.lmesh = None
+		"""
 
+		self.max_memory = max_memory.to(byte).value
+		self.memory = 0
+		self.hits = 0
+		self.misses = 0
+		self._planes = OrderedDict()
 
-	def addLens(self,lens_specification):
+	def __len__(self):
+		return len(self._planes)
 
-		"""
-		Adds a gravitational lens to the ray tracer, either by putting in a lens plane, or by specifying the name of a file which contains the lens specifications
+	def __contains__(self,filename):
+		return filename in self._planes
 
-		:param lens_specification: specifications of the lens to add, either in tuple(filename,distance,redshift) or as a PotentialPlane instance
-		:type lens specification: tuple or PotentialPlane instance
+	@staticmethod
+	def _nbytes(plane):
 
-		"""
+		#Memory held by a plane, including its derivative planes
+		if plane._derivatives is None:
+			return plane.data.nbytes
+		else:
+			return plane.data.nbytes + plane._derivatives.nbytes
 
-		#Sanity check
-		assert type(lens_specification) in [tuple,self.lens_type]
+	def load(self,filename,cls,derivatives=False,double_precision=True):
 
-		#If specification is in tuple form, parse it
-		if type(lens_specification)==tuple:
+		"""
+		Retrieves a plane from the cache, reading it from disk if it is not cached yet (or if it is cached with a different precision)
 
-			filename,distance,redshift = lens_specification
+		:param filename: name of the file that contains the plane
+		:type filename: str.
 
-			assert type(filename)==str
-			assert distance.unit.physical_type=="length"
-			assert type(redshift)==float
-			
-			self.lens.append(filename)
-			self.distance.append(distance)
-			self.redshift.append(redshift)
-			self.Nlenses += 1
+		:param cls: plane type used to read the file
+		:type cls: :py:class:`Plane` subclass
 
-		else:
+		:param derivatives: if True, the precomputed derivative planes are attached to the plane (and cached along with it)
+		:type derivatives: bool.
 
-			#Otherwise get the info from the PotentialPlane class
-			self.lens.append(lens_specification)
-			self.distance.append(lens_specification.comoving_distance)
-			self.redshift.append(lens_specification.redshift)
-			self.Nlenses += 1
+		:param double_precision: if False, the pixels are held in single precision
+		:type double_precision: bool.
 
-		#If completed correctly, log info to the user
-		logray.debug("Added lens at redshift {0:.3f}(comoving distance {1:.3f})".format(self.redshift[-1],self.distance[-1]))
+		:returns: plane instance that shares the cached data buffer
 
-	#Load the lens
-	def loadLens(self,lens):
+		"""
 
-		if type(lens)==self.lens_type:
-			return lens
+		if (filename in self._planes) and ((self._planes[filename]._realType()==np.float64)!=double_precision):
+			evicted = self._planes.pop(filename)
+			self.memory -= self._nbytes(evicted)
+			logray.debug("Evicted {0} from plane cache (cached with a different precision)".format(filename))
 
-		elif type(lens)==str:
-				
-			logray.info("Reading plane from {0}...".format(lens))
-			current_lens = self.lens_type.load(lens)
-			logray.info("Read plane from {0}...".format(lens))
-			logstderr.debug("Read plane: peak memory usage {0:.3f} (task)".format(peakMemory()))
-			
-			logray.info("Randomly rolling lens at z={0:.3f} along its axes...".format(current_lens.redshift))
-			current_lens.randomRoll()
-			logray.info("Rolled lens at z={0:.3f} along its axes...".format(current_lens.redshift))
-			logstderr.debug("Rolled lens: peak memory usage {0:.3f} (task)".format(peakMemory()))
+		if filename in self._planes:
 
-			return current_lens
+			#Move the plane at the end of the LRU queue
+			plane = self._planes.pop(filename)
+			self.memory -= self._nbytes(plane)
+			self.hits += 1
+			logray.debug("Plane cache hit for {0} ({1} hits, {2} misses)".format(filename,self.hits,self.misses))
 
 		else:
-			raise TypeError("Lens format not recognized!")
 
+			plane = cls.load(filename,double_precision=double_precision)
+			self.misses += 1
+			logray.debug("Plane cache miss for {0} ({1} hits, {2} misses)".format(filename,self.hits,self.misses))
 
-	def randomRoll(self,seed=None):
-
-		"""
-		Randomly rolls all the lenses in the system along both axes
+		#Attach the derivatives if requested and not cached yet
+		if derivatives and (plane._derivatives is None):
+			plane.loadDerivatives()
 
-		:param seed: random seed with which to initialize the generator
-		:type seed: int.
+		#Planes that are bigger than the whole budget are never cached
+		if self._nbytes(plane)>self.max_memory:
+			return plane
 
-		"""
+		#Evict the least recently used planes until there is enough room for this one
+		while self.memory+self._nbytes(plane)>self.max_memory:
+			evicted_filename,evicted = self._planes.popitem(last=False)
+			self.memory -= self._nbytes(evicted)
+			logray.debug("Evicted {0} from plane cache".format(evicted_filename))
 
-		if seed is not None:
-			np.random.seed(seed)
+		plane.data.flags.writeable = False
+		self._planes[filename] = plane
+		self.memory += self._nbytes(plane)
 
-		for lens in self.lens:
-			lens.randomRoll(seed=None,lmesh=self.lmesh)
+		#Shallow copy: the data buffer is shared and read only, the roll is applied lazily by the ray tracer
+		cached_plane = copy.copy(plane)
+		if not derivatives:
+			cached_plane._derivatives = None
 
+		return cached_plane
 
-	def reorderLenses(self):
+	def clear(self):
 
 		"""
-		Reorders the lenses in the ray tracer according to their comoving distance from the observer
+		Empties the cache
 
 		"""
 
-		self.lens = [ lens for (redshift,lens) in sorted(zip(self.redshift,self.lens)) ]
-		self.redshift.sort()
-		self.distance.sort()
+		self._planes.clear()
+		self.memory = 0
 
 
-	##################################################################################################################################
-	#####################This method solves the nonlinear lensing ODE#################################################################
-	#############################(backward ray tracing)###############################################################################
-	##################################################################################################################################
+class SharedPlaneStore(object):
 
-	def shoot(self,initial_positions,z=2.0,initial_deflection=None,kind="positions",save_intermediate=False,compute_all_deflections=False,callback=None,transfer=None,**kwargs):
+	"""
+	Node wide store of lens planes read from disk, for MPI ray tracing: the tasks that run on the same node request their lens planes together (one lens at a time, in the same order), each distinct plane file is read by a single task of the node into a MPI-3 shared memory segment, and all the tasks that requested it trace rays against the same read only pixels. The planes handed out by a request remain valid until the next request
 
-		"""
-		Shots a bucket of light rays from the observer to the sources at redshift z (backward ray tracing), through the system of gravitational lenses, and computes the deflection statistics
+	"""
 
-		:param initial_positions: initial angular positions of the light ray bucket, according to the observer; if unitless, the positions are assumed to be in radians. initial_positions[0] is x, initial_positions[1] is y
-		:type initial_positions: numpy array or quantity
+	#Alignment of the planes in the shared memory segment (bytes)
+	_alignment = 64
 
-		:param z: redshift of the sources; if an array is passed, a redshift must be specified for each ray, i.e. z.shape==initial_positions.shape[1:]
-		:type z: float. or array
+	def __init__(self,pool):
 
-		:param initial_deflection: if not None, this is the initial deflection light rays undergo with respect to the line of sight (equivalent to specifying the first derivative IC on the lensing ODE); must have the same shape as initial_positions
-		:type initial_deflection: numpy array or quantity
+		"""
+		:param pool: MPI pool that runs the ray tracing tasks
+		:type pool: :py:class:`~lenstools.utils.mpi.MPIWhirlPool`
+
+		"""
+
+		self.pool = pool
+		self.memory = 0
+		self._window = None
+
+	def load(self,filename,cls,derivatives=False,double_precision=True):
+
+		"""
+		Retrieves a plane through the node shared memory segment; this is collective over the tasks on the same node, which must all call it the same number of times (tasks that do not need a plane pass None)
+
+		:param filename: name of the file that contains the plane
+		:type filename: str.
+
+		:param cls: plane type used to read the file
+		:type cls: :py:class:`Plane` subclass
+
+		:param derivatives: if True, the precomputed derivative planes are attached to the plane (and shared along with it)
+		:type derivatives: bool.
+
+		:param double_precision: if False, the pixels are held (and shared) in single precision
+		:type double_precision: bool.
+
+		:returns: plane instance that views the shared, read only, pixels
+
+		"""
+
+		node_comm = self.pool.node_comm
+
+		#The planes handed out by the previous request are not needed anymore
+		self.release()
+
+		#Each distinct plane file requested on the node is read by a single task
+		filenames = sorted(set([ f for f in node_comm.allgather(filename) if f is not None ]))
+		planes = dict()
+
+		for n,f in enumerate(filenames):
+			if n%node_comm.size==node_comm.rank:
+				planes[f] = cls.load(f,double_precision=double_precision)
+				if derivatives:
+					planes[f].loadDerivatives()
+
+		#Share the plane headers (everything but the pixels) across the node
+		headers = dict()
+		for f,plane in planes.items():
+			headers[f] = copy.copy(plane)
+			headers[f]._extra_attributes = list(plane._extra_attributes)
+			headers[f].data = (plane.data.shape,plane.data.dtype)
+			headers[f]._derivatives = None if plane._derivatives is None else (plane._derivatives.shape,plane._derivatives.dtype)
+
+		for node_headers in node_comm.allgather(headers):
+			headers.update(node_headers)
+
+		#Layout of the shared memory segment: pixels (and derivatives) of each plane, one after the other
+		layout = dict()
+		self.memory = 0
+
+		for f in filenames:
+			layout[f] = list()
+			for buf in (headers[f].data,headers[f]._derivatives):
+				if buf is None:
+					layout[f].append(None)
+					continue
+				layout[f].append((self.memory,)+buf)
+				self.memory += reduce(mul,buf[0],1)*buf[1].itemsize
+				self.memory += (-self.memory) % self._alignment
+
+		self._window,segment = self.pool.openSharedWindow(self.memory)
+		self._window.Fence()
+
+		def view(buf):
+			offset,shape,dtype = buf
+			return np.ndarray(buffer=segment,offset=offset,shape=shape,dtype=dtype)
+
+		#Each reader copies its planes in the shared segment, then drops its private copy
+		for f,plane in planes.items():
+			view(layout[f][0])[:] = plane.data
+			if plane._derivatives is not None:
+				view(layout[f][1])[:] = plane._derivatives
+
+		planes.clear()
+		self._window.Fence()
+
+		if node_comm.rank==0:
+			logray.debug("Node shared plane store: {0} distinct planes for {1} tasks ({2:.3f} GB)".format(len(filenames),node_comm.size,self.memory/1024.**3))
+
+		if filename is None:
+			return None
+
+		#Wrap the shared, read only, pixels
+		plane = copy.copy(headers[filename])
+		plane.data = view(layout[filename][0])
+		plane.data.flags.writeable = False
+
+		if layout[filename][1] is not None:
+			plane._derivatives = view(layout[filename][1])
+			plane._derivatives.flags.writeable = False
+
+		return plane
+
+	def release(self):
+
+		"""
+		Frees the shared memory segment that holds the planes handed out by the last request (collective over the tasks on the same node)
+
+		"""
+
+		if self._window is not None:
+			self.pool.closeSharedWindow(self._window)
+			self._window = None
+			self.memory = 0
+
+
+#######################################################
+###############RayTracer class#########################
+#######################################################
+
+class RayTracer(object):
+
+	"""
+	Class handler of ray tracing operations: it mainly computes the path corrections of light rays that travel through a set of gravitational lenses
+
+	"""
+
+	def __init__(self,lens_mesh_size=None,lens_type=PotentialPlane,plane_cache=None,prefetch=0,derivatives=False,shared_store=None,windowed=False,double_precision=True):
+
+		self.Nlenses = 0
+		self.lens = list()
+		self.distance = list()
+		self.redshift = list()
+		self.lens_type = lens_type
+
+		#Lens planes specified by file name are read through this cache, if provided
+		assert (plane_cache is None) or isinstance(plane_cache,PlaneCache)
+		self.plane_cache = plane_cache
+
+		#Lens planes specified by file name can alternatively be shared between the MPI tasks on the same node
+		assert (shared_store is None) or isinstance(shared_store,SharedPlaneStore)
+		assert (shared_store is None) or (plane_cache is None),"Lens planes cannot be both cached and shared!"
+		self.shared_store = shared_store
+
+		#Number of lens planes read ahead by a background thread while the current one is crossed (0 disables prefetching)
+		assert prefetch>=0,"prefetch depth must be non negative!"
+		self.prefetch = prefetch
+
+		#If True, the deflection angles and shear matrices of lens planes read from disk are looked up in the derivative planes saved alongside them (if present and up to date)
+		assert not(derivatives) or hasattr(lens_type,"loadDerivatives"),"Derivative planes are available only for potential planes!"
+		self.derivatives = derivatives
+
+		#If True, only the square window of each lens plane (specified by file name) that the light rays can hit is read from disk, when the rays reach the plane (no caching or prefetching)
+		assert not(windowed) or ((shared_store is None) and not(derivatives)),"Windowed lens planes cannot be shared or looked up in derivative planes!"
+		self.windowed = windowed
+
+		#If False, the lens planes read from disk, their derivatives and the light ray state (positions, deflections and jacobians) are held in single precision
+		self.double_precision = double_precision
+
+		#If we know the size of the lens planes already we can compute, once and for all, the FFT meshgrid
+		if lens_mesh_size is not None:
+			self.lmesh = _fourierMesh(lens_mesh_size)
+		else:
+			self.lmesh = None
+
+
+	def addLens(self,lens_specification):
+
+		"""
+		Adds a gravitational lens to the ray tracer, either by putting in a lens plane, or by specifying the name of a file which contains the lens specifications
+
+		:param lens_specification: specifications of the lens to add, either in tuple(filename,distance,redshift) or as a PotentialPlane instance
+		:type lens specification: tuple or PotentialPlane instance
+
+		"""
+
+		#Sanity check
+		assert type(lens_specification) in [tuple,self.lens_type]
+
+		#If specification is in tuple form, parse it
+		if type(lens_specification)==tuple:
+
+			filename,distance,redshift = lens_specification
+
+			assert type(filename)==str
+			assert distance.unit.physical_type=="length"
+			assert type(redshift)==float
+			
+			self.lens.append(filename)
+			self.distance.append(distance)
+			self.redshift.append(redshift)
+			self.Nlenses += 1
+
+		else:
+
+			#Otherwise get the info from the PotentialPlane class
+			self.lens.append(lens_specification)
+			self.distance.append(lens_specification.comoving_distance)
+			self.redshift.append(lens_specification.redshift)
+			self.Nlenses += 1
+
+		#If completed correctly, log info to the user
+		logray.debug("Added lens at redshift {0:.3f}(comoving distance {1:.3f})".format(self.redshift[-1],self.distance[-1]))
+
+	#Load the lens
+	def loadLens(self,lens):
+
+		if type(lens)==self.lens_type:
+			return lens
+
+		elif type(lens)==str:
+			
+			current_lens = self._readLens(lens)
+			self._rollLens(current_lens)
+			return current_lens
+
+		else:
+			raise TypeError("Lens format not recognized!")
+
+	def _readLens(self,lens):
+
+		logray.info("Reading plane from {0}...".format(lens))
+		if self.shared_store is not None:
+			current_lens = self.shared_store.load(lens,self.lens_type,derivatives=self.derivatives,double_precision=self.double_precision)
+		elif self.plane_cache is not None:
+			current_lens = self.plane_cache.load(lens,self.lens_type,derivatives=self.derivatives,double_precision=self.double_precision)
+		else:
+			current_lens = self.lens_type.load(lens,double_precision=self.double_precision)
+			if self.derivatives:
+				current_lens.loadDerivatives()
+		logray.info("Read plane from {0}...".format(lens))
+		logstderr.debug("Read plane: peak memory usage {0:.3f} (task)".format(peakMemory()))
+
+		return current_lens
+
+	def _readLensWindow(self,lens,positions):
+
+		#The pixel scale of the plane (radians to pixels) is read from the header: SIDE and CHI are both in Mpc/h
+		header = self.lens_type.readHeader(lens)
+		num_pixels = header["NAXIS1"]
+
+		if "SIDE" in header.keys():
+			side = header["SIDE"] / header["CHI"]
+		elif "ANGLE" in header.keys():
+			side = (header["ANGLE"]*deg).to(rad).value
+		else:
+			side = header["RES_X"] * num_pixels / header["CHI"]
+
+		scale = num_pixels / side
+
+		#Random roll of the whole plane (the same random numbers as the lazy roll in real space)
+		logray.info("Randomly rolling lens at z={0:.3f} along its axes...".format(header["Z"]))
+		di = np.random.randint(0,num_pixels)
+		dj = np.random.randint(0,num_pixels)
+
+		#Unrolled pixels hit by the light rays, indexed as in the finite difference kernels, plus the 2 pixels margin of the stencils
+		x,y = np.asarray(positions,dtype=np.float64)
+		i = np.trunc(y*scale).astype(np.int64) - di
+		j = np.trunc(x*scale).astype(np.int64) - dj
+		first_row,first_col = i.min()-2,j.min()-2
+		size = max(i.max()-first_row,j.max()-first_col) + 3
+
+		#The light rays can hit the whole plane
+		if size>=num_pixels:
+			current_lens = self._readLens(lens)
+			current_lens._roll_offset = (di,dj)
+			return current_lens
+
+		#Read the window only: its pixels are indexed in the same way if the lazy roll offsets are shifted by the window origin
+		logray.info("Reading {0}x{0} window of the {1}x{1} plane from {2}...".format(size,num_pixels,lens))
+		current_lens = self.lens_type.load(lens,window=(first_row,first_col,size),double_precision=self.double_precision)
+		current_lens._roll_offset = (int(di+first_row)%size,int(dj+first_col)%size)
+		logray.info("Read window of the plane from {0}...".format(lens))
+		logstderr.debug("Read plane window: peak memory usage {0:.3f} (task)".format(peakMemory()))
+
+		return current_lens
+
+	def _rollLens(self,current_lens):
+			
+		logray.info("Randomly rolling lens at z={0:.3f} along its axes...".format(current_lens.redshift))
+		current_lens.randomRoll(lazy=True)
+		logray.info("Rolled lens at z={0:.3f} along its axes...".format(current_lens.redshift))
+		logstderr.debug("Rolled lens: peak memory usage {0:.3f} (task)".format(peakMemory()))
+
+	def _transferLens(self,current_lens,transfer):
+
+		#If transfer function is provided, scale to target redshift
+		if transfer is not None:
+			current_lens.scaleWithTransfer(transfer.cur2target[current_lens.redshift],tfr=transfer.tfr,with_scale_factor=transfer.with_scale_factor,kmesh=transfer.kmesh,scaling_method=transfer.scaling_method)
+
+	def iterLenses(self,num_lenses,transfer=None):
+
+		"""
+		Iterates over the first num_lenses lenses in the system, loading (and randomly rolling) each of them in turn; if the prefetch depth of the ray tracer is positive, the lens planes are read from disk (and scaled with the transfer function) by a background thread, up to prefetch lenses ahead of the one that is being used. The random rolls are drawn in order by the calling thread, so the outcome does not depend on the prefetch depth
+
+		:param num_lenses: number of lenses to iterate over
+		:type num_lenses: int.
+
+		:param transfer: if not None, scales the fluctuations on each lens plane to a different redshift using the provided transfer function
+		:type transfer: :py:class:`TransferSpecs`
+
+		:returns: generator of loaded lenses
+
+		"""
+
+		lenses = self.lens[:num_lenses]
+
+		#No prefetching: load the lenses one at a time (the shared plane store needs the lenses to be loaded by the calling thread)
+		if not(self.prefetch) or not(all([ type(lens)==str for lens in lenses ])) or (self.shared_store is not None):
+			
+			for lens in lenses:
+				current_lens = self.loadLens(lens)
+				self._transferLens(current_lens,transfer)
+				yield current_lens
+
+			return
+
+		#Bounded queue: at most prefetch lenses are held in memory on top of the current one
+		loaded = queue.Queue(maxsize=self.prefetch)
+		stop = threading.Event()
+		load_time = [0.0]
+
+		def reader():
+
+			for lens in lenses:
+
+				try:
+					start = time.time()
+					current_lens = self._readLens(lens)
+					self._transferLens(current_lens,transfer)
+					load_time[0] += time.time() - start
+					item = (current_lens,None)
+				except Exception as e:
+					item = (None,e)
+
+				#Wait for a free slot, unless the consumer went away
+				while not stop.is_set():
+					try:
+						loaded.put(item,timeout=0.1)
+						break
+					except queue.Full:
+						pass
+
+				if (item[1] is not None) or stop.is_set():
+					return
+
+		thread = threading.Thread(target=reader,name="LensPrefetch")
+		thread.daemon = True
+		thread.start()
+
+		wait_time = 0.0
+
+		try:
+
+			for n in range(len(lenses)):
+
+				start = time.time()
+				current_lens,error = loaded.get()
+				wait_time += time.time() - start
+
+				if error is not None:
+					raise error
+
+				self._rollLens(current_lens)
+				yield current_lens
+
+		finally:
+
+			stop.set()
+			thread.join()
+
+		logray.info("Lens prefetching (depth {0}): {1:.3f}s of lens loading, {2:.3f}s hidden behind computations".format(self.prefetch,load_time[0],max(load_time[0]-wait_time,0.0)))
+
+	def randomRoll(self,seed=None):
+
+		"""
+		Randomly rolls all the lenses in the system along both axes
+
+		:param seed: random seed with which to initialize the generator
+		:type seed: int.
+
+		"""
+
+		if seed is not None:
+			np.random.seed(seed)
+
+		for lens in self.lens:
+			lens.randomRoll(seed=None,lmesh=self.lmesh)
+
+
+	def reorderLenses(self):
+
+		"""
+		Reorders the lenses in the ray tracer according to their comoving distance from the observer
+
+		"""
+
+		self.lens = [ lens for (redshift,lens) in sorted(zip(self.redshift,self.lens)) ]
+		self.redshift.sort()
+		self.distance.sort()
+
+
+	##################################################################################################################################
+	#####################This method solves the nonlinear lensing ODE#################################################################
+	#############################(backward ray tracing)###############################################################################
+	##################################################################################################################################
+
+	def shoot(self,initial_positions,z=2.0,initial_deflection=None,kind="positions",save_intermediate=False,compute_all_deflections=False,callback=None,transfer=None,chunk_size=None,**kwargs):
+
+		"""
+		Shots a bucket of light rays from the observer to the sources at redshift z (backward ray tracing), through the system of gravitational lenses, and computes the deflection statistics
+
+		:param initial_positions: initial angular positions of the light ray bucket, according to the observer; if unitless, the positions are assumed to be in radians. initial_positions[0] is x, initial_positions[1] is y
+		:type initial_positions: numpy array or quantity
+
+		:param z: redshift of the sources; if an array is passed, a redshift must be specified for each ray, i.e. z.shape==initial_positions.shape[1:]; if a (sorted) list is passed, the rays are traced once through the lenses and the results are computed for each of the source redshifts in the list
+		:type z: float., array or list
+
+		:param initial_deflection: if not None, this is the initial deflection light rays undergo with respect to the line of sight (equivalent to specifying the first derivative IC on the lensing ODE); must have the same shape as initial_positions
+		:type initial_deflection: numpy array or quantity
 
 		:param kind: what deflection statistics to compute; "positions" will calculate the ray deflections after they crossed the last lens, "jacobian" will compute the lensing jacobian matrix after the last lens, "shear" and "convergence" will compute the omonimous weak lensing statistics  
 		:type kind: str.
@@ -1119,40 +2055,74 @@ class RayTracer(object):
 		:param transfer: if not None, scales the fluctuations on each lens plane to a different redshift (before computing the ray defections) using a provided transfer function 
 		:type transfer: :py:class:`TransferSpecs`
 
+		:param chunk_size: if not None, the light rays are moved across each lens in tiles of (at most) chunk_size rays, which bounds the memory taken by the temporary arrays; each lens is loaded only once for all the tiles
+		:type chunk_size: int.
+
 		:param kwargs: the keyword arguments are passed to the callback if not None
 		:type kwargs: dict.
 
-		:returns: angular positions (or jacobians) of the light rays after the last lens crossing
+		:returns: angular positions (or jacobians) of the light rays after the last lens crossing (a list with one element per source redshift if z is a list)
 
 		"""
 
+		assert transfer is None or isinstance(transfer,TransferSpecs)
+		assert not(self.windowed) or ((transfer is None) and not(compute_all_deflections)),"Windows of lens planes cannot be scaled with a transfer function or differentiated with FFTs!"
+
+		#Move the light rays across the lenses, loaded (and scaled with the transfer function) one at a time
+		steps = self._shootSteps(initial_positions,z=z,initial_deflection=initial_deflection,kind=kind,save_intermediate=save_intermediate,compute_all_deflections=compute_all_deflections,callback=callback,chunk_size=chunk_size,**kwargs)
+		num_lenses = next(steps)
+		result = next(steps)
+
+		#Windowed lens planes: while waiting for each lens, the generator hands back the current ray positions, which decide the window to read
+		if self.windowed:
+			
+			for k in range(num_lenses):
+				lens = self.lens[k]
+				current_lens = self._readLensWindow(lens,result) if type(lens)==str else self.loadLens(lens)
+				result = steps.send(current_lens)
+
+			return result
+
+		for current_lens in self.iterLenses(num_lenses,transfer=transfer):
+			result = steps.send(current_lens)
+
+		return result
+
+	def _shootSteps(self,initial_positions,z=2.0,initial_deflection=None,kind="positions",save_intermediate=False,compute_all_deflections=False,callback=None,chunk_size=None,**kwargs):
+
+		#Generator version of shoot: yields the number of lenses to cross, then receives the loaded lenses one at a time (through send, each time yielding the current flat ray positions in radians) and finally yields the result
+
 		#Sanity check
 		assert self.lens_type==PotentialPlane, "Lens type must be PotentialPlane"
 		assert initial_positions.ndim>=2 and initial_positions.shape[0]==2,"initial positions shape must be (2,...)!"
 		assert type(initial_positions)==quantity.Quantity and initial_positions.unit.physical_type=="angle"
 		assert kind in ["positions","jacobians","shear","convergence"],"kind must be one in [positions,jacobians,shear,convergence]!"
-		assert transfer is None or isinstance(transfer,TransferSpecs)
 
-		#Allocate arrays for the intermediate light ray positions and deflections
+		#Allocate arrays for the intermediate light ray positions and deflections (in the precision of the ray tracer); the lens loop runs on plain arrays of radians, the units are stripped here and reattached to the outputs
+		dtype = np.float64 if self.double_precision else np.float32
+		unit = initial_positions.unit
 
 		if initial_deflection is None:
-			current_positions = initial_positions.copy()
-			current_deflection = np.zeros(initial_positions.shape) * initial_positions.unit
+			current_positions = _radians(initial_positions,dtype)
+			current_deflection = np.zeros(initial_positions.shape,dtype=dtype)
 		else:
 			assert initial_deflection.shape==initial_positions.shape
-			current_deflection = initial_deflection.copy()
-			current_positions = initial_positions + initial_deflection
+			current_deflection = _radians(initial_deflection,dtype)
+			current_positions = _radians(initial_positions,dtype) + current_deflection
+
+		def with_units(positions):
+			return quantity.Quantity(positions,unit=rad,copy=False).to(unit)
 
 		#If we want to trace jacobians, allocate also space for the jacobians
 		if kind in ["jacobians","shear","convergence"]:
 
 			#Initial condition for the jacobian is the identity
-			current_jacobian = np.outer(np.array([1.0,0.0,0.0,1.0]),np.ones(initial_positions.shape[1:])).reshape((4,)+initial_positions.shape[1:])
-			current_jacobian_deflection = np.zeros(current_jacobian.shape)
+			current_jacobian = np.outer(np.array([1.0,0.0,0.0,1.0],dtype=dtype),np.ones(initial_positions.shape[1:],dtype=dtype)).reshape((4,)+initial_positions.shape[1:])
+			current_jacobian_deflection = np.zeros(current_jacobian.shape,dtype=dtype)
 
-			#Useful to compute the product of the jacobian (2x2 matrix) with the shear matrix (2x2 symmetric matrix)
-			dotter = np.zeros((4,3,4))
-			dotter[(0,0,1,1,2,2,3,3),(0,2,0,2,2,1,2,1),(0,2,1,3,0,2,1,3)] = 1
+			#Flat (4,Nrays) views for the jacobian recursion
+			flat_jacobian = current_jacobian.reshape((4,-1))
+			flat_jacobian_deflection = current_jacobian_deflection.reshape((4,-1))
 
 		#Decide which is the last lens the light rays should cross
 		if type(z)==np.ndarray:
@@ -1166,15 +2136,55 @@ class RayTracer(object):
 			#Compute the number of lenses that each ray should cross
 			last_lens_ray = (z[None] > np.array(self.redshift).reshape((len(self.redshift),)+(1,)*len(z.shape))).argmin(0) - 1
 			last_lens = last_lens_ray.max()
+
+			#Sort the rays by last lens crossed once (stable sort of small integers): at each lens, the rays that still need to be moved form a contiguous (shrinking) range at the end of the flat arrays
+			ray_order = np.argsort(last_lens_ray.reshape(-1).astype(np.int16),kind="mergesort")
+			flat_z = z.reshape(-1)[ray_order]
+			flat_last_lens_ray = last_lens_ray.reshape(-1)[ray_order]
+			current_positions = np.take(current_positions.reshape((2,-1)),ray_order,axis=1)
+			current_deflection = np.take(current_deflection.reshape((2,-1)),ray_order,axis=1)
+
+			#Per ray weights of the jacobian distortions
+			if kind in ["jacobians","convergence","shear"]:
+				jacobian_weights = np.zeros(flat_z.shape,dtype=dtype)
+		
+		elif type(z) in [list,tuple]:
+
+			#Check that the source redshifts are sorted and not too high given the current lenses
+			assert len(z)>0,"At least one source redshift must be specified!"
+			assert all([ z[n]<=z[n+1] for n in range(len(z)-1) ]),"Source redshifts must be sorted!"
+			assert z[-1]<self.redshift[-1],"Given the current lenses you can trace up to redshift {0:.2f}!".format(self.redshift[-1])
+
+			#Compute the last lens before each source redshift: the results are interpolated between lenses when the rays cross it
+			last_lens_source = [ (zs>np.array(self.redshift)).argmin() - 1 for zs in z ]
+			last_lens = last_lens_source[-1]
+
+			#One output for each source redshift (sources in front of the first lens see the initial conditions)
+			if kind=="positions":
+				source_outputs = [ current_positions.copy() for zs in z ]
+				flat_source_outputs = [ output.reshape((2,-1)) for output in source_outputs ]
+			else:
+				source_outputs = [ current_jacobian.copy() for zs in z ]
+				flat_source_outputs = [ output.reshape((4,-1)) for output in source_outputs ]
 		
 		else:
 			
 			#Check that redshift is not too high given the current lenses
 			assert z<self.redshift[-1],"Given the current lenses you can trace up to redshift {0:.2f}!".format(self.redshift[-1])
 			last_lens = (z>np.array(self.redshift)).argmin() - 1
+
+		#Scatter the sorted rays back to the original order (the initial jacobian is the identity, so it does not need sorting); the rays are sorted only when each has its own redshift
+		def restore_order(flat_array):
+
+			if type(z)!=np.ndarray:
+				return flat_array
+
+			restored = np.empty(flat_array.shape,dtype=flat_array.dtype)
+			restored[:,ray_order] = flat_array
+			return restored.reshape((flat_array.shape[0],)+initial_positions.shape[1:])
 		
 		if kind=="positions" and save_intermediate:
-			all_positions = np.zeros((last_lens+1,) + initial_positions.shape) * initial_positions.unit
+			all_positions = np.zeros((last_lens+1,) + initial_positions.shape,dtype=dtype)
 
 		#The light rays positions at the k+1 th step are computed according to Xk+1 = Xk + Dk, where Dk is the deflection
 		#To stabilize the solution numerically we compute the deflections as Dk+1 = (Ak-1)Dk + Ck*pk where pk is the deflection due to the potential gradient
@@ -1182,105 +2192,205 @@ class RayTracer(object):
 		#Ordered references to the lenses
 		distance = np.array([ d.to(Mpc).value for d in [0.0*Mpc] + self.distance ])
 		redshift = np.array([0.0] + self.redshift)
-		lens = self.lens
+
+		#Split the light rays in tiles: flat (2,Nrays) views of the ray positions and deflections are sliced along the ray axis
+		flat_positions = current_positions.reshape((2,-1))
+		flat_deflection = current_deflection.reshape((2,-1))
+		num_rays = flat_positions.shape[1]
+
+		if chunk_size is None:
+			chunk_size = num_rays
+		else:
+			assert chunk_size>0,"chunk_size must be positive!"
+			chunk_size = min(chunk_size,num_rays)
+
+		tiles = [ (first,min(first+chunk_size,num_rays)) for first in range(0,num_rays,chunk_size) ]
+		logray.debug("Light rays split in {0} tiles of (at most) {1} rays".format(len(tiles),chunk_size))
+
+		#Preallocated buffer for the deflections and shear matrices at the ray positions (one tile at a time)
+		if kind in ["jacobians","convergence","shear"]:
+			lens_derivatives_buffer = np.empty(5*chunk_size,dtype=dtype)
+
+		#Work buffer for the stacked FFT derivatives of lenses in fourier space (allocated once)
+		fourier_work = None
+
+		#Hand back the number of lenses to cross: the caller sends them in one at a time
+		yield last_lens+1
 
 		#This is the main loop that goes through all the lenses
 		for k in range(last_lens+1):
 
-			#Load in the lens
-			current_lens = self.loadLens(lens[k])
-			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
+			current_lens = (yield flat_positions)
 
-			#If transfer function is provided, scale to target redshift
-			if transfer is not None:
-				current_lens.scaleWithTransfer(transfer.cur2target[current_lens.redshift],tfr=transfer.tfr,with_scale_factor=transfer.with_scale_factor,kmesh=transfer.kmesh,scaling_method=transfer.scaling_method)
+			#Check the loaded lens (scaled to the target redshift if a transfer function is provided)
+			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
 
 			#Log
 			logray.debug("Crossing lens {0} at redshift z={1:.3f}".format(k,current_lens.redshift))
 			start = time.time()
 			last_timestamp = start
 
-			#Compute the deflection angles and log timestamp
-			if compute_all_deflections:
-				deflections = current_lens.deflectionAngles(lmesh=self.lmesh).getValues(current_positions[0],current_positions[1])
-			else:
-				deflections = current_lens.deflectionAngles(current_positions[0],current_positions[1])
+			#Compute geometrical weight factors
+			Ak = (distance[k+1] / distance[k+2]) * (1.0 + (distance[k+2] - distance[k+1])/(distance[k+1] - distance[k]))
+			Ck = -1.0 * (distance[k+2] - distance[k+1]) / distance[k+2]
 
-			now = time.time()
-			logray.debug("Retrieval of deflection angles from potential planes completed in {0:.3f}s".format(now-last_timestamp))
-			logstderr.debug("Retrieval of deflection angles: peak memory usage {0:.3f} (task)".format(peakMemory()))
-			last_timestamp = now
+			#Jacobians through lenses in fourier space: all the derivatives are computed on the whole lens with a single stacked inverse FFT, and looked up at the ray positions
+			if compute_all_deflections and (kind in ["jacobians","convergence","shear"]) and (current_lens.space=="fourier") and (current_lens._derivatives is None):
 
-			#If we are tracing jacobians we need to retrieve the shear matrices too
-			if kind in ["jacobians","convergence","shear"]:
+				if (fourier_work is None) or (fourier_work.shape!=current_lens.data.shape+(5,)) or (fourier_work.dtype!=current_lens.data.dtype):
+					fourier_work = np.empty(current_lens.data.shape+(5,),dtype=current_lens.data.dtype)
 
-				if compute_all_deflections:
-					shear_tensors = current_lens.shearMatrix(lmesh=self.lmesh).getValues(current_positions[0],current_positions[1])
-				else:
-					shear_tensors = current_lens.shearMatrix(current_positions[0],current_positions[1])
+				current_lens = copy.copy(current_lens)
+				current_lens._derivatives = current_lens._fourierDerivatives(lmesh=self.lmesh,work=fourier_work)
 
 				now = time.time()
-				logray.debug("Shear matrices retrieved in {0:.3f}s".format(now-last_timestamp))
-				logstderr.debug("Shear matrices retrieved: peak memory usage {0:.3f} (task)".format(peakMemory()))
+				logray.debug("Deflection angles and shear matrices computed on the whole lens with stacked FFTs in {0:.3f}s".format(now-last_timestamp))
+				logstderr.debug("Deflection angles and shear matrices computed on the whole lens: peak memory usage {0:.3f} (task)".format(peakMemory()))
 				last_timestamp = now
-			
-			#####################################################################################
 
-			#Compute geometrical weight factors
-			Ak = (distance[k+1] / distance[k+2]) * (1.0 + (distance[k+2] - distance[k+1])/(distance[k+1] - distance[k]))
-			Ck = -1.0 * (distance[k+2] - distance[k+1]) / distance[k+2]
+			#If the lens has precomputed derivative planes, these are looked up instead of computing the derivatives on the whole lens
+			full_lens = compute_all_deflections and (current_lens._derivatives is None)
 
-			#Compute the position on the next lens and log timestamp
-			current_deflection *= (Ak-1) 
-			now = time.time()
-			logray.debug("Geometrical weight factors calculations and deflection scaling completed in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now
+			#If we are tracing jacobians and we proceed in real space (or by lookups), retrieve deflections and shear matrices in a single pass
+			fused = kind in ["jacobians","convergence","shear"] and not(full_lens) and (current_lens.space=="real" or (current_lens._derivatives is not None))
 
-			#Add deflections and log timestamp
-			current_deflection += Ck * deflections 
-			now = time.time()
-			logray.debug("Deflection angles computed in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now
-
-			#If we are tracing jacobians we need to compute the matrix product with the shear matrix
-			if kind in ["jacobians","convergence","shear"]:
+			#With FFTs the derivatives are computed once on the whole lens, and then evaluated at the positions of each tile
+			if full_lens:
 
-				current_jacobian_deflection *= (Ak-1)
+				deflection_plane = current_lens.deflectionAngles(lmesh=self.lmesh)
+				if kind in ["jacobians","convergence","shear"]:
+					shear_plane = current_lens.shearMatrix(lmesh=self.lmesh)
 
-				#This is the part in which the products with the shear matrix are computed
-				current_jacobian_deflection += Ck * (np.tensordot(dotter,current_jacobian,axes=([2],[0])) * shear_tensors).sum(1)
-				
 				now = time.time()
-				logray.debug("Shear matrix products computed in {0:.3f}s".format(now-last_timestamp))
-				logstderr.debug("Shear matrix products completed: peak memory usage {0:.3f} (task)".format(peakMemory()))
+				logray.debug("Deflection angles and shear matrices computed on the whole lens in {0:.3f}s".format(now-last_timestamp))
+				logstderr.debug("Deflection angles and shear matrices computed on the whole lens: peak memory usage {0:.3f} (task)".format(peakMemory()))
 				last_timestamp = now
 
-			###########################################################################################
-
+			#Only the rays whose source is behind this lens need to be moved (if they are sorted by redshift, they are at the end of the arrays)
 			if type(z)==np.ndarray:
-				
-				current_positions[:,k<last_lens_ray] += current_deflection[:,k<last_lens_ray]
-				current_positions[:,k==last_lens_ray] += current_deflection[:,k==last_lens_ray] * (z[None,k==last_lens_ray] - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+				first_active = np.searchsorted(flat_last_lens_ray,k,side="left")
+				last_crossing = np.searchsorted(flat_last_lens_ray,k,side="right")
+				lens_tiles = [ (first,min(first+chunk_size,num_rays)) for first in range(first_active,num_rays,chunk_size) ]
+			else:
+				lens_tiles = tiles
 
-				#We need to add the distortions to the jacobians too
-				if kind in ["jacobians","convergence","shear"]:
-					current_jacobian[:,k<last_lens_ray] += current_jacobian_deflection[:,k<last_lens_ray]
-					current_jacobian[:,k==last_lens_ray] += current_jacobian_deflection[:,k==last_lens_ray] * (z[None,k==last_lens_ray] - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+			#Move the light rays across the lens, one tile at a time
+			for first,last in lens_tiles:
+
+				tile_positions = flat_positions[:,first:last]
+				tile_deflection = flat_deflection[:,first:last]
+
+				if fused:
+
+					lens_derivatives = lens_derivatives_buffer[:5*(last-first)].reshape((5,last-first))
+					current_lens.deflectionShear(tile_positions[0],tile_positions[1],out=lens_derivatives)
+					deflections = lens_derivatives[:2]
+					shear_tensors = lens_derivatives[2:]
+
+					now = time.time()
+					logray.debug("Deflection angles and shear matrices retrieved in {0:.3f}s".format(now-last_timestamp))
+					logstderr.debug("Deflection angles and shear matrices retrieved: peak memory usage {0:.3f} (task)".format(peakMemory()))
+					last_timestamp = now
 
-			else:
-				
-				if k<last_lens:
-					current_positions += current_deflection
 				else:
-					current_positions += current_deflection * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
 
-				#We need to add the distortions to the jacobians too
+					#The plane methods take angle quantities (views of the ray positions, no copies)
+					tile_angles = quantity.Quantity(tile_positions,unit=rad,copy=False)
+
+					#Compute the deflection angles (in radians) and log timestamp
+					if full_lens:
+						deflections = quantity.Quantity(deflection_plane.getValues(tile_angles[0],tile_angles[1]),unit=rad,copy=False).value
+					else:
+						deflections = current_lens.deflectionAngles(tile_angles[0],tile_angles[1]).to(rad).value
+
+					now = time.time()
+					logray.debug("Retrieval of deflection angles from potential planes completed in {0:.3f}s".format(now-last_timestamp))
+					logstderr.debug("Retrieval of deflection angles: peak memory usage {0:.3f} (task)".format(peakMemory()))
+					last_timestamp = now
+
+				#If we are tracing jacobians we need to retrieve the shear matrices too
+				if kind in ["jacobians","convergence","shear"] and not(fused):
+
+					if full_lens:
+						shear_tensors = shear_plane.getValues(tile_angles[0],tile_angles[1])
+					else:
+						shear_tensors = current_lens.shearMatrix(tile_angles[0],tile_angles[1])
+
+					now = time.time()
+					logray.debug("Shear matrices retrieved in {0:.3f}s".format(now-last_timestamp))
+					logstderr.debug("Shear matrices retrieved: peak memory usage {0:.3f} (task)".format(peakMemory()))
+					last_timestamp = now
+				
+				#####################################################################################
+
+				#Compute the position on the next lens and log timestamp
+				tile_deflection *= (Ak-1) 
+				now = time.time()
+				logray.debug("Geometrical weight factors calculations and deflection scaling completed in {0:.3f}s".format(now-last_timestamp))
+				last_timestamp = now
+
+				#Add deflections and log timestamp
+				tile_deflection += Ck * deflections 
+				now = time.time()
+				logray.debug("Deflection angles computed in {0:.3f}s".format(now-last_timestamp))
+				last_timestamp = now
+
+				#If we are tracing jacobians we need to compute the matrix product with the shear matrix and add the distortions to the jacobians (in place, in a single pass)
 				if kind in ["jacobians","convergence","shear"]:
 
+					#Weight of the jacobian distortions for each ray (1 before the last lens, the fraction of the distance to the next lens at the last lens, 0 afterwards)
+					if type(z)==np.ndarray:
+						split = min(max(last_crossing,first),last)
+						tile_weights = jacobian_weights[first:last]
+						tile_weights[:split-first] = (flat_z[first:split] - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+						tile_weights[split-first:] = 1.0
+					elif type(z) in [list,tuple]:
+						tile_weights = 0.0 if (k in last_lens_source) else 1.0
+					elif k<last_lens:
+						tile_weights = 1.0
+					else:
+						tile_weights = (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+
+					_topology.jacobianStep(flat_jacobian[:,first:last],flat_jacobian_deflection[:,first:last],shear_tensors,Ak-1,Ck,tile_weights)
+					
+					now = time.time()
+					logray.debug("Shear matrix products computed in {0:.3f}s".format(now-last_timestamp))
+					logstderr.debug("Shear matrix products completed: peak memory usage {0:.3f} (task)".format(peakMemory()))
+					last_timestamp = now
+
+				###########################################################################################
+
+				if type(z)==np.ndarray:
+
+					#The rays whose source is between this lens and the next come first in the tile
+					split = min(max(last_crossing,first),last)
+					tile_positions[:,:split-first] += tile_deflection[:,:split-first] * (flat_z[None,first:split] - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+					tile_positions[:,split-first:] += tile_deflection[:,split-first:]
+
+				elif type(z) in [list,tuple]:
+
+					#Interpolate between this lens and the next for each source redshift that falls in between
+					for n,zs in enumerate(z):
+
+						if last_lens_source[n]!=k:
+							continue
+
+						if kind=="positions":
+							flat_source_outputs[n][:,first:last] = tile_positions + tile_deflection * (zs - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+						else:
+							flat_source_outputs[n][:,first:last] = flat_jacobian[:,first:last] + flat_jacobian_deflection[:,first:last] * ((zs - redshift[k+1]) / (redshift[k+2] - redshift[k+1]))
+
+					#Move on to the next lens
+					tile_positions += tile_deflection
+					if (kind in ["jacobians","convergence","shear"]) and (k in last_lens_source):
+						flat_jacobian[:,first:last] += flat_jacobian_deflection[:,first:last]
+
+				else:
+					
 					if k<last_lens:
-						current_jacobian += current_jacobian_deflection
+						tile_positions += tile_deflection
 					else:
-						current_jacobian += current_jacobian_deflection * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+						tile_positions += tile_deflection * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
 
 			now = time.time()
 			logray.debug("Addition of deflections completed in {0:.3f}s".format(now-last_timestamp))
@@ -1289,14 +2399,14 @@ class RayTracer(object):
 
 			#Save the intermediate positions if option was specified
 			if kind=="positions" and save_intermediate:
-				all_positions[k] = current_positions.copy()
+				all_positions[k] = restore_order(flat_positions).reshape(initial_positions.shape)
 
 			#Optionally, call the callback function on the current positions
 			if callback is not None:
 				if kind=="positions":
-					callback(current_positions,self,k,**kwargs)
+					callback(with_units(restore_order(flat_positions).reshape(initial_positions.shape)),self,k,**kwargs)
 				elif kind=="jacobians":
-					callback(current_jacobian,self,k,**kwargs)
+					callback(restore_order(flat_jacobian).reshape(current_jacobian.shape),self,k,**kwargs)
 
 			#Log timestamp to cross lens
 			now = time.time()
@@ -1304,26 +2414,46 @@ class RayTracer(object):
 			logstderr.debug("Lens {0} crossed: peak memory usage {1:.3f} (task)".format(k,peakMemory()))
 
 
+		#Multiple source redshifts: return one output for each
+		if type(z) in [list,tuple]:
+			
+			if kind=="convergence":
+				yield [ 1.0 - 0.5*(jacobian[0]+jacobian[3]) for jacobian in source_outputs ]
+			elif kind=="shear":
+				yield [ np.array([0.5*(jacobian[3] - jacobian[0]),-0.5*(jacobian[1]+jacobian[2])]) for jacobian in source_outputs ]
+			elif kind=="positions":
+				yield [ with_units(positions) for positions in source_outputs ]
+			else:
+				yield source_outputs
+
+			return
+
+		#Back to the original order of the light rays if they were sorted by redshift
+		if type(z)==np.ndarray:
+			current_positions = restore_order(flat_positions)
+			if kind in ["jacobians","convergence","shear"]:
+				current_jacobian = restore_order(flat_jacobian)
+
 		#Return the final positions of the light rays (or jacobians)
 		if kind=="positions":
 			
 			if save_intermediate:
-				return all_positions
+				yield with_units(all_positions)
 			else:
-				return current_positions
+				yield with_units(current_positions)
 
 		else:
 
 			#Different return types according to option (can compute convergence and shear directly)
 
 			if kind=="convergence":
-				return 1.0 - 0.5*(current_jacobian[0]+current_jacobian[3]) 
+				yield 1.0 - 0.5*(current_jacobian[0]+current_jacobian[3]) 
 			
 			elif kind=="shear":
-				return np.array([0.5*(current_jacobian[3] - current_jacobian[0]),-0.5*(current_jacobian[1]+current_jacobian[2])])
+				yield np.array([0.5*(current_jacobian[3] - current_jacobian[0]),-0.5*(current_jacobian[1]+current_jacobian[2])])
 
 			else:
-				return current_jacobian
+				yield current_jacobian
 
 	##################################################################################
 	###########Direct calculation of the convergence with Born approximation##########
@@ -1364,7 +2494,6 @@ class RayTracer(object):
 		#Ordered references to the lenses
 		distance = np.array([ d.to(Mpc).value for d in [0.0*Mpc] + self.distance ])
 		redshift = np.array([0.0] + self.redshift)
-		lens = self.lens
 
 		#Initial positions
 		current_positions = initial_positions.copy()
@@ -1378,13 +2507,12 @@ class RayTracer(object):
 
 		#Loop that goes through the lenses
 		current_convergence = np.zeros(initial_positions.shape[1:])
-		for k in range(last_lens+1):
+		for k,current_lens in enumerate(self.iterLenses(last_lens+1)):
 
 			#Start time for this lens
 			start = time.time()
 
-			#Load in the lens
-			current_lens = self.loadLens(lens[k])
+			#Check the loaded lens
 			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
 
 			#Extract the density at the ray positions
@@ -1506,7 +2634,6 @@ class RayTracer(object):
 		#Ordered references to the lenses
 		distance = np.array([ d.to(Mpc).value for d in [0.0*Mpc] + self.distance ])
 		redshift = np.array([0.0] + self.redshift)
-		lens = self.lens
 
 		#Initial positions
 		current_positions = initial_positions
@@ -1526,19 +2653,18 @@ class RayTracer(object):
 		current_jacobians_1 = np.zeros((3,)+initial_positions.shape[1:])
 		current_jacobians = np.zeros((3,)+initial_positions.shape[1:])
 		
-		for k in range(last_lens+1):
+		for k,current_lens in enumerate(self.iterLenses(last_lens+1)):
 
 			#Start time for this lens
 			start = time.time()
 
-			#Load in the lens
-			current_lens = self.loadLens(lens[k])
+			#Check the loaded lens
 			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
 
 			#Maybe transpose
 			if k<=transpose_up_to:
 				logray.debug("Transposing pixel values for lens {0}".format(k))
-				current_lens.data = current_lens.data.T
+				current_lens._transposeRoll()
 
 			#Distances, lensing kernel
 			chi_prev = distance[k]
@@ -1635,6 +2761,155 @@ class RayTracer(object):
 		else:
 			return current_convergence
 
+	##########################################################################################
+	###########Born, post-Born and ray traced convergence in a single pass####################
+	##########################################################################################
+
+	def convergenceLOS(self,initial_positions,z=2.0,terms=("born","ll","gp"),jacobians=False,transpose_up_to=-1,callback=None,**kwargs):
+
+		"""
+		Computes the Born convergence, the second post-Born corrections to the convergence (lens-lens coupling and geodesic perturbation) and optionally the ray traced jacobians in a single pass through the lenses: each lens is loaded once, the field values at the unperturbed ray positions are shared by all the terms, and only the running sums of the line of sight integrals are held in memory
+
+		:param initial_positions: initial angular positions of the light ray bucket, according to the observer; initial_positions[0] is x, initial_positions[1] is y
+		:type initial_positions: quantity
+
+		:param z: redshift of the sources
+		:type z: float.
+
+		:param terms: contributions to the convergence to compute, any of "born" (first order), "ll" (lens-lens coupling) and "gp" (geodesic perturbation)
+		:type terms: tuple.
+
+		:param jacobians: if True, the light rays are also traced through the same lenses and the jacobians at the sources are computed (as in shoot with kind="jacobians")
+		:type jacobians: bool.
+
+		:param transpose_up_to: transpose all the lenses before a certain index before integration
+		:type transpose_up_to: int.
+
+		:param callback: function is called on each contribution to the convergence during the LOS integration. The signature of the callback is callback(array_ov_values,tracer,k,type,**kwargs)
+		:type callback: callable.
+
+		:param kwargs: additional keyword arguments to be passed to the callback
+		:type kwargs: dict.
+
+		:returns: dictionary with the convergence contribution at each of the initial positions for each of the terms (and the ray traced jacobians, with key "jacobians", if requested)
+
+		"""
+
+		#Sanity check
+		assert initial_positions.ndim>=2 and initial_positions.shape[0]==2,"initial positions shape must be (2,...)!"
+		assert type(initial_positions)==quantity.Quantity and initial_positions.unit.physical_type=="angle"
+		assert self.lens_type==PotentialPlane
+		for term in terms:
+			assert term in ["born","ll","gp"],"Convergence term {0} not recognized!".format(term)
+
+		#Check that redshift is not too high given the current lenses
+		assert z<self.redshift[-1],"Given the current lenses you can trace up to redshift {0:.2f}!".format(self.redshift[-1])
+		last_lens = (z>np.array(self.redshift)).argmin() - 1
+
+		#Ordered references to the lenses
+		distance = np.array([ d.to(Mpc).value for d in [0.0*Mpc] + self.distance ])
+		redshift = np.array([0.0] + self.redshift)
+
+		#Running sums: the convergence terms, the deflections (in radians) and the jacobians integrated along the unperturbed ray trajectories
+		convergence = dict([ (term,np.zeros(initial_positions.shape[1:])) for term in terms ])
+
+		if "gp" in terms:
+			deflections_0 = np.zeros(initial_positions.shape)
+			deflections_1 = np.zeros(initial_positions.shape)
+			current_deflections = np.zeros(initial_positions.shape)
+
+		if "ll" in terms:
+			jacobians_0 = np.zeros((3,)+initial_positions.shape[1:])
+			jacobians_1 = np.zeros((3,)+initial_positions.shape[1:])
+			current_jacobians = np.zeros((3,)+initial_positions.shape[1:])
+
+		#The ray traced jacobians are computed by the shoot generator, which receives the same lenses
+		if jacobians:
+			steps = self._shootSteps(initial_positions,z=z,kind="jacobians")
+			next(steps)
+			traced = next(steps)
+
+		for k,current_lens in enumerate(self.iterLenses(last_lens+1)):
+
+			#Start time for this lens
+			start = time.time()
+
+			#Check the loaded lens
+			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
+
+			#Maybe transpose
+			if k<=transpose_up_to:
+				logray.debug("Transposing pixel values for lens {0}".format(k))
+				current_lens._transposeRoll()
+
+			#Distances, lensing kernel (the last lens is weighted by the fraction of its slab in front of the sources)
+			chi_prev = distance[k]
+			chi = distance[k+1]
+			kernel = 1. - (chi/current_lens.cosmology.comoving_distance(z).to(Mpc).value)
+			if k==last_lens:
+				kernel *= (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+
+			#Field values at the unperturbed ray positions, computed once and shared by all the terms
+			logray.debug("Extracting field values from lens {0} at redshift {1:2f}".format(k,current_lens.redshift))
+
+			if ("born" in terms) or ("ll" in terms):
+				shear_tensors_lcl = current_lens.shearMatrix(initial_positions[0],initial_positions[1])
+
+			if "gp" in terms:
+
+				deflections_lcl = current_lens.deflectionAngles(initial_positions[0],initial_positions[1]).to(rad).value
+				density_grad_lcl = current_lens.densityGradient(initial_positions[0],initial_positions[1])
+
+				#Conversion of density gradient times deflection into a number
+				gp_scale = (density_grad_lcl.unit*rad).decompose().scale
+				density_grad_lcl = density_grad_lcl.value
+
+				#Save geodesic perturbation term
+				if callback is not None:
+					callback(gp_scale*(deflections_lcl*density_grad_lcl).sum(0),self,k,"gpgd",**kwargs)
+
+			#Accumulate the contributions of this lens (the post-Born terms use the running sums up to the previous lens)
+			for term in terms:
+
+				if term=="born":
+					add_on = (0.5*kernel) * (shear_tensors_lcl[0]+shear_tensors_lcl[1])
+				elif term=="ll":
+					add_on = (0.5*kernel) * (shear_tensors_lcl*current_jacobians)[[0,1,2,2]].sum(0)
+				else:
+					add_on = (kernel*gp_scale) * (density_grad_lcl*current_deflections).sum(0)
+
+				convergence[term] += add_on
+				if callback is not None:
+					callback(add_on,self,k,term,**kwargs)
+
+			#Update the running sums
+			if k<last_lens:
+
+				if "gp" in terms:
+					deflections_0 += deflections_lcl
+					deflections_1 += deflections_lcl*(0.5*(chi+chi_prev))
+					np.multiply(deflections_1,1.0/chi,out=current_deflections)
+					current_deflections -= deflections_0
+
+				if "ll" in terms:
+					jacobians_0 += shear_tensors_lcl
+					jacobians_1 += shear_tensors_lcl*(0.5*(chi+chi_prev))
+					np.multiply(jacobians_1,1.0/chi,out=current_jacobians)
+					current_jacobians -= jacobians_0
+
+			#Trace the light rays through the same lens
+			if jacobians:
+				traced = steps.send(current_lens)
+
+			now = time.time()
+			logray.debug("Lens {0} crossed in {1:.3f}s".format(k,now-start))
+
+		#Return to the user
+		if jacobians:
+			convergence["jacobians"] = traced
+
+		return convergence
+
 	########################################################################
 	###########Calculation of omega at second post-Born order###############
 	########################################################################
@@ -1672,7 +2947,6 @@ class RayTracer(object):
 		#Ordered references to the lenses
 		distance = np.array([ d.to(Mpc).value for d in [0.0*Mpc] + self.distance ])
 		redshift = np.array([0.0] + self.redshift)
-		lens = self.lens
 
 		#Initial positions
 		current_positions = initial_positions
@@ -1687,13 +2961,12 @@ class RayTracer(object):
 		current_jacobians_1 = np.zeros((3,)+initial_positions.shape[1:])
 		current_jacobians = np.zeros((3,)+initial_positions.shape[1:])
 		
-		for k in range(last_lens+1):
+		for k,current_lens in enumerate(self.iterLenses(last_lens+1)):
 
 			#Start time for this lens
 			start = time.time()
 
-			#Load in the lens
-			current_lens = self.loadLens(lens[k])
+			#Check the loaded lens
 			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
 
 			#Distances, lensing kernel
@@ -1746,10 +3019,10 @@ class RayTracer(object):
 	############Forward ray tracing##########################
 	#########################################################
 
-	def shootForward(self,source_positions,z=2.0,save_intermediate=False,grid_resolution=512,interpolation="nearest"):
+	def shootForward(self,source_positions,z=2.0,save_intermediate=False,grid_resolution=512,interpolation="bilinear"):
 
 		"""
-		Shoots a bucket of light rays from the source at redshift z to the observer at redshift 0 (forward ray tracing) and computes the according deflections using backward ray tracing plus a suitable interpolation scheme (KD Tree based)
+		Shoots a bucket of light rays from the source at redshift z to the observer at redshift 0 (forward ray tracing) and computes the according deflections using backward ray tracing of a regular grid plus a suitable interpolation scheme
 
 		:param source_positions: angular positions of the unlensed sources
 		:type source_positions: numpy array or quantity
@@ -1763,14 +3036,16 @@ class RayTracer(object):
 		:param grid_resolution: the number of points on a side of the interpolation grid (must be choosen big enough according to the number of sources to resolve)
 		:type grid_resolution: int. 
 
-		:param interpolation: only "nearest" implemented so far
+		:param interpolation: "bilinear" locates each source in the cells of the lensed grid (through a spatial hash) and inverts the bilinear map of the cell, which gives sub-cell accuracy; sources that do not fall in any cell (outside of the lensed grid) get the nearest grid point. "nearest" uses the nearest grid point for all the sources (KD Tree based)
 		:type interpolation: str.
 
 		:returns: apparent positions of the sources as seen from the observer
 
 		"""
 
-		#First allocate the regular grid to use (must be fine enough to resolve the single ray distortions, since we use nearest neighbors interpolation for now)
+		assert interpolation in ["bilinear","nearest"],"Interpolation {0} not implemented!".format(interpolation)
+
+		#First allocate the regular grid to use (must be fine enough to resolve the single ray distortions)
 		corner = source_positions.max(axis=tuple(range(1,len(source_positions.shape))))
 		initial_grid = np.array(np.meshgrid(np.linspace(0.0,corner[0].value,grid_resolution),np.linspace(0.0,corner[1].value,grid_resolution))) * corner.unit
 		initial_grid = initial_grid.reshape((2,)+(reduce(mul,initial_grid.shape[1:]),))
@@ -1785,51 +3060,62 @@ class RayTracer(object):
 		logray.debug("Ray tracing in {0:.3f}s".format(now-last_timestamp))
 		last_timestamp = now
 
-		if save_intermediate:
-
-			#If this option is enabled the full evolution of the distortions (after each lens is crossed) is computed
+		#Flat source positions in the units of the grid
+		sources = source_positions.reshape((2,)+(reduce(mul,source_positions.shape[1:]),)).to(corner.unit).value
 
-			#Allocate space for the apparent positions
+		#If this option is enabled the full evolution of the distortions (after each lens is crossed) is computed
+		if save_intermediate:
 			apparent_positions = np.zeros((final_grid.shape[0],) + source_positions.shape) * corner.unit
-
 			for n in range(final_grid.shape[0]):
+				apparent_positions[n] = self._invertGrid(initial_grid,final_grid[n].to(corner.unit).value,sources,grid_resolution,interpolation).reshape(source_positions.shape)
+		else:
+			apparent_positions = self._invertGrid(initial_grid,final_grid.to(corner.unit).value,sources,grid_resolution,interpolation).reshape(source_positions.shape)
 
-				#Next build the KD tree for nearest neighbors interpolation
-				tree = KDTree(final_grid[n].transpose())
+		#Return the measured apparent distances
+		return apparent_positions
 
-				now = time.time()
-				logray.debug("KDTree built in {0:.3f}s".format(now-last_timestamp))
-				last_timestamp = now
+	def _invertGrid(self,initial_grid,final_grid,sources,grid_resolution,interpolation):
 
-				#Query the tree and retrieve the apparent positions
-				distances,apparent_position_index = tree.query(source_positions.reshape((2,)+(reduce(mul,source_positions.shape[1:]),)).transpose())
+		#Apparent positions of the sources, given the regular grid of light rays (initial_grid) and where the rays end up (final_grid); sources and final_grid are plain arrays in the units of initial_grid
+		now = time.time()
+		last_timestamp = now
 
-				now = time.time()
-				logray.debug("Tree query completed in {0:.3f}s".format(now-last_timestamp))
-				last_timestamp = now
+		if interpolation=="bilinear":
 
-				apparent_positions[n] = initial_grid[:,apparent_position_index].reshape(source_positions.shape).copy()
+			#Locate the sources in the lensed grid cells, the apparent position is the same point in the regular grid cell
+			cell,u,v,located = _locateInGrid(final_grid.reshape((2,grid_resolution,grid_resolution)),sources)
+			row,column = np.divmod(cell,grid_resolution-1)
+			spacing = initial_grid[:,-1] / (grid_resolution-1)
+			apparent_positions = np.array([(column+u)*spacing[0].value,(row+v)*spacing[1].value]) * initial_grid.unit
 
+			now = time.time()
+			logray.debug("Located {0} of {1} sources in the lensed grid in {2:.3f}s".format(located.sum(),len(located),now-last_timestamp))
+			last_timestamp = now
 
-		else:
+			if located.all():
+				return apparent_positions
+			
+			missing = np.where(~located)[0]
 
-			#Next build the KD tree for nearest neighbors interpolation
-			tree = KDTree(final_grid.transpose())
+		else:
+			apparent_positions = np.zeros(sources.shape) * initial_grid.unit
+			missing = np.arange(sources.shape[1])
 
-			now = time.time()
-			logray.debug("KDTree built in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now
+		#Next build the KD tree for nearest neighbors interpolation
+		tree = KDTree(final_grid.transpose())
 
-			#Query the tree and retrieve the apparent positions
-			distances,apparent_position_index = tree.query(source_positions.reshape((2,)+(reduce(mul,source_positions.shape[1:]),)).transpose())
+		now = time.time()
+		logray.debug("KDTree built in {0:.3f}s".format(now-last_timestamp))
+		last_timestamp = now
 
-			now = time.time()
-			logray.debug("Tree query completed in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now
+		#Query the tree and retrieve the apparent positions
+		distances,apparent_position_index = tree.query(sources[:,missing].transpose())
 
-			apparent_positions = initial_grid[:,apparent_position_index].reshape(source_positions.shape)
+		now = time.time()
+		logray.debug("Tree query completed in {0:.3f}s".format(now-last_timestamp))
+		last_timestamp = now
 
-		#Return the measured apparent distances
+		apparent_positions[:,missing] = initial_grid[:,apparent_position_index]
 		return apparent_positions
 
 
@@ -1949,9 +3235,133 @@ class RayTracer(object):
 			pass
 
 
+#######################################################
+###############RayTracerBatch class####################
+#######################################################
 
+class RayTracerBatch(object):
 
+	"""
+	Batch of ray tracers (typically different random realizations drawn from the same pool of lens planes) that move their light rays through the lenses together, one lens index at a time: at each lens index, the tracers that drew the same plane file are served by a single loaded copy of it, each with its own random roll. The random rolls of each tracer continue the random sequence from where it was when the tracer was added to the batch, so the results are the same as calling shoot on each tracer in turn
 
+	"""
 
-		
+	def __init__(self,tracers=None):
+
+		"""
+		:param tracers: ray tracers to add to the batch, in order
+		:type tracers: list.
+
+		"""
+
+		self.tracers = list()
+		self._random_states = list()
+
+		for tracer in (tracers or list()):
+			self.add(tracer)
+
+	def __len__(self):
+		return len(self.tracers)
+
+	def add(self,tracer):
+
+		"""
+		Adds a ray tracer to the batch, recording the current state of the random number generator (from which the random rolls of its lenses will be drawn)
+
+		:param tracer: ray tracer to add
+		:type tracer: :py:class:`RayTracer`
+
+		"""
+
+		assert isinstance(tracer,RayTracer)
+		assert tracer.shared_store is None,"Lens planes in the shared store are loaded collectively, and cannot be batched!"
+		assert not(tracer.windowed),"Windowed lens planes depend on the ray positions of each tracer, and cannot be batched!"
+		assert (not self.tracers) or (tracer.double_precision==self.tracers[0].double_precision),"All the tracers in the batch must have the same precision!"
+
+		self.tracers.append(tracer)
+		self._random_states.append(np.random.get_state())
+
+	def shoot(self,initial_positions,z=2.0,kind="positions",transfer=None,chunk_size=None):
+
+		"""
+		Shoots the same bucket of light rays through the lenses of each tracer in the batch (see :py:meth:`RayTracer.shoot`): the ray state of each tracer is kept in memory at the same time, and the planes are loaded once per lens index for all the tracers that use them. Shared planes are rolled lazily; if more tracers need the jacobians across the same real space plane, the deflection angles and shear matrices are computed once on the whole plane and looked up by all of them. The global random state is left untouched
+
+		:param initial_positions: initial angular positions of the light ray bucket, according to the observer; if unitless, the positions are assumed to be in radians. initial_positions[0] is x, initial_positions[1] is y
+		:type initial_positions: quantity
+
+		:param z: redshift of the sources (same meaning as in :py:meth:`RayTracer.shoot`)
+		:type z: float., array or list
+
+		:param kind: what deflection statistics to compute (same meaning as in :py:meth:`RayTracer.shoot`)
+		:type kind: str.
+
+		:param transfer: if not None, scales the fluctuations on each lens plane to a different redshift using the provided transfer function (applied once per loaded plane)
+		:type transfer: :py:class:`TransferSpecs`
+
+		:param chunk_size: if not None, the light rays are moved across each lens in tiles of (at most) chunk_size rays
+		:type chunk_size: int.
+
+		:returns: list with the result of each tracer, in the order in which the tracers were added
+
+		"""
+
+		assert len(self.tracers),"The batch is empty!"
+		assert transfer is None or isinstance(transfer,TransferSpecs)
+
+		#One ray state for each tracer
+		steps = [ tracer._shootSteps(initial_positions,z=z,kind=kind,chunk_size=chunk_size) for tracer in self.tracers ]
+		num_lenses = [ next(step) for step in steps ]
+		assert len(set(num_lenses))==1,"All the tracers in the batch must cross the same number of lenses!"
+		results = [ next(step) for step in steps ]
+
+		random_states = list(self._random_states)
+		outer_random_state = np.random.get_state()
+
+		try:
+
+			for k in range(num_lenses[0]):
+
+				start = time.time()
+
+				#Group the tracers that use the same plane at this lens index
+				groups = OrderedDict()
+				for n,tracer in enumerate(self.tracers):
+					lens = tracer.lens[k]
+					groups.setdefault(lens if type(lens)==str else id(lens),list()).append(n)
+
+				for members in groups.values():
+
+					lens = self.tracers[members[0]].lens[k]
+
+					#Lens planes in memory are used as they are
+					if type(lens)!=str:
+						for n in members:
+							current_lens = self.tracers[n].loadLens(lens)
+							self.tracers[n]._transferLens(current_lens,transfer)
+							results[n] = steps[n].send(current_lens)
+						continue
+
+					#Read the plane once for the whole group
+					plane = self.tracers[members[0]]._readLens(lens)
+					self.tracers[members[0]]._transferLens(plane,transfer)
+
+					#Planes in fourier space are differentiated with the stacked FFTs even if used by a single tracer
+					if (kind in ["jacobians","convergence","shear"]) and (plane._derivatives is None) and ((len(members)>1) or (plane.space=="fourier")):
+						plane.computeDerivatives(lmesh=self.tracers[members[0]].lmesh)
+
+					#Each tracer rolls its own shallow copy of the plane, continuing its own random sequence
+					for n in members:
+						current_lens = copy.copy(plane)
+						np.random.set_state(random_states[n])
+						self.tracers[n]._rollLens(current_lens)
+						random_states[n] = np.random.get_state()
+						results[n] = steps[n].send(current_lens)
+
+					del plane,current_lens
+
+				logray.debug("Lens {0} crossed by {1} tracers using {2} planes in {3:.3f}s".format(k,len(self.tracers),len(groups),time.time()-start))
+
+		finally:
+			np.random.set_state(outer_random_state)
 
+		return results
@@ -26,7 +26,8 @@ else:
 import numpy as np
 import pandas as pd
 
-from scipy import stats,interpolate
+from scipy import stats,interpolate,linalg
+from scipy.spatial.distance import cdist
 
 from emcee.ensemble import _function_wrapper
 
@@ -1013,7 +1014,7 @@ class Emulator(Analysis):
 		:param method: interpolation method; can be 'Rbf' or callable. If callable, it must take two arguments, a square distance and a square length smoothing scale
 		:type method: str. or callable
 
-		:param kwargs: keyword arguments to be passed to the interpolator constructor
+		:param kwargs: keyword arguments to be passed to the interpolator constructor (with method='Rbf' these are 'function', 'epsilon' and 'smooth' as in scipy.interpolate.Rbf; anything else falls back to one scipy Rbf per feature bin)
 
 		"""
 
@@ -1037,11 +1038,18 @@ class Emulator(Analysis):
 
 		if method=="Rbf":
 
-			#Scipy Rbf method
-			self._interpolator = list()
+			if _RbfInterpolator.supports(**kwargs):
 
-			for n in range(self._num_bins):
-				self._interpolator.append(_interpolate_wrapper(interpolate.Rbf,args=(tuple(used_parameters.T) + (flattened_feature_set[:,n],)),kwargs=kwargs))
+				#Multi-output Rbf: the kernel matrix is shared between the bins, factorize it once
+				self._interpolator = _RbfInterpolator(used_parameters,flattened_feature_set,**kwargs)
+
+			else:
+
+				#Scipy Rbf method
+				self._interpolator = list()
+
+				for n in range(self._num_bins):
+					self._interpolator.append(_interpolate_wrapper(interpolate.Rbf,args=(tuple(used_parameters.T) + (flattened_feature_set[:,n],)),kwargs=kwargs))
 
 		else:
 
@@ -1426,6 +1434,67 @@ class EmulatorPanel(Panel):
 
 #########################################################################################################################################################################################
 
+###########################################################################
+###########Multi-output radial basis function interpolator#################
+###########################################################################
+
+class _RbfInterpolator(object):
+
+	"""
+	Radial basis function interpolator that reproduces scipy.interpolate.Rbf, but handles all the feature bins at once: the kernel matrix only depends on the training points, so it is LU factorized once and the weights of all the bins are stored in a single (Npoints,Nbins) matrix
+
+	"""
+
+	#Radial functions, same conventions as scipy.interpolate.Rbf
+	_functions = {
+	"multiquadric" : lambda r,e: np.sqrt((r/e)**2 + 1),
+	"inverse" : lambda r,e: 1.0/np.sqrt((r/e)**2 + 1),
+	"inverse_multiquadric" : lambda r,e: 1.0/np.sqrt((r/e)**2 + 1),
+	"gaussian" : lambda r,e: np.exp(-(r/e)**2),
+	"linear" : lambda r,e: r,
+	"cubic" : lambda r,e: r**3,
+	"quintic" : lambda r,e: r**5,
+	"thin_plate" : lambda r,e: np.where(r>0,r**2*np.log(np.where(r>0,r,1.0)),0.0),
+	}
+
+	#Maximum number of (point,node) pairs held in memory at once during a prediction
+	_block_size = 2**22
+
+	@classmethod
+	def supports(cls,function="multiquadric",epsilon=None,smooth=0.0,**kwargs):
+		return (function in cls._functions) and not(len(kwargs))
+
+	def __init__(self,points,values,function="multiquadric",epsilon=None,smooth=0.0):
+
+		self.points = np.asarray(points,dtype=np.float64)
+		self.function = function
+
+		#Default smoothing scale: the average distance between nodes based on a bounding hypercube
+		if epsilon is None:
+			edges = self.points.max(0) - self.points.min(0)
+			edges = edges[np.nonzero(edges)]
+			epsilon = np.power(np.prod(edges)/len(self.points),1.0/edges.size)
+
+		self.epsilon = epsilon
+		self.smooth = smooth
+
+		#Factorize the kernel matrix once and solve for the weights of all the bins together
+		kernel = self._functions[function](cdist(self.points,self.points),epsilon) - np.eye(len(self.points))*smooth
+		self.weights = linalg.lu_solve(linalg.lu_factor(kernel),np.asarray(values,dtype=np.float64))
+
+	def __call__(self,parameters):
+
+		parameters = np.atleast_2d(parameters)
+		interpolated_feature = np.empty((parameters.shape[0],self.weights.shape[1]))
+
+		#Process the parameter points in blocks, to bound the size of the distance matrix
+		step = max(1,self._block_size//len(self.points))
+		for s in range(0,parameters.shape[0],step):
+			r = cdist(parameters[s:s+step],self.points)
+			np.dot(self._functions[self.function](r,self.epsilon),self.weights,out=interpolated_feature[s:s+step])
+
+		return interpolated_feature
+
 ###########################################################################
 ###########Hack to make scipy interpolate objects pickleable###############
 ###########################################################################
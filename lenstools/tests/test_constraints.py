@@ -237,6 +237,23 @@ def test_interpolation():
 
 	return chi2_values_1,chi2_values_2
 
+#Test the multi-output Rbf interpolator against scipy.interpolate.Rbf
+def test_rbf():
+
+	from scipy.interpolate import Rbf
+
+	np.random.seed(1)
+	parameters = np.random.rand(20,3)
+	features = np.random.rand(20,10)
+	emulator = Emulator.from_features(features,parameters=parameters,parameter_index=["Om","w","si8"])
+
+	points = np.random.rand(50,3)
+	for function in ["multiquadric","gaussian","thin_plate"]:
+		emulator.train(function=function)
+		predicted = emulator.predict(points,raw=True)
+		scipy_predicted = np.array([ Rbf(*(tuple(parameters.T) + (features[:,n],)),function=function)(*points.T) for n in range(features.shape[1]) ]).T
+		assert np.allclose(predicted,scipy_predicted)
+
 def test_find():
 
 	emulator = Emulator.read("analysis.pkl")
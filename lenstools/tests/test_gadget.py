@@ -28,6 +28,42 @@ def test_read():
 	#Close the snapshot
 	snapshot.close()
 
+def test_chunked_read():
+
+	#Open the gadget snapshot
+	snapshot = Gadget2SnapshotDE.open(os.path.join(dataExtern(),"gadget/snapshot_001"))
+
+	#The memory mapped chunks must match what is read in at once
+	pos = snapshot.getPositions(save=False)
+	assert np.all(np.concatenate([ p.value for p in snapshot.iterPositions(chunk_size=1000) ])==pos.value)
+	assert np.all(np.concatenate([ p.value for p in snapshot.iterPositions(chunk_size=1000,first=500,last=2500) ])==pos.value[500:2500])
+	assert np.allclose(snapshot.memmap("velocities")*snapshot._velocity_unit,snapshot.getVelocities(save=False).value)
+	assert np.all(snapshot.memmap("ids")==snapshot.getID(save=False))
+
+	#Gridding the positions chunk by chunk must give the same density
+	density,resolution = snapshot.massDensity(resolution=32)
+	density_chunks,resolution_chunks = snapshot.massDensity(resolution=32,chunk_size=1000)
+	assert np.allclose(density,density_chunks)
+
+	#Close the snapshot
+	snapshot.close()
+
+def test_distributed_read():
+
+	#Without a pool, a single task reads all the particles of the snapshot
+	snapshot = Gadget2SnapshotDE.open(os.path.join(dataExtern(),"gadget/snapshot_001"))
+	snapshot_distributed = Gadget2SnapshotDE.openDistributed(os.path.join(dataExtern(),"gadget/snapshot_001"))
+	assert snapshot_distributed._parts==[(snapshot.fp.name,0,snapshot.header["num_particles_file"])]
+
+	#Gridding must give the same density, reading the particles all at once or chunk by chunk
+	density,resolution = snapshot.massDensity(resolution=32)
+	assert np.allclose(density,snapshot_distributed.massDensity(resolution=32)[0])
+	assert np.allclose(density,snapshot_distributed.massDensity(resolution=32,chunk_size=1000)[0])
+
+	#Close the snapshots
+	snapshot.close()
+	snapshot_distributed.close()
+
 def test_write():
 
 	#Create an empty gadget snapshot
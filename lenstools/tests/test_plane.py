@@ -29,4 +29,47 @@ def test_nfw():
 	#Build a PotentialPlane
 	pln = PotentialPlane(p/p.max(),snap.header["box_size"],comoving_distance=snap.header["comoving_distance"],unit=None,num_particles=n)
 	pln.visualize(colorbar=True)
-	pln.savefig("nfw.png")
\ No newline at end of file
+	pln.savefig("nfw.png")
+
+def test_multi_slab():
+
+	#Create Gadget2Snapshot with random particles
+	snap = Gadget2Snapshot()
+	snap.setPositions(np.random.rand(10000,3).astype(np.float32)*240.0*u.Mpc)
+	snap.weights = None
+	snap.virial_radius = None
+	snap.concentration = None
+	snap.setHeaderInfo(box_size=240.0*u.Mpc)
+
+	#Binning all the slabs in one pass (or the slabs of two centers at a time, within the memory budget) must give the same planes as cutting them one at a time
+	centers = np.array([40.0,120.0,200.0])*u.Mpc
+
+	for assignment,memory_budget in [("NGP",None),("CIC",None),("NGP",2*3*64*64*4*u.byte),("CIC",2*3*64*64*4*u.byte)]:
+		
+		planes = snap.cutPlanesGaussianGrid(normals=(0,1,2),centers=centers,thickness=80.0*u.Mpc,plane_resolution=64,left_corner=np.zeros(3)*u.Mpc,assignment=assignment,memory_budget=memory_budget)
+
+		for center in centers:
+			for normal in (0,1,2):
+				p,b,n = next(planes)
+				p_single,b_single,n_single = snap.cutPlaneGaussianGrid(normal=normal,center=center,thickness=80.0*u.Mpc,plane_resolution=64,left_corner=np.zeros(3)*u.Mpc,assignment=assignment)
+				assert n==n_single
+				assert np.allclose(p,p_single)
+
+def test_mass_assignment():
+
+	#Create Gadget2Snapshot with random particles away from the box edges
+	snap = Gadget2Snapshot()
+	snap.setPositions((20.0+np.random.rand(10000,3).astype(np.float32)*200.0)*u.Mpc)
+	snap.weights = None
+	snap.virial_radius = None
+	snap.concentration = None
+	snap.setHeaderInfo(box_size=240.0*u.Mpc)
+
+	for assignment in ("NGP","CIC","TSC"):
+
+		#All the mass of interior particles must land on the grid, whatever the number of threads
+		density,bin_edges = snap.massDensity(resolution=64,left_corner=np.zeros(3)*u.Mpc,assignment=assignment)
+		assert np.isclose(density.sum(),64**3,rtol=1e-4)
+
+		density_threads,bin_edges = snap.massDensity(resolution=64,left_corner=np.zeros(3)*u.Mpc,assignment=assignment,num_threads=4)
+		assert (density_threads==density).all()
@@ -1,13 +1,17 @@
 import os
 
-from ..simulations.raytracing import RayTracer,PotentialPlane,DeflectionPlane
+from ..simulations.raytracing import RayTracer,RayTracerBatch,PotentialPlane,DeflectionPlane,PlaneCache,SharedPlaneStore
+from ..simulations.camb import CAMBTransferFunction
+from ..utils.mpi import MPIWhirlPool
 from .. import ConvergenceMap,OmegaMap,ShearMap
 
 from .. import dataExtern
+from ..extern import _topology
 
 import numpy as np
 import matplotlib.pyplot as plt
 from astropy.units import deg,rad,arcmin
+import astropy.units as u
 
 import logging
 import time
@@ -147,6 +151,115 @@ def test_callback():
 
 
 
+def test_plane_cache():
+
+	#Read each plane twice through a cache that fits only two planes at a time
+	plane_names = [ os.path.join(dataExtern(),"lensing/planes/snap{0}_potentialPlane0_normal0.fits").format(i) for i in range(11,14) ]
+	plane = PotentialPlane.load(plane_names[0])
+	cache = PlaneCache(2*plane.data.nbytes*u.byte)
+
+	for name in plane_names + plane_names:
+		cached_plane = cache.load(name,PotentialPlane)
+		assert (cached_plane.data==PotentialPlane.load(name).data).all()
+
+	#The least recently used planes are evicted
+	assert cache.misses==6 and cache.hits==0
+	assert len(cache)==2 and (plane_names[0] not in cache)
+	assert cache.load(plane_names[-1],PotentialPlane) is not None and cache.hits==1
+
+	#Rolling a cached plane leaves the cached buffer untouched
+	cached_tracer = RayTracer(plane_cache=cache)
+	rolled = cached_tracer.loadLens(plane_names[-1])
+	assert (cache.load(plane_names[-1],PotentialPlane).data==PotentialPlane.load(plane_names[-1]).data).all()
+	assert rolled.data.shape==plane.data.shape
+
+	#Scaling a cached plane with a transfer function works on a private copy of the pixels
+	tfr = CAMBTransferFunction.read(os.path.join(dataExtern(),"camb","camb_tfr.pkl"))
+	for scaling_method in ["uniform","FFT"]:
+		scaled = cache.load(plane_names[-1],PotentialPlane)
+		scaled.scaleWithTransfer(1.5,tfr,scaling_method=scaling_method)
+		assert (cache.load(plane_names[-1],PotentialPlane).data==PotentialPlane.load(plane_names[-1]).data).all()
+
+def test_lazy_roll():
+
+	plane_name = os.path.join(dataExtern(),"lensing/planes/snap11_potentialPlane0_normal0.fits")
+	b = np.random.rand(2,1000)*PotentialPlane.load(plane_name).side_angle.to(deg).value
+
+	for space in ["real","fourier"]:
+
+		#Same random numbers for the eager and the lazy roll
+		rolled,lazy = PotentialPlane.load(plane_name),PotentialPlane.load(plane_name)
+		if space=="fourier":
+			rolled.toFourier()
+			lazy.toFourier()
+
+		rolled.randomRoll(seed=11)
+		lazy.randomRoll(seed=11,lazy=True)
+
+		if space=="fourier":
+			rolled.toReal()
+			lazy.toReal()
+
+		#Pixel values and derivatives must agree
+		assert np.allclose(rolled.getValues(b[0]*deg,b[1]*deg),lazy.getValues(b[0]*deg,b[1]*deg))
+		assert np.allclose(rolled.deflectionAngles(b[0]*deg,b[1]*deg),lazy.deflectionAngles(b[0]*deg,b[1]*deg))
+		assert np.allclose(rolled.shearMatrix(b[0]*deg,b[1]*deg),lazy.shearMatrix(b[0]*deg,b[1]*deg))
+		assert np.allclose(rolled.shearMatrix().data,lazy.shearMatrix().data)
+
+		#Derivative planes are computed on the unrolled pixels, which must not be touched
+		pixels = lazy.data
+		lazy.computeDerivatives()
+		assert lazy.data is pixels
+		assert np.allclose(rolled.deflectionShear(b[0]*deg,b[1]*deg),lazy.deflectionShear(b[0]*deg,b[1]*deg))
+
+def test_deflection_shear():
+
+	#The fused calculation must agree with the separate deflection and shear calculations
+	lens = tracer.lens[0]
+	pos = np.random.rand(2,1000)*lens.side_angle.to(deg).value*deg
+	derivatives = np.empty((5,1000))
+	lens.deflectionShear(pos[0],pos[1],out=derivatives)
+
+	assert np.allclose(derivatives[:2],lens.deflectionAngles(pos[0],pos[1]).to(rad).value)
+	assert np.allclose(derivatives[2:],lens.shearMatrix(pos[0],pos[1]))
+
+	#Rays that lie exactly on the pixel edges (in radians, as the ray tracer sees them) must hit the same pixels
+	edges = np.arange(0,lens.data.shape[0],lens.data.shape[0]//120)[:120] * lens.resolution.to(rad).value
+	x,y = np.meshgrid(edges,edges[::-1])
+	derivatives = lens.deflectionShear(x,y)
+
+	assert np.allclose(derivatives[:2],lens.deflectionAngles(x,y).to(rad).value)
+	assert np.allclose(derivatives[2:],lens.shearMatrix(x,y))
+
+def test_fourier_derivatives():
+
+	#The stacked inverse FFT must agree with the separate deflection and shear calculations in fourier space
+	lens = PotentialPlane.load(os.path.join(dataExtern(),"lensing/planes/snap11_potentialPlane0_normal0.fits"))
+	lens.toFourier()
+	derivatives = lens._fourierDerivatives()
+	assert derivatives.flags.c_contiguous
+
+	assert np.allclose(np.moveaxis(derivatives[...,:2],-1,0),lens.deflectionAngles().data)
+	assert np.allclose(np.moveaxis(derivatives[...,2:],-1,0),lens.shearMatrix().data)
+
+def test_jacobian_step():
+
+	jacobian = np.random.randn(4,1000)
+	jacobian_deflection = np.random.randn(4,1000)
+	shear = np.random.randn(3,1000)
+	weights = np.random.rand(1000)
+
+	#Reference: product of the jacobian with the (symmetric) shear matrix via tensordot
+	dotter = np.zeros((4,3,4))
+	dotter[(0,0,1,1,2,2,3,3),(0,2,0,2,2,1,2,1),(0,2,1,3,0,2,1,3)] = 1
+	jacobian_deflection_ref = 0.3*jacobian_deflection - 0.2*(np.tensordot(dotter,jacobian,axes=([2],[0]))*shear).sum(1)
+	jacobian_ref = jacobian + jacobian_deflection_ref*weights
+
+	_topology.jacobianStep(jacobian,jacobian_deflection,shear,0.3,-0.2,weights)
+	assert np.allclose(jacobian_deflection,jacobian_deflection_ref)
+	assert np.allclose(jacobian,jacobian_ref)
+
+
 def test_convergence_born():
 
 	z_final = 2.0
@@ -203,6 +316,29 @@ def test_post_born2():
 	omega_pb2.savefig("omega_pb2.png")
 
 
+def test_convergence_los():
+
+	z_final = 2.0
+
+	#The single pass integration must agree with the separate Born, post-Born and ray tracing passes
+	pos = np.random.rand(2,1000)*tracer.lens[0].side_angle.to(deg).value*deg
+
+	np.random.seed(6)
+	terms = tracer.convergenceLOS(pos,z=z_final,jacobians=True)
+	np.random.seed(6)
+	born = tracer.convergencePostBorn2(pos,z=z_final,include_first_order=True,include_ll=False,include_gp=False)
+	np.random.seed(6)
+	conv_ll = tracer.convergencePostBorn2(pos,z=z_final,include_gp=False)
+	np.random.seed(6)
+	conv_gp = tracer.convergencePostBorn2(pos,z=z_final,include_ll=False)
+	np.random.seed(6)
+	jacobians = tracer.shoot(pos,z=z_final,kind="jacobians")
+
+	assert np.allclose(terms["born"],born)
+	assert np.allclose(terms["ll"],conv_ll)
+	assert np.allclose(terms["gp"],conv_gp)
+	assert np.allclose(terms["jacobians"],jacobians)
+
 def test_distortion():
 
 	#Figures
@@ -233,6 +369,25 @@ def test_distortion():
 	fig.savefig("lens_distortion.png")
 
 
+def test_forward_bilinear():
+
+	#Sources located with the bilinear grid inversion must be traced back onto themselves with sub-cell accuracy
+	side = tracer.lens[0].side_angle.to(deg).value
+	pos = (0.25 + 0.5*np.random.rand(2,1000))*side*deg
+
+	np.random.seed(7)
+	pos_apparent = tracer.shootForward(pos,z=2.0,grid_resolution=128)
+	np.random.seed(7)
+	pos_nearest = tracer.shootForward(pos,z=2.0,grid_resolution=128,interpolation="nearest")
+	np.random.seed(7)
+	pos_traced = tracer.shoot(pos_apparent,z=2.0)
+	np.random.seed(7)
+	pos_traced_nearest = tracer.shoot(pos_nearest,z=2.0)
+
+	spacing = pos.max().value/127
+	assert np.abs(pos_apparent-pos_nearest).to(deg).value.max() < 2*spacing
+	assert np.median(np.abs(pos_traced-pos).to(deg).value) < np.median(np.abs(pos_traced_nearest-pos).to(deg).value)
+
 def test_continuous_distortion():
 
 	#load unlensed image from png file
@@ -269,3 +424,234 @@ def test_continuous_distortion():
 		ax.set_title("z={:.2f}".format(tracer.redshift[n]))	
 		fig.savefig("distortion{0}.png".format(n))	 
 
+
+def test_chunked_shoot():
+
+	#Moving the rays in tiles must not change the result
+	b = np.linspace(0.0,tracer.lens[0].side_angle.to(deg).value,128)
+	xx,yy = np.meshgrid(b,b)
+	pos = np.array([xx,yy]) * deg
+
+	for kind in ["positions","jacobians"]:
+		full = tracer.shoot(pos,z=1.5,kind=kind)
+		chunked = tracer.shoot(pos,z=1.5,kind=kind,chunk_size=1000)
+		assert np.allclose(full,chunked)
+
+def test_prefetch():
+
+	#Reading the lenses ahead in a background thread must not change the result
+	pos = np.random.rand(2,1000)*tracer.lens[0].side_angle.to(deg).value*deg
+	results = list()
+
+	for prefetch in [0,2]:
+		
+		prefetch_tracer = RayTracer(prefetch=prefetch)
+		for i in range(11,20):
+			plane_name = os.path.join(dataExtern(),"lensing/planes/snap{0}_potentialPlane0_normal0.fits").format(i)
+			plane = PotentialPlane.load(plane_name)
+			prefetch_tracer.addLens((plane_name,plane.comoving_distance,plane.redshift))
+
+		prefetch_tracer.reorderLenses()
+		np.random.seed(2)
+		results.append(prefetch_tracer.shoot(pos,z=prefetch_tracer.redshift[-1]-0.01,kind="jacobians"))
+
+	assert np.allclose(results[0],results[1])
+
+def test_multi_redshift():
+
+	#A single pass through the lenses must give the same jacobians as one pass per source redshift
+	pos = np.random.rand(2,1000)*tracer.lens[0].side_angle.to(deg).value*deg
+	source_redshifts = [0.5,1.0,1.5,2.0]
+
+	jacobians = tracer.shoot(pos,z=source_redshifts,kind="jacobians")
+	assert len(jacobians)==len(source_redshifts)
+
+	for n,z in enumerate(source_redshifts):
+		assert np.allclose(jacobians[n],tracer.shoot(pos,z=z,kind="jacobians"))
+
+def test_ray_redshifts():
+
+	#Rays with different source redshifts must match the single redshift results
+	pos = np.random.rand(2,1000)*tracer.lens[0].side_angle.to(deg).value*deg
+	z = np.array([1.0,2.0])[np.random.randint(0,2,size=1000)]
+
+	jacobians = tracer.shoot(pos,z=z,kind="jacobians")
+	for source_redshift in [1.0,2.0]:
+		assert np.allclose(jacobians[:,z==source_redshift],tracer.shoot(pos[:,z==source_redshift],z=source_redshift,kind="jacobians"))
+
+def test_derivative_planes():
+
+	#Looking up precomputed derivative planes must give the same jacobians as computing the derivatives on the fly
+	pos = np.random.rand(2,1000)*tracer.lens[0].side_angle.to(deg).value*deg
+	tracers = [RayTracer(),RayTracer()]
+
+	for i in range(11,20):
+		plane_name = os.path.join(dataExtern(),"lensing/planes/snap{0}_potentialPlane0_normal0.fits").format(i)
+		derivatives_name = PotentialPlane.derivativesFilename(os.path.basename(plane_name))
+
+		plane = PotentialPlane.load(plane_name)
+		plane.saveDerivatives(derivatives_name,double_precision=True)
+		assert plane.loadDerivatives(derivatives_name)
+
+		tracers[0].addLens(PotentialPlane.load(plane_name))
+		tracers[1].addLens(plane)
+
+	for t in tracers:
+		t.reorderLenses()
+
+	jacobians = [ t.shoot(pos,z=t.redshift[-1]-0.01,kind="jacobians") for t in tracers ]
+	assert np.allclose(jacobians[0],jacobians[1])
+
+	#Single precision planes read the derivatives in single precision
+	PotentialPlane.load(plane_name,double_precision=False).saveDerivatives(derivatives_name,double_precision=True)
+	plane = PotentialPlane.load(plane_name,double_precision=False)
+	assert plane.loadDerivatives(derivatives_name) and (plane._derivatives.dtype==np.float32)
+
+	#Derivatives computed from different pixels must not be attached
+	plane = PotentialPlane.load(plane_name)
+	plane.data *= 2.0
+	assert not plane.loadDerivatives(derivatives_name)
+
+def test_tracer_batch():
+
+	#Tracing realizations together against a shared lens stack must not change the results
+	pos = np.random.rand(2,1000)*tracer.lens[0].side_angle.to(deg).value*deg
+	plane_names = [ os.path.join(dataExtern(),"lensing/planes/snap{0}_potentialPlane0_normal0.fits").format(i) for i in range(11,20) ]
+	planes = [ PotentialPlane.load(name) for name in plane_names ]
+
+	def tracers():
+		for seed in range(3):
+			realization_tracer = RayTracer()
+			for name,plane in zip(plane_names,planes):
+				realization_tracer.addLens((name,plane.comoving_distance,plane.redshift))
+			realization_tracer.reorderLenses()
+			np.random.seed(seed)
+			yield realization_tracer
+
+	z = max([ plane.redshift for plane in planes ]) - 0.01
+	sequential = [ realization_tracer.shoot(pos,z=z,kind="jacobians") for realization_tracer in tracers() ]
+	batch = RayTracerBatch()
+	for realization_tracer in tracers():
+		batch.add(realization_tracer)
+
+	for result,batch_result in zip(sequential,batch.shoot(pos,z=z,kind="jacobians")):
+		assert np.allclose(result,batch_result)
+
+def test_windowed_planes():
+
+	#Reading only the windows of the planes that a tile of light rays hits must not change the result
+	pos = (0.2 + 0.1*np.random.rand(2,1000))*tracer.lens[0].side_angle.to(deg).value*deg
+	plane_names = [ os.path.join(dataExtern(),"lensing/planes/snap{0}_potentialPlane0_normal0.fits").format(i) for i in range(11,20) ]
+	results = list()
+
+	for windowed in [False,True]:
+
+		window_tracer = RayTracer(windowed=windowed)
+		for name in plane_names:
+			plane = PotentialPlane.load(name)
+			window_tracer.addLens((name,plane.comoving_distance,plane.redshift))
+
+		window_tracer.reorderLenses()
+		np.random.seed(3)
+		results.append(window_tracer.shoot(pos,z=window_tracer.redshift[-1]-0.01,kind="jacobians"))
+
+	assert np.allclose(results[0],results[1])
+
+def test_single_precision():
+
+	#Ray tracing in single precision must agree with double precision within the error budget
+	pos = np.random.rand(2,1000)*tracer.lens[0].side_angle.to(deg).value*deg
+	plane_names = [ os.path.join(dataExtern(),"lensing/planes/snap{0}_potentialPlane0_normal0.fits").format(i) for i in range(11,20) ]
+	convergence = list()
+
+	for double_precision in [True,False]:
+
+		precision_tracer = RayTracer(double_precision=double_precision)
+		for name in plane_names:
+			plane = PotentialPlane.load(name)
+			precision_tracer.addLens((name,plane.comoving_distance,plane.redshift))
+
+		precision_tracer.reorderLenses()
+		np.random.seed(4)
+		convergence.append(precision_tracer.shoot(pos,z=precision_tracer.redshift[-1]-0.01,kind="convergence"))
+
+	assert convergence[1].dtype==np.float32
+	assert np.sqrt(((convergence[1]-convergence[0])**2).mean()) < 1.0e-2*convergence[0].std()
+
+def test_single_precision_full_lens():
+
+	#The derivatives computed on the whole lens are double precision: they must be cast to the precision of the rays
+	pos = np.random.rand(2,1000)*tracer.lens[0].side_angle.to(deg).value*deg
+	plane_names = [ os.path.join(dataExtern(),"lensing/planes/snap{0}_potentialPlane0_normal0.fits").format(i) for i in range(11,20) ]
+	jacobians = list()
+
+	for double_precision in [True,False]:
+
+		precision_tracer = RayTracer(double_precision=double_precision)
+		for name in plane_names:
+			precision_tracer.addLens(PotentialPlane.load(name))
+
+		precision_tracer.reorderLenses()
+		jacobians.append(precision_tracer.shoot(pos,z=precision_tracer.redshift[-1]-0.01,kind="jacobians",compute_all_deflections=True))
+
+	assert jacobians[1].dtype==np.float32
+	assert np.sqrt(((jacobians[1]-jacobians[0])**2).mean()) < 1.0e-2*jacobians[0].std()
+
+	#Same for double precision rays on a single precision plane
+	x,y = pos.to(rad).value
+	derivatives = [ PotentialPlane.load(plane_names[0],double_precision=double_precision).deflectionShear(x,y) for double_precision in [True,False] ]
+	assert derivatives[1].dtype==np.float32
+	assert np.sqrt(((derivatives[1]-derivatives[0])**2).mean()) < 1.0e-2*derivatives[0].std()
+
+def test_position_units():
+
+	#Positions come back in the units they were passed in, and the result does not depend on the units
+	pos = np.random.rand(2,1000)*tracer.lens[0].side_angle.to(deg).value*deg
+	np.random.seed(5)
+	final_deg = tracer.shoot(pos,z=2.0,kind="positions")
+	np.random.seed(5)
+	final_arcmin = tracer.shoot(pos.to(arcmin),z=2.0,kind="positions")
+
+	assert final_deg.unit==deg
+	assert final_arcmin.unit==arcmin
+	assert np.allclose(final_arcmin.to(deg).value,final_deg.value)
+
+def test_shared_store():
+
+	#Sharing the lens planes between the tasks on the same node must not change the result (run with mpiexec -n 2 or more)
+	try:
+		pool = MPIWhirlPool()
+	except (ValueError,ImportError):
+		return
+
+	store = SharedPlaneStore(pool)
+	pos = np.random.rand(2,1000)*tracer.lens[0].side_angle.to(deg).value*deg
+	results = list()
+
+	for shared_store in [None,store]:
+		
+		shared_tracer = RayTracer(shared_store=shared_store)
+		for i in range(11,20):
+			plane_name = os.path.join(dataExtern(),"lensing/planes/snap{0}_potentialPlane0_normal0.fits").format(i)
+			plane = PotentialPlane.load(plane_name)
+			shared_tracer.addLens((plane_name,plane.comoving_distance,plane.redshift))
+
+		shared_tracer.reorderLenses()
+		np.random.seed(pool.rank)
+		results.append(shared_tracer.shoot(pos,z=shared_tracer.redshift[-1]-0.01,kind="jacobians"))
+
+	store.release()
+	assert np.allclose(results[0],results[1])
+
+def test_dynamic_scheduling():
+
+	#Each task must be processed exactly once, whatever the number of workers (run with mpiexec -n 2 or more)
+	try:
+		pool = MPIWhirlPool()
+	except (ValueError,ImportError):
+		return
+
+	results = pool.schedule(lambda n:(n,pool.rank),range(2*pool.size+1))
+	if pool.is_master():
+		assert [ r[0] for r in results ]==list(range(2*pool.size+1))
+		assert all([ r[1]>0 for r in results ])
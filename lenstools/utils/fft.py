@@ -34,7 +34,7 @@ class FFTEngine(object):
 		pass
 
 	@abstractmethod
-	def irfft2(self,x):
+	def irfft2(self,x,axes=(-2,-1)):
 		pass
 
 	@abstractmethod
@@ -83,8 +83,8 @@ class NUMPYFFTPack(FFTEngine):
 	def rfft2(self,x):
 		return np.fft.rfft2(x)
 
-	def irfft2(self,x):
-		return np.fft.irfft2(x)
+	def irfft2(self,x,axes=(-2,-1)):
+		return np.fft.irfft2(x,axes=axes)
 
 	def rfftn(self,x):
 		return np.fft.rfftn(x)
@@ -85,15 +85,37 @@ class MPIWhirlPool(MPIPool):
 
 	#######################################################################################################################
 
-	def accumulate(self,op=default_op):
+	def accumulate(self,op=default_op,method="tree"):
 
 		"""
 		Accumulates the all the window data on the master, performing a custom operation (default is sum)
 
+		:param op: MPI reduction operation
+		:type op: MPI.Op
+
+		:param method: "tree" uses a log2(size) tree of point to point (or RMA) communications between the tasks, which also leaves partial sums in the window memory of the intermediate tasks; "reduce" uses the native, in place, MPI reduction (see reduce), which leaves the window memory untouched on all the tasks but the master
+		:type method: str.
+
 		"""
 
+		#Native MPI reduction on the window memory
+		if method=="reduce":
+
+			if self._window_type=="RMA":
+				self.win.Fence()
+
+			self.reduce(self.memory,op=op)
+
+			if self._window_type=="RMA":
+				self.win.Fence()
+
+			return
+
+		elif method!="tree":
+			raise NotImplementedError("Accumulation method {0} not implemented!".format(method))
+
 		#All the tasks that participate in the communication
-		tasks = range(self.size+1)
+		tasks = list(range(self.size+1))
 
 		#Cycle until only master is left
 		while len(tasks)>1:
@@ -142,8 +164,188 @@ class MPIWhirlPool(MPIPool):
 
 				#Safety barrier
 				self.comm.Barrier()
-				
-	
+
+	#######################################################################################################################
+
+	def reduce(self,data,op=default_op,root=0,allreduce=False):
+
+		"""
+		Reduces an array across all the MPI tasks (performing a custom operation, default is sum) with the native MPI collectives, in place: the result is written into the array of the root task (of all the tasks if allreduce is True), while the arrays of the other tasks are left untouched. This is collective over all the MPI tasks; arrays that are not C contiguous are reduced through a contiguous copy
+
+		:param data: array to reduce (same shape and type on all the tasks)
+		:type data: numpy nd array
+
+		:param op: MPI reduction operation
+		:type op: MPI.Op
+
+		:param root: task that receives the result
+		:type root: int.
+
+		:param allreduce: if True, all the tasks receive the result (MPI_Allreduce)
+		:type allreduce: bool.
+
+		:returns: data
+
+		"""
+
+		assert isinstance(data,np.ndarray)
+
+		#MPI needs contiguous buffers
+		if data.flags["C_CONTIGUOUS"]:
+			buf = data
+		else:
+			buf = np.ascontiguousarray(data)
+
+		if allreduce:
+			self.comm.Allreduce(MPI.IN_PLACE,buf,op=op)
+		elif self.rank==root:
+			self.comm.Reduce(MPI.IN_PLACE,buf,op=op,root=root)
+		else:
+			self.comm.Reduce(buf,None,op=op,root=root)
+
+		#Copy the result back into non contiguous arrays
+		if (buf is not data) and (allreduce or self.rank==root):
+			data[...] = buf
+
+		return data
+
+	def reduceScatter(self,data,op=default_op):
+
+		"""
+		Reduces an array across all the MPI tasks (performing a custom operation, default is sum) with MPI_Reduce_scatter, leaving each task with the result for a contiguous block of rows (first axis) only: the rows are divided as evenly as possible between the tasks, in rank order. This is collective over all the MPI tasks
+
+		:param data: array to reduce (same shape and type on all the tasks)
+		:type data: numpy nd array
+
+		:param op: MPI reduction operation
+		:type op: MPI.Op
+
+		:returns: tuple(index of the first row of the block,reduced block of rows)
+
+		"""
+
+		assert isinstance(data,np.ndarray)
+		buf = np.ascontiguousarray(data)
+
+		#Rows assigned to each task
+		num_tasks = self.size + 1
+		first_row = [ (len(buf)*t)//num_tasks for t in range(num_tasks+1) ]
+		rows = [ first_row[t+1] - first_row[t] for t in range(num_tasks) ]
+		row_size = int(np.prod(buf.shape[1:]))
+
+		#Reduce and scatter
+		block = np.empty((rows[self.rank],) + buf.shape[1:],dtype=buf.dtype)
+		self.comm.Reduce_scatter(buf,block,recvcounts=[ r*row_size for r in rows ],op=op)
+
+		return first_row[self.rank],block
+		
+	#######################################################################################################################
+
+	def schedule(self,function,tasks,callback=None):
+
+		"""
+		Dynamic master/worker scheduling: the master hands out the tasks one at a time, each to the first worker that becomes free, and collects the results; the workers execute function(task) in the MPIPool wait loop. This is collective over all the MPI tasks, which must call it with the same function: since the function is installed locally on each worker, it does not need to be pickled (closures are allowed), only the tasks and the results travel through MPI
+
+		:param function: function to call on each task
+		:type function: callable
+
+		:param tasks: tasks to hand out (only the ones passed on the master are used)
+		:type tasks: list.
+
+		:param callback: called on the master with each result, as soon as it is received
+		:type callback: callable
+
+		:returns: list of results in the same order as the tasks (master), None (workers)
+
+		"""
+
+		#Every MPI task knows the function already, this prevents MPIPool from broadcasting it
+		self.function = function
+
+		if not self.is_master():
+			self.wait()
+			return None
+
+		tasks = list(tasks)
+
+		#With no workers (a single MPI task) the master does all the work by itself
+		if self.size<1:
+			results = list()
+			for task in tasks:
+				results.append(function(task))
+				if callback is not None:
+					callback(results[-1])
+			return results
+
+		results = [None]*len(tasks)
+		status = MPI.Status()
+
+		#Keep all the workers busy: one task each to start with, then a new task to each worker that reports back (the tag is the task index)
+		dispatched = 0
+		for worker in range(1,min(self.size,len(tasks))+1):
+			self.comm.send(tasks[dispatched],dest=worker,tag=dispatched)
+			dispatched += 1
+
+		for n in range(len(tasks)):
+
+			result = self.comm.recv(source=MPI.ANY_SOURCE,tag=MPI.ANY_TAG,status=status)
+			results[status.Get_tag()] = result
+
+			if dispatched<len(tasks):
+				self.comm.send(tasks[dispatched],dest=status.Get_source(),tag=dispatched)
+				dispatched += 1
+
+			if callback is not None:
+				callback(result)
+
+		#Release the workers from the wait loop
+		self.close()
+
+		return results
+
+	#######################################################################################################################
+
+	@property
+	def node_comm(self):
+
+		"""
+		Communicator between the tasks that run on the same node (and hence can share memory)
+
+		"""
+
+		if not hasattr(self,"_node_comm"):
+			self._node_comm = self.comm.Split_type(MPI.COMM_TYPE_SHARED,key=self.rank)
+
+		return self._node_comm
+
+	def openSharedWindow(self,nbytes):
+
+		"""
+		Allocate a MPI-3 shared memory window of nbytes bytes, visible by all the tasks on the same node; this is collective over the node communicator, and the memory is physically allocated only once per node
+
+		:param nbytes: size of the shared memory segment in bytes (must be the same on all the tasks of the node)
+		:type nbytes: int.
+
+		:returns: tuple(window,segment) where segment is a numpy byte array that views the shared memory
+
+		"""
+
+		#Only the first task on the node allocates the memory, the other tasks query its location
+		window = MPI.Win.Allocate_shared(nbytes if self.node_comm.rank==0 else 0,1,comm=self.node_comm)
+		buf,itemsize = window.Shared_query(0)
+		segment = np.ndarray(buffer=buf,dtype=np.uint8,shape=(nbytes,))
+
+		return window,segment
+
+	def closeSharedWindow(self,window):
+
+		"""
+		Free a shared memory window allocated with openSharedWindow (collective over the node communicator); views of the segment must not be used afterwards
+
+		"""
+
+		window.Free()
+
 	#######################################################################################################################
 
 	def closeWindow(self):
@@ -222,6 +222,18 @@ else:
 
 ######################################################################################################################################
 
+#OpenMP is used by the multithreaded mass assignment kernels in _nbody (they run on a single thread without it)
+openmp_modules = ["_nbody"]
+
+if conf.has_section("openmp") and conf.getboolean("openmp","enabled"):
+	print(green("[OK] OpenMP enabled for {0} (disable it in the [openmp] section of {1} if the compiler does not support -fopenmp)".format(",".join(openmp_modules),cfg_file)))
+	openmp_flags = ["-fopenmp"]
+else:
+	print(yellow("[WARNING] OpenMP disabled, the mass assignment kernels will run on a single thread (enable it in the [openmp] section of {0} if the compiler supports -fopenmp)".format(cfg_file)))
+	openmp_flags = list()
+
+######################################################################################################################################
+
 if conf.getboolean("nicaea","install_python_bindings"):
 
 	#Decide if we can install the NICAEA bindings
@@ -287,9 +299,16 @@ for ext_module in external_sources.keys():
 	if ext_module in external_support.keys():
 		sources += external_support[ext_module]
 
+	#OpenMP flags
+	if ext_module in openmp_modules:
+		extra_flags = openmp_flags
+	else:
+		extra_flags = list()
+
 	ext.append(Extension(ext_module,
                              sources,
-                             extra_link_args=lenstools_link,
+                             extra_compile_args=extra_flags,
+                             extra_link_args=lenstools_link+extra_flags,
                              include_dirs=lenstools_includes))
 
 #################################################################################################